@@ -4,33 +4,305 @@ import sys
 import subprocess
 import shutil
 import re
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from binary_utils import get_dcm2niix_bin
+from dicom_utils import group_series
+from nifti_io import NIFTI_STORAGE, STORAGE_MODES, nifti_ext, nifti_stem
+
+# "dcm2niix" runs the external converter; "native" decodes the chosen series in-process (dicom_reader.py)
+BACKENDS = ("dcm2niix", "native")
+# Threads decoding slices in the native backend (the workers argument counts dcm2niix processes)
+NATIVE_READ_WORKERS = int(os.environ.get("SARC_NATIVE_READ_WORKERS", min(16, os.cpu_count() or 1)))
 
 def _log_default(msg):
     print(msg, end="", flush=True)
 
-def dicom_to_nifti(input_base, output_base, patient_id=None, log_callback=None):
+def _series_folders(input_base):
+    """Subfolders under input_base that directly contain (non-hidden) files."""
+    folders = []
+    for folder in sorted([p for p in input_base.rglob("*") if p.is_dir()]):
+        try:
+            files = [f for f in folder.iterdir() if f.is_file() and not f.name.startswith(".")]
+        except PermissionError:
+            continue
+        if files:
+            folders.append(folder)
+    return folders
+
+_L3_RE = re.compile(r"\bL3\b", re.IGNORECASE)
+_LOCALIZER_RE = re.compile(r"scout|topogram|localizer|surview|dose\s*report|screen\s*save", re.IGNORECASE)
+# Lung/bone/sharp reconstructions (incl. Siemens B6x-B9x style kernels) segment poorly
+_SHARP_KERNEL_RE = re.compile(r"lung|bone|sharp|detail|edge|\b[BIH]r?[6-9]\d", re.IGNORECASE)
+
+def _as_text(value):
+    if value is None or value == "NA":
+        return ""
+    if isinstance(value, (list, tuple)) or type(value).__name__ == "MultiValue":
+        return " ".join(str(v) for v in value)
+    return str(value)
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def series_rank(series):
+    """
+    Sort key for a series from group_series (higher is better): an "L3"
+    description wins, then usable axial CT over scouts/dose reports, soft-tissue
+    over sharp kernels, slices of at most 5 mm, more slices, thinner slices.
+    """
+    desc = _as_text(series.get("SeriesDescription"))
+    kernel = _as_text(series.get("ConvolutionKernel"))
+    image_type = _as_text(series.get("ImageType")).upper()
+    modality = _as_text(series.get("Modality")).upper()
+    thickness = _as_float(series.get("SliceThickness"))
+    n_slices = len(series.get("files", []))
+
+    usable = (modality in ("", "CT")
+              and "LOCALIZER" not in image_type
+              and not _LOCALIZER_RE.search(desc)
+              and n_slices > 3)
+    return (
+        bool(_L3_RE.search(desc)),
+        usable,
+        not _SHARP_KERNEL_RE.search(kernel),
+        thickness is None or thickness <= 5.0,
+        n_slices,
+        -(thickness or 0.0),
+    )
+
+def plan_series(input_base, log=None, workers=8, index=None):
+    """
+    Header-only planning step: group every file under input_base by
+    SeriesInstanceUID and return the series ranked best first.
+    With index (path of a dicom_index.DicomIndex database), only new or changed
+    files are read and the grouping is answered from the index.
+    """
+    log = log or _log_default
+    if index:
+        from dicom_index import DicomIndex
+        db = DicomIndex(index)
+        stats = db.scan(input_base, workers=workers)
+        log(f"   Header index: {stats['files']} files, {stats['read']} (re)read in {stats['seconds']} s\n")
+        groups = db.group_series(input_base)
+        db.close()
+    else:
+        groups = group_series(input_base, workers=workers)
+    ranked = sorted(groups, key=series_rank, reverse=True)
+    for i, s in enumerate(ranked):
+        log(f"   {'*' if i == 0 else ' '} series {_as_text(s.get('SeriesNumber')) or '?'}: "
+            f"\"{_as_text(s.get('SeriesDescription'))}\" {len(s['files'])} slices, "
+            f"thickness {_as_text(s.get('SliceThickness')) or '?'}, kernel {_as_text(s.get('ConvolutionKernel')) or '?'}\n")
+    return ranked
+
+def select_slab(series, slab_mm, center=0.5, center_z=None):
+    """
+    Files of a series whose slice position lies within slab_mm / 2 of the slab centre.
+    The centre is center_z (mm along the slice normal, e.g. a known L3 position) if
+    given, else the fraction `center` of the scanned range measured from its inferior
+    end. A fraction only picks part of the scan (mid-scan by default); nothing here
+    locates a vertebral level. Positions come from ImagePositionPatient;
+    InstanceNumber x SliceThickness is used when they are missing.
+    """
+    files = series["files"]
+    positions = series.get("positions") or [None] * len(files)
+    if any(p is None for p in positions):
+        instances = series.get("instances") or [None] * len(files)
+        if any(i is None for i in instances):
+            return files  # no geometry in the headers, keep the whole series
+        thickness = _as_float(series.get("SliceThickness")) or 1.0
+        positions = [i * thickness for i in instances]
+
+    lo, hi = min(positions), max(positions)
+    c = float(center_z) if center_z is not None else lo + float(center) * (hi - lo)
+    half = slab_mm / 2.0
+    chosen = [f for f, p in zip(files, positions) if abs(p - c) <= half]
+    if not chosen:
+        # Window misses the scan: keep the slice nearest the requested centre
+        chosen = [min(zip(files, positions), key=lambda fp: abs(fp[1] - c))[0]]
+    return chosen
+
+def _stage_series(files, stage_dir):
+    """Expose exactly the chosen files to dcm2niix via links (copies where links are not allowed)."""
+    stage_dir.mkdir(parents=True, exist_ok=True)
+    for i, src in enumerate(files):
+        dst = stage_dir / f"{i:05d}.dcm"
+        try:
+            os.symlink(os.path.abspath(src), dst)
+        except OSError:
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+    return stage_dir
+
+def _convert_series(dcm2niix, folder, series_dir, tag, log, compress=True):
+    """Run dcm2niix on one series folder into its own directory, tagging every log line."""
+    series_dir.mkdir(parents=True, exist_ok=True)
+    cmd = [str(dcm2niix), "-z", "y" if compress else "n", "-o", str(series_dir), "-f", "%p_%s", str(folder)]
+    log(f"   [{tag}] Processing: {folder}\n")
+    log(f"   [{tag}] Running: {' '.join(cmd)}\n")
+
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1
+    )
+
+    # Stream output to log_callback
+    for line in iter(proc.stdout.readline, ""):
+        if not line:
+            break
+        log(f"   [{tag}] {line}")
+    proc.stdout.close()
+    ret = proc.wait()
+    if ret != 0:
+        log(f"   [{tag}] dcm2niix exit code {ret} for {folder}\n")
+    else:
+        log(f"   [{tag}] conversion finished for {folder}\n")
+    return ret
+
+def _collect_series_outputs(series_dirs, out_dir, log):
+    """Move every job's outputs into out_dir, prefixing names that would collide."""
+    for idx, series_dir in enumerate(series_dirs, start=1):
+        if not series_dir.exists():
+            continue
+        for f in sorted(series_dir.iterdir()):
+            target = out_dir / f.name
+            if target.exists():
+                target = out_dir / f"s{idx:03d}_{f.name}"
+            shutil.move(str(f), str(target))
+        shutil.rmtree(series_dir, ignore_errors=True)
+
+def _output_dir(output_base, patient_id):
+    """(normalized patient id or None, nifti output folder)."""
+    if patient_id:
+        pid = re.sub(r"\s+", "_", str(patient_id))
+        return pid, Path(output_base) / pid / "nifti"
+    # If output_base already looks like a nifti folder use it, otherwise create .../nifti
+    out_dir = Path(output_base)
+    if out_dir.name != "nifti":
+        out_dir = out_dir / "nifti"
+    return None, out_dir
+
+def _keep_only(out_dir, final_path, log):
+    """Remove everything in out_dir except final_path."""
+    for f in out_dir.glob("*"):
+        try:
+            if f.resolve() == final_path.resolve():
+                continue
+        except Exception:
+            # fallback compare by name
+            if f.name == final_path.name:
+                continue
+        # remove files; remove dirs recursively
+        try:
+            if f.is_dir():
+                shutil.rmtree(f)
+            else:
+                f.unlink()
+        except Exception as ex:
+            log(f"Could not remove {f}: {ex}\n")
+
+def record_l3(out_dir, z_mm):
+    """
+    Write l3.json next to the NIfTI: the L3 position scoring measures
+    (body_composition.L3_RECORD). Only for an explicitly given position.
+    """
+    path = Path(out_dir) / "l3.json"
+    path.write_text(json.dumps({"z_mm": float(z_mm)}))
+    return path
+
+def dicom_to_volume(input_base, output_base, patient_id=None, log_callback=None, workers=NATIVE_READ_WORKERS,
+                    slab_mm=None, slab_center=0.5, slab_z=None, index=None, storage=None, write=True):
+    """
+    Native conversion without dcm2niix: plan the series from the headers (as
+    dicom_to_nifti does), then decode it in-process with dicom_reader.read_series.
+    Returns (Nifti1Image held in memory, path written or None). The NIfTI is only
+    written with write=True, named <pid>_L3 or <pid>_largest like the dcm2niix output,
+    with the l3.json record when slab_z (the L3 position) is given.
+    """
+    from dicom_reader import read_series_image
+    log = log_callback or _log_default
+    pid, out_dir = _output_dir(output_base, patient_id)
+
+    ranked = plan_series(input_base, log, index=index)
+    if not ranked:
+        log(f"No DICOM series found under: {input_base}\n")
+        return None, None
+    series = ranked[0]
+    files = series["files"]
+    if slab_mm:
+        files = select_slab(series, slab_mm, slab_center, slab_z)
+        log(f"   Slab of {slab_mm} mm: reading {len(files)} of {len(series['files'])} slices\n")
+    by_file = dict(zip(series["files"], series.get("positions") or []))
+    positions = [by_file.get(f) for f in files]
+
+    log(f"▶️ Reading {len(files)} slices in-process with {workers} thread(s)\n")
+    img = read_series_image(files, positions, workers)
+    log(f"   Volume {img.shape}, zooms {tuple(round(float(z), 3) for z in img.header.get_zooms())}\n")
+    if not write:
+        return img, None
+
+    level = "L3" if _L3_RE.search(_as_text(series.get("SeriesDescription"))) else "largest"
+    stem = pid or nifti_stem(Path(files[0]).parent.name)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    final_path = out_dir / f"{stem}_{level}{nifti_ext(storage)}"
+    img.to_filename(str(final_path))
+    _keep_only(out_dir, final_path, log)
+    if slab_z is not None:
+        record_l3(out_dir, slab_z)
+    log(f"Saved {final_path}\n")
+    return img, final_path
+
+def dicom_to_nifti(input_base, output_base, patient_id=None, log_callback=None, workers=1, plan=True,
+                   slab_mm=None, slab_center=0.5, slab_z=None, index=None, storage=None, backend="dcm2niix"):
     """
     Convert DICOM -> NIfTI using dcm2niix.
+
+    With plan=True, DICOM headers are read first and only the best ranked series
+    (see series_rank) is handed to dcm2niix. Without a plan (or if no headers
+    could be parsed) every series folder is converted into its own temporary
+    directory; with workers > 1 up to that many dcm2niix processes run at once.
+    The L3/largest selection runs only after all jobs have finished.
+
+    With slab_mm (requires plan), only the slices of the chosen series within a
+    slab_mm thick window are converted (see select_slab). The window is centred on
+    slab_z, the L3 position in mm when it is known, else on the slab_center
+    fraction of the scan, which is not an L3 estimate. A given slab_z is written
+    to l3.json so scoring measures that slice; without it nothing is recorded.
+
+    storage "raw" writes an uncompressed .nii (memory-mapped by the later
+    stages) instead of .nii.gz; the default comes from SARC_NIFTI_STORAGE.
+    backend "native" reads the planned series with dicom_reader instead of
+    running dcm2niix (see dicom_to_volume).
     """
     log = log_callback or _log_default
+    ext = nifti_ext(storage)
 
     input_base = Path(input_base)
     if not input_base.exists():
         log(f"Input folder does not exist: {input_base}\n")
         return None
 
-    # Normalize patient id
-    if patient_id:
-        pid = re.sub(r"\s+", "_", str(patient_id))
-        out_dir = Path(output_base) / pid / "nifti"
-    else:
-        # If output_base already looks like a nifti folder use it, otherwise create .../nifti
-        out_dir = Path(output_base)
-        if out_dir.name != "nifti":
-            out_dir = out_dir / "nifti"
+    if backend == "native":
+        try:
+            return dicom_to_volume(input_base, output_base, patient_id, log, NATIVE_READ_WORKERS,
+                                   slab_mm, slab_center, slab_z, index, storage)[1]
+        except Exception as ex:
+            log(f"Native conversion failed: {ex}\n")
+            return None
 
+    # Normalize patient id
+    pid, out_dir = _output_dir(output_base, patient_id)
     out_dir.mkdir(parents=True, exist_ok=True)
     log(f"💾 Output NIfTI folder: {out_dir}\n")
 
@@ -42,48 +314,60 @@ def dicom_to_nifti(input_base, output_base, patient_id=None, log_callback=None):
 
     log(f"▶️ Using dcm2niix: {dcm2niix}\n")
 
-    # Runing conversion on each subfolder that contains files
-    processed_any = False
-    for folder in sorted([p for p in input_base.rglob("*") if p.is_dir()]):
+    folders = None
+    plan_dir = out_dir / ".plan"
+    if plan:
+        log("   Planning conversion from DICOM headers\n")
         try:
-            files = [f for f in folder.iterdir() if f.is_file() and not f.name.startswith(".")]
-        except PermissionError:
-            continue
-        if not files:
-            continue
-
-        processed_any = True
-        log(f"   Processing: {folder}\n")
-        cmd = [str(dcm2niix), "-z", "y", "-o", str(out_dir), "-f", "%p_%s", str(folder)]
-        log(f"   Running: {' '.join(cmd)}\n")
-
-        proc = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1
-        )
-
-        # Stream output to log_callback
-        for line in iter(proc.stdout.readline, ""):
-            if not line:
-                break
-            log(line)
-        proc.stdout.close()
-        ret = proc.wait()
-        if ret != 0:
-            log(f"   dcm2niix exit code {ret} for {folder}\n")
+            ranked = plan_series(input_base, log, index=index)
+        except Exception as ex:
+            log(f"   Header planning failed ({ex}), converting every series\n")
+            ranked = []
+        if ranked:
+            files = ranked[0]["files"]
+            if slab_mm:
+                files = select_slab(ranked[0], slab_mm, slab_center, slab_z)
+                log(f"   Slab of {slab_mm} mm: converting {len(files)} of {len(ranked[0]['files'])} slices\n")
+            folders = [_stage_series(files, plan_dir)]
         else:
-            log(f"   conversion finished for {folder}\n")
+            log("   No DICOM headers found, converting every series\n")
 
-    if not processed_any:
+    if folders is None:
+        if slab_mm:
+            log("   Slab selection needs the header plan, converting whole series\n")
+        folders = _series_folders(input_base)
+    if not folders:
         log(f"No DICOM-containing subfolders found under: {input_base}\n")
         return None
 
+    # One temp dir per series so parallel jobs cannot overwrite each other's outputs
+    series_root = out_dir / ".series"
+    series_dirs = [series_root / f"{i:03d}" for i in range(1, len(folders) + 1)]
+    workers = max(1, min(int(workers or 1), len(folders)))
+    log(f"   Converting {len(folders)} series folder(s) with {workers} worker(s)\n")
+
+    log_lock = threading.Lock()
+    def tagged_log(msg):
+        with log_lock:
+            log(msg)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(_convert_series, dcm2niix, folder, series_dir, f"series {i}", tagged_log,
+                            ext == ".nii.gz")
+                for i, (folder, series_dir) in enumerate(zip(folders, series_dirs), start=1)]
+        for job in jobs:
+            try:
+                job.result()
+            except Exception as ex:
+                log(f"   dcm2niix job failed: {ex}\n")
+
+    _collect_series_outputs(series_dirs, out_dir, log)
+    shutil.rmtree(series_root, ignore_errors=True)
+    shutil.rmtree(plan_dir, ignore_errors=True)
+
     # Post-processing: keeping only L3 nifti (if JSON mentions "L3"), else keeping largest nifti
     json_files = sorted(out_dir.glob("*.json"))
-    nii_files = sorted(out_dir.glob("*.nii.gz"))
+    nii_files = sorted(out_dir.glob("*" + ext))
 
     if not nii_files:
         log(f"⚠️ No NIfTI files created in {out_dir}\n")
@@ -101,10 +385,10 @@ def dicom_to_nifti(input_base, output_base, patient_id=None, log_callback=None):
             continue
 
     if l3_json:
-        # corresponding NIfTI has same stem + ".nii.gz"
-        candidate_nii = out_dir / (l3_json.stem + ".nii.gz")
+        # corresponding NIfTI has same stem + ".nii.gz" (".nii" for raw storage)
+        candidate_nii = out_dir / (l3_json.stem + ext)
         if candidate_nii.exists():
-            final_name = f"{pid}_L3.nii.gz" if patient_id else f"{l3_json.stem}_L3.nii.gz"
+            final_name = f"{pid}_L3{ext}" if patient_id else f"{l3_json.stem}_L3{ext}"
             final_path = out_dir / final_name
 
             # Move chosen file to final name
@@ -115,34 +399,56 @@ def dicom_to_nifti(input_base, output_base, patient_id=None, log_callback=None):
             final_path = None
 
     else:
-        # No L3 -> keep largest .nii.gz
+        # No L3 -> keep largest NIfTI
         largest = max(nii_files, key=lambda p: p.stat().st_size)
-        final_name = f"{pid}_largest.nii.gz" if patient_id else f"{largest.stem}_largest.nii.gz"
+        final_name = f"{pid}_largest{ext}" if patient_id else f"{nifti_stem(largest)}_largest{ext}"
         final_path = out_dir / final_name
         shutil.move(str(largest), str(final_path))
         log(f"No L3 found — kept largest NIfTI: {final_path}\n")
 
     # Cleanup: remove everything except final_path
     if final_path:
-        for f in out_dir.glob("*"):
-            try:
-                if f.resolve() == final_path.resolve():
-                    continue
-            except Exception:
-                # fallback compare by name
-                if f.name == final_path.name:
-                    continue
-            # remove files; remove dirs recursively
-            try:
-                if f.is_dir():
-                    shutil.rmtree(f)
-                else:
-                    f.unlink()
-            except Exception as ex:
-                log(f"Could not remove {f}: {ex}\n")
-
+        _keep_only(out_dir, final_path, log)
+        if slab_z is not None:
+            log(f"Recorded L3 at {slab_z} mm: {record_l3(out_dir, slab_z)}\n")
         log(f"Cleanup complete. Final file: {final_path}\n")
     else:
         log("No final NIfTI produced.\n")
 
-    return final_path
\ No newline at end of file
+    return final_path
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Convert a DICOM study to a single NIfTI (L3 or largest series)")
+    parser.add_argument("input_folder", help="Folder containing the DICOM series")
+    parser.add_argument("output_base", help="Base results folder")
+    parser.add_argument("patient_id", help="Patient ID (spaces are replaced by underscores)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of series converted in parallel")
+    parser.add_argument("--no-plan", action="store_true",
+                        help="Convert every series instead of only the one picked from the DICOM headers")
+    parser.add_argument("--slab-mm", type=float,
+                        help="Only convert a slab this thick (mm) around --slab-z (or --slab-center) instead of the whole series")
+    parser.add_argument("--slab-center", type=float, default=0.5,
+                        help="Slab centre as a fraction of the scanned range from its inferior end (default 0.5, "
+                             "mid-scan; this does not locate L3)")
+    parser.add_argument("--slab-z", "--l3-z", dest="slab_z", type=float,
+                        help="L3 position in mm along the slice normal: centres the slab (overrides --slab-center) "
+                             "and is recorded in l3.json as the slice to score")
+    parser.add_argument("--index", help="DICOM header index database (dicom_index.py) used for planning")
+    parser.add_argument("--storage", choices=STORAGE_MODES, default=NIFTI_STORAGE,
+                        help="gzip (.nii.gz) or raw (uncompressed .nii, faster to read) output")
+    parser.add_argument("--backend", choices=BACKENDS, default="dcm2niix",
+                        help="dcm2niix, or native (in-process pydicom reader, no dcm2niix needed)")
+    args = parser.parse_args()
+
+    final_path = dicom_to_nifti(args.input_folder, args.output_base, args.patient_id,
+                                workers=args.workers, plan=not args.no_plan,
+                                slab_mm=args.slab_mm, slab_center=args.slab_center, slab_z=args.slab_z,
+                                index=args.index, storage=args.storage, backend=args.backend)
+    if final_path is None:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
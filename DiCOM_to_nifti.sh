@@ -1,13 +1,15 @@
 #!/bin/bash
 
-# Usage: ./dicom_to_nifti.sh <input_folder> <output_base> <patient_id>
+# Usage: ./dicom_to_nifti.sh <input_folder> <output_base> <patient_id> [jobs]
+#   jobs: number of series folders converted in parallel (default 1)
 input_base="$1"
 output_base="$2"
 patient_id="$3"
+jobs_max="${4:-1}"
 APPDIR="$(dirname "$0")"
 
 if [ -z "$input_base" ] || [ -z "$output_base" ] || [ -z "$patient_id" ]; then
-    echo "Usage: $0 <input_folder> <output_base> <patient_id>"
+    echo "Usage: $0 <input_folder> <output_base> <patient_id> [jobs]"
     exit 1
 fi
 
@@ -22,13 +24,45 @@ echo "Output: $out_dir"
 echo "Converting for patient: $patient_id"
 echo "------------------------------------"
 
-# Convert all DICOM subfolders into the nifti folder
-find "$input_base" -type d -print0 | while IFS= read -r -d '' folder; do
+# Convert all DICOM subfolders, each into its own temp dir so parallel jobs cannot collide
+series_root="$out_dir/.series"
+mkdir -p "$series_root"
+echo "Parallel jobs: $jobs_max"
+
+i=0
+while IFS= read -r -d '' folder; do
     if [ "$(find "$folder" -maxdepth 1 -type f | wc -l)" -gt 0 ]; then
-        echo "   Processing: $folder"
-        "$APPDIR/dcm2niix" -z y -o "$out_dir" -f "%p_%s" "$folder"
+        i=$((i + 1))
+        tag="series $i"
+        series_dir="$series_root/$(printf '%03d' "$i")"
+        mkdir -p "$series_dir"
+        (
+            echo "   [$tag] Processing: $folder"
+            "$APPDIR/dcm2niix" -z y -o "$series_dir" -f "%p_%s" "$folder" 2>&1 |
+                while IFS= read -r line; do echo "   [$tag] $line"; done
+        ) &
+        # Bounded concurrency (portable to bash 3.2, no wait -n)
+        while [ "$(jobs -rp | wc -l)" -ge "$jobs_max" ]; do
+            sleep 0.2
+        done
     fi
+done < <(find "$input_base" -type d -print0)
+wait
+
+# Gather outputs now that all jobs finished; prefix names that would collide
+for series_dir in "$series_root"/*; do
+    [ -d "$series_dir" ] || continue
+    idx="$(basename "$series_dir")"
+    for f in "$series_dir"/*; do
+        [ -e "$f" ] || continue
+        name="$(basename "$f")"
+        if [ -e "$out_dir/$name" ]; then
+            name="s${idx}_$name"
+        fi
+        mv "$f" "$out_dir/$name"
+    done
 done
+rm -rf "$series_root"
 
 echo "Cleaning up NIfTI files for: $patient_id"
 
@@ -1,32 +1,28 @@
 # ai_explainer.py
 import os
-import pandas as pd
-from huggingface_hub import InferenceClient
-import pypandoc
-import markdown
-from docx import Document
-from docx.shared import Inches
-from binary_utils import get_pandoc_bin
-
-def generate_ai_explanation(patient_folder, api_key=None):
-    """Generate AI explanation for the patient's report.csv and save as DOCX."""
-    report_path = os.path.join(patient_folder, "report.csv")
-    if not os.path.exists(report_path):
-        raise FileNotFoundError(f"No report.csv found in {patient_folder}")
+import json
+import math
+import random
+import time
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-    # Load patient report
-    df = pd.read_csv(report_path)
-    row = df.iloc[0].to_dict()
-    report_summary = "\n".join([f"{k}: {v}" for k, v in row.items()])
+import metrics
+# pandas, huggingface_hub and python-docx are imported where they are used so
+# that importing this module does not slow down app start-up
+
+MODEL = "openai/gpt-oss-120b"
+PROVIDER = "cerebras"
+# Bump when the prompt text changes so cached explanations are not reused
+PROMPT_VERSION = "1"
 
-    # HuggingFace client
-    client = InferenceClient(
-        provider="cerebras",
-        api_key=api_key or os.environ.get("HF_API_TOKEN", "Your_api_key"),
-    )
+# Point at an OpenAI-compatible endpoint (e.g. llm_stub.py) instead of the provider
+LLM_BASE_URL = os.environ.get("SARC_LLM_BASE_URL")
 
-    # Prompt
-    prompt = f"""
+def build_prompt(report_summary):
+    return f"""
     You are the Sarcopenia Detection Assistant — an intelligent medical imaging tool that has just analyzed the patient's CT scan.
     You performed the image conversion, segmentation, and measurement of muscle and fat areas, and calculated the Sarcopenia risk.
 
@@ -42,48 +38,230 @@ def generate_ai_explanation(patient_folder, api_key=None):
     5. End with encouragement, practical lifestyle advice (exercise, diet, follow-up with doctor), and emphasize that these results are an aid for discussion with their healthcare provider.
     """
 
+def prompt_fingerprint():
+    """Hash of the prompt template, prompt version and model: changes whenever the answer would."""
+    payload = json.dumps([PROMPT_VERSION, MODEL, PROVIDER, build_prompt("{report_summary}")])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def is_retryable(exc):
+    """Timeouts, 429 Too Many Requests and 5xx server errors are worth another attempt; nothing else is."""
+    if isinstance(exc, TimeoutError) or any("Timeout" in cls.__name__ for cls in type(exc).__mro__):
+        return True
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status == 429 or (status is not None and 500 <= status < 600)
+
+def read_report_row(patient_folder):
+    """First row of the patient's report.csv as a dict."""
+    report_path = os.path.join(patient_folder, "report.csv")
+    if not os.path.exists(report_path):
+        raise FileNotFoundError(f"No report.csv found in {patient_folder}")
+
+    # Load patient report
+    import pandas as pd
+    df = pd.read_csv(report_path)
+    return df.iloc[0].to_dict()
 
-    completion = client.chat.completions.create(
-        model="openai/gpt-oss-120b",
-        messages=[{"role": "user", "content": prompt}],
-    )
+def _normalize_value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return "NA"
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    return str(value).strip()
 
-    ai_text = completion.choices[0].message["content"]
+def report_cache_key(row):
+    """Hash of the normalized report row and prompt_fingerprint: identical reports share one answer."""
+    normalized = {str(k): _normalize_value(v) for k, v in row.items()}
+    payload = json.dumps([prompt_fingerprint(), sorted(normalized.items())])
+    return hashlib.sha256(payload.encode()).hexdigest()
 
-    html_text = markdown.markdown(ai_text, extensions=["tables", "fenced_code"])
 
-    #print(html_text)
+class ExplanationService:
+    """
+    Asynchronous LLM explanation service.
 
-    # Save to DOCX
-    output_path = os.path.join(patient_folder, "final_output.docx")
+    One InferenceClient (and its pooled HTTP connections) is shared by every
+    request. Calls run on a private event loop thread; the blocking client calls
+    run on an executor of max_concurrency threads, and a slot is only freed
+    when its thread returns, so timed-out calls cannot pile up threads. Each
+    attempt has a timeout; timeouts, 429 and 5xx answers are retried with
+    exponential backoff, other errors fail at once. Answers are
+    cached on disk by report_cache_key, and identical requests already in
+    flight are joined instead of being sent twice.
+    """
 
-    # Convert Markdown (from AI) to DOCX
-    pypandoc.pandoc_path = get_pandoc_bin()
-    pypandoc.convert_text(
-        html_text,                     # input text (Markdown with **bold**)
-        'docx',                      # output format
-        format='html',                 # input format is Markdown
-        outputfile=output_path, 
-        extra_args=['--standalone']  # ensures complete doc structure
-    )
-    # Add overlays
-    overlay_dir = os.path.join(patient_folder, "overlays")
-    if os.path.exists(overlay_dir):
-        add_overlays_to_doc(output_path, overlay_dir)
+    def __init__(self, api_key=None, base_url=LLM_BASE_URL, cache_dir=None,
+                 max_concurrency=4, timeout=120.0, retries=3, backoff=2.0):
+        self.api_key = api_key or os.environ.get("HF_API_TOKEN", "Your_api_key")
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._client = None
+        self._inflight = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm")
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._sem = asyncio.run_coroutine_threadsafe(self._make_semaphore(), self._loop).result()
+        metrics.QUEUE_DEPTH.set_function(lambda: {("llm",): len(self._inflight)}, "llm")
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    async def _make_semaphore(self):
+        return asyncio.Semaphore(self.max_concurrency)
+
+    @property
+    def client(self):
+        if self._client is None:
+            from huggingface_hub import InferenceClient
+            if self.base_url:
+                self._client = InferenceClient(base_url=self.base_url, api_key=self.api_key, timeout=self.timeout)
+            else:
+                self._client = InferenceClient(provider=PROVIDER, api_key=self.api_key, timeout=self.timeout)
+        return self._client
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json") if self.cache_dir else None
+
+    def cached(self, row):
+        """Cached explanation for a report row, or None."""
+        path = self._cache_path(report_cache_key(row))
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                text = json.load(f)["text"]
+            os.utime(path)  # recently used: evicted last by ResultCache.evict
+            return text
+        except (OSError, ValueError, KeyError):
+            return None
 
+    def _store(self, key, text):
+        path = self._cache_path(key)
+        if not path:
+            return
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"prompt_version": PROMPT_VERSION, "model": MODEL, "text": text}, f)
+        os.replace(tmp, path)
+
+    def _complete(self, prompt):
+        completion = self.client.chat.completions.create(
+            model=MODEL,
+            messages=[{"role": "user", "content": prompt}],
+        )
+        return completion.choices[0].message["content"]
+
+    async def _call(self, prompt):
+        """One attempt. The semaphore is released when the executor thread finishes, not on timeout."""
+        await self._sem.acquire()
+        try:
+            future = self._executor.submit(self._complete, prompt)
+        except BaseException:
+            self._sem.release()
+            raise
+        future.add_done_callback(lambda _: self._loop.call_soon_threadsafe(self._sem.release))
+        return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+
+    async def _call_with_retry(self, prompt):
+        delay = self.backoff
+        for attempt in range(1, self.retries + 2):
+            try:
+                return await self._call(prompt)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise RuntimeError(f"LLM request failed: {e}") from e
+                if attempt > self.retries:
+                    raise RuntimeError(f"LLM request failed after {attempt} attempts: {str(e) or type(e).__name__}") from e
+                await asyncio.sleep(delay * (1 + random.random() * 0.25))
+                delay *= 2
+
+    async def explain(self, row):
+        """Explanation text for a report row (coroutine, runs on the service loop)."""
+        key = report_cache_key(row)
+        text = self.cached(row)
+        if text is not None:
+            metrics.CACHE_REQUESTS.inc(cache="llm", result="hit")
+            return text
+        if key in self._inflight:
+            metrics.CACHE_REQUESTS.inc(cache="llm", result="joined")
+            return await asyncio.shield(self._inflight[key])
+        metrics.CACHE_REQUESTS.inc(cache="llm", result="miss")
+
+        report_summary = "\n".join([f"{k}: {v}" for k, v in row.items()])
+        started = time.perf_counter()
+        task = asyncio.ensure_future(self._call_with_retry(build_prompt(report_summary)))
+        self._inflight[key] = task
+        try:
+            text = await task
+        finally:
+            self._inflight.pop(key, None)
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm")
+        self._store(key, text)
+        return text
+
+    def submit(self, row):
+        """Start explaining a report row without blocking; returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(self.explain(row), self._loop)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+def get_service(api_key=None, cache_dir=None):
+    """
+    Process-wide shared ExplanationService (created on first use).
+    Arguments left as None accept the existing service's settings; asking for
+    a different api_key or cache_dir than it was created with raises ValueError.
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = ExplanationService(api_key=api_key, cache_dir=cache_dir)
+            return _service
+        if api_key is not None and api_key != _service.api_key:
+            raise ValueError("The shared ExplanationService was created with a different api_key")
+        if cache_dir is not None and (_service.cache_dir is None
+                                      or os.path.abspath(cache_dir) != os.path.abspath(_service.cache_dir)):
+            raise ValueError(f"The shared ExplanationService was created with cache_dir={_service.cache_dir!r}, "
+                             f"not {cache_dir!r}")
+        return _service
+
+
+def write_explanation_doc(patient_folder, ai_text):
+    """Build final_output.docx from the explanation markdown plus the overlays, in one save."""
+    from docx_report import build_report_docx
+    output_path = os.path.join(patient_folder, "final_output.docx")
+    overlay_dir = os.path.join(patient_folder, "overlays")
+    started = time.perf_counter()
+    build_report_docx(ai_text, output_path, overlay_dir)
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="docx")
+    print(f"✅ Report written to {output_path}")
     return output_path
 
+def generate_ai_explanation(patient_folder, api_key=None, explanation=None, cache_dir=None):
+    """
+    Generate AI explanation for the patient's report.csv and save as DOCX.
+    explanation may be a Future from ExplanationService.submit started earlier.
+    """
+    if explanation is None:
+        explanation = get_service(api_key, cache_dir).submit(read_report_row(patient_folder))
+    ai_text = explanation.result()
+    return write_explanation_doc(patient_folder, ai_text)
+
 def add_overlays_to_doc(docx_path, overlay_dir):
+    """Append overlays to an existing DOCX (reports are now built with them in one pass)."""
+    from docx import Document
+    from docx_report import add_overlays
     doc = Document(docx_path)
-
-    # Add a heading before images
-    doc.add_heading("Segmentation Overlays", level=1)
-
-    # Insert each overlay PNG
-    for img_file in sorted(os.listdir(overlay_dir)):
-        if img_file.endswith(".png"):
-            doc.add_picture(os.path.join(overlay_dir, img_file), width=Inches(4))
-            doc.add_paragraph(img_file)  # caption
+    add_overlays(doc, overlay_dir)
 
     # Save back
     doc.save(docx_path)
@@ -0,0 +1,121 @@
+# benchmarks/import_budget.py
+"""
+Start-up import budget: imports each module in a fresh interpreter with
+-X importtime, compares its cumulative import time with a budget and checks
+that modules which must stay light did not pull in heavy dependencies.
+
+    python benchmarks/import_budget.py            # exit 1 on any violation
+    python benchmarks/import_budget.py --scale 2  # slower machine: double every budget
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded only when the stage that needs them runs
+HEAVY = ("pandas", "numpy", "matplotlib", "pydicom", "nibabel", "huggingface_hub", "docx", "markdown", "PIL")
+
+# module -> (budget in ms for its own import, dependencies it must not import)
+BUDGETS = {
+    "sarc_app": (150, HEAVY),
+    "pipeline": (100, HEAVY),
+    "watch_folder": (120, HEAVY),
+    "job_api": (120, HEAVY),
+    "ai_api": (120, HEAVY),
+    "log_console": (100, HEAVY),
+    "result_cache": (50, HEAVY),
+    "stage_timing": (60, HEAVY),
+    "results_store": (60, HEAVY),
+    "stage_scheduler": (60, HEAVY),
+    "metrics": (40, HEAVY),
+    "nifti_io": (60, HEAVY),
+    "llm_stub": (80, HEAVY),
+    # Stage modules: heavy by nature, budgets catch new or slower dependencies
+    # (nibabel.nifti1 itself imports pydicom when it is installed)
+    "dicom_utils": (600, ("pandas", "matplotlib", "huggingface_hub", "docx")),
+    "dicom_reader": (600, ("pandas", "matplotlib", "huggingface_hub", "docx")),
+    "slice_viewer": (600, ("pandas", "matplotlib", "huggingface_hub", "docx")),
+    "overlay_utils": (600, ("pandas", "matplotlib", "huggingface_hub", "docx")),
+    "body_composition": (1200, ("matplotlib", "huggingface_hub", "docx")),
+    "cohort_store": (1500, ("matplotlib", "pydicom", "nibabel", "huggingface_hub", "docx")),
+    "docx_report": (600, ("pandas", "numpy", "matplotlib", "pydicom", "nibabel", "huggingface_hub")),
+}
+
+_LINE_RE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s?(\s*)(\S+)")
+
+
+def measure(module):
+    """(cumulative import time in ms, modules loaded) for one fresh `import module`."""
+    code = f"import sys, {module}; print('\\n'.join(sys.modules))"
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=REPO_DIR,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}")
+    cumulative = None
+    for line in proc.stderr.splitlines():
+        m = _LINE_RE.match(line)
+        if m and not m.group(3) and m.group(4) == module:
+            cumulative = int(m.group(2)) / 1000.0
+    return cumulative, set(proc.stdout.split())
+
+
+def check(modules, repeat=5, scale=1.0):
+    """Median import time per module against its budget. Returns result rows."""
+    rows = []
+    for module in modules:
+        budget_ms, forbidden = BUDGETS[module]
+        try:
+            runs = [measure(module) for _ in range(repeat)]
+        except RuntimeError as e:
+            rows.append({"module": module, "error": str(e), "ok": False})
+            continue
+        ms = statistics.median(r[0] for r in runs if r[0] is not None)
+        loaded = sorted(m for m in forbidden if m in runs[-1][1])
+        rows.append({
+            "module": module,
+            "import_ms": round(ms, 1),
+            "budget_ms": budget_ms * scale,
+            "heavy_loaded": loaded,
+            "ok": ms <= budget_ms * scale and not loaded,
+        })
+    return rows
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Check per-module import time budgets")
+    parser.add_argument("modules", nargs="*", help=f"Modules to check (default: all {len(BUDGETS)})")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh imports per module (median is used)")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every budget (slow machines, CI)")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    unknown = [m for m in args.modules if m not in BUDGETS]
+    if unknown:
+        print(f"❌ No budget for: {', '.join(unknown)}")
+        sys.exit(2)
+
+    rows = check(args.modules or list(BUDGETS), args.repeat, args.scale)
+    print(f"{'module':<20}{'import ms':>11}{'budget ms':>11}  heavy imports")
+    for r in rows:
+        if "error" in r:
+            print(f"❌ {r['module']:<18}import failed: {r['error']}")
+            continue
+        mark = "✅" if r["ok"] else "❌"
+        print(f"{mark} {r['module']:<18}{r['import_ms']:>11.1f}{r['budget_ms']:>11.0f}  {', '.join(r['heavy_loaded']) or '-'}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+    if not all(r["ok"] for r in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
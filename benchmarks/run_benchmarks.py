@@ -0,0 +1,412 @@
+# benchmarks/run_benchmarks.py
+"""
+Offline benchmark suite: times and memory-profiles each pipeline stage on
+synthetic studies of several sizes. Every (stage, size) case runs in a fresh
+process with the stub executables from stubs.py, so peak RSS is per case and
+no network, GPU or real dcm2niix/model is needed.
+
+    python benchmarks/run_benchmarks.py --sizes small,medium --out bench.json
+    python benchmarks/run_benchmarks.py --out new.json --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import statistics
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import synthetic
+import stubs
+from stage_timing import StageTimer
+
+# series x slices x matrix of the synthetic study per size
+SIZES = {
+    "small": {"series": 1, "slices": 40, "matrix": 128},
+    "medium": {"series": 3, "slices": 120, "matrix": 256},
+    "large": {"series": 4, "slices": 300, "matrix": 512},
+}
+
+SAMPLE_MARKDOWN = """# Your Results
+
+Your **Skeletal Muscle Index** was calculated from the CT scan.
+
+- Muscle area and fat areas were measured.
+- Please discuss these results with your healthcare provider.
+
+| Measure | Value |
+|---|---|
+| SMI | 40.5 |
+"""
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+def prepare_data(data_dir, size):
+    """Generate (once) the DICOM study and patient folder for a size. Returns their paths."""
+    params = SIZES[size]
+    root = os.path.join(data_dir, size)
+    l3_record = os.path.join(root, "patient", "BENCH", "nifti", "l3.json")  # older data lacks it
+    if synthetic.read_manifest(root) != params or not os.path.exists(l3_record):
+        shutil.rmtree(root, ignore_errors=True)
+        os.makedirs(root)
+        print(f"Generating {size} study {params} in {root}", flush=True)
+        synthetic.make_dicom_study(os.path.join(root, "dicom"), params["slices"], params["matrix"], params["series"])
+        synthetic.make_patient_folder(os.path.join(root, "patient", "BENCH"), params["slices"], params["matrix"])
+        synthetic.write_manifest(root, **params)
+    return os.path.join(root, "dicom"), os.path.join(root, "patient", "BENCH")
+
+
+# Each case: setup(dicom_dir, patient_dir, scratch, work_dir) -> (run, reset).
+# run() is timed; reset() (untimed) restores the scratch state between repeats.
+# run() may return a dict; only its RECORD_EXTRAS fields are added to the record
+# (other return values, e.g. the metadata dict, are ignored).
+RECORD_EXTRAS = ("disk_bytes", "cache_hits", "cache_misses")
+
+def _case_metadata(dicom_dir, patient_dir, scratch, work_dir):
+    from dicom_utils import extract_dicom_metadata
+    return (lambda: extract_dicom_metadata(dicom_dir)), _noop
+
+def _case_series_plan(dicom_dir, patient_dir, scratch, work_dir):
+    from DiCOM_to_nifti import plan_series
+    return (lambda: plan_series(dicom_dir, _noop)), _noop
+
+def _disk_bytes(*paths):
+    return sum(os.path.getsize(p) for p in paths)
+
+def _conversion_case(storage, backend="dcm2niix"):
+    def setup(dicom_dir, patient_dir, scratch, work_dir):
+        from DiCOM_to_nifti import dicom_to_nifti
+        from pipeline import CONVERSION_WORKERS
+
+        def run():
+            final_path = dicom_to_nifti(dicom_dir, scratch, "BENCH", log_callback=_noop, workers=CONVERSION_WORKERS,
+                                        storage=storage, backend=backend)
+            if final_path is None:
+                raise RuntimeError("conversion produced no NIfTI (is the dcm2niix stub first on the lookup path?)")
+            return {"disk_bytes": _disk_bytes(final_path)}
+        return run, lambda: shutil.rmtree(os.path.join(scratch, "BENCH"), ignore_errors=True)
+    return setup
+
+def _stored_copy(patient_dir, scratch, storage):
+    """Copy of the patient's CT and labels in a storage mode. Returns (ct_path, seg_path)."""
+    import nibabel as nib
+    from overlay_utils import find_nii
+    from nifti_io import nifti_ext, nifti_stem
+    paths = []
+    for sub in ("nifti", "segmentation"):
+        src = find_nii(os.path.join(patient_dir, sub))
+        dst = os.path.join(scratch, storage, sub, nifti_stem(src) + nifti_ext(storage))
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        nib.save(nib.load(src), dst)
+        paths.append(dst)
+    return paths
+
+def _nifti_load_case(storage):
+    def setup(dicom_dir, patient_dir, scratch, work_dir):
+        import numpy as np
+        from nifti_io import load_nifti
+        ct_path, seg_path = _stored_copy(patient_dir, scratch, storage)
+
+        def run():
+            # What the later stages do: a chunked pass over both volumes, then a few slices
+            ct, seg = load_nifti(ct_path), load_nifti(seg_path)
+            nz = ct.shape[2]
+            for z0 in range(0, nz, 32):
+                np.asarray(ct.dataobj[:, :, z0:z0 + 32], dtype=np.float32)
+                np.asarray(seg.dataobj[:, :, z0:z0 + 32])
+            for z in (nz // 4, nz // 2, 3 * nz // 4):
+                np.asanyarray(ct.dataobj[:, :, z])
+                np.asanyarray(seg.dataobj[:, :, z])
+            return {"disk_bytes": _disk_bytes(ct_path, seg_path)}
+        return run, _noop
+    return setup
+
+def _case_archive_gzip(dicom_dir, patient_dir, scratch, work_dir):
+    from nifti_io import compress_niftis
+    folder = os.path.join(scratch, "raw")
+
+    def reset():
+        shutil.rmtree(folder, ignore_errors=True)
+        _stored_copy(patient_dir, scratch, "raw")
+
+    def run():
+        return {"disk_bytes": _disk_bytes(*compress_niftis(folder))}
+    return run, reset
+
+def _case_segmentation(dicom_dir, patient_dir, scratch, work_dir):
+    cmd = ["python", "predict_muscle_fat.py", "--input", os.path.join(patient_dir, "nifti"),
+           "--output", os.path.join(scratch, "segmentation")]
+    cwd = os.path.join(work_dir, "CT-Muscle-and-Fat-Segmentation")
+    return (lambda: subprocess.run(cmd, cwd=cwd, check=True, stdout=subprocess.DEVNULL)), _noop
+
+def _patient_copy(patient_dir, scratch):
+    dst = os.path.join(scratch, "BENCH")
+    shutil.rmtree(dst, ignore_errors=True)
+    shutil.copytree(patient_dir, dst)
+    return dst
+
+def _case_body_composition(dicom_dir, patient_dir, scratch, work_dir):
+    from body_composition import measure_patient
+    patient = _patient_copy(patient_dir, scratch)
+    return (lambda: measure_patient(patient)), _noop
+
+def _case_scoring(dicom_dir, patient_dir, scratch, work_dir):
+    from body_composition import measure_patient
+    from rule_based_sarcopenia import calculate_sarcopenia
+    patient = _patient_copy(patient_dir, scratch)
+    measure_patient(patient)  # scoring alone, not the in-process measurement
+    return (lambda: calculate_sarcopenia(patient, os.path.join(patient, "report.csv"))), _noop
+
+def _case_cohort_query(dicom_dir, patient_dir, scratch, work_dir, n=100_000):
+    """Group-by over a cohort store of n synthetic patients scored over 90 days (independent of size)."""
+    import numpy as np
+    import pandas as pd
+    from cohort_store import CohortStore, to_table
+    root = os.path.join(scratch, "cohort")
+    shutil.rmtree(root, ignore_errors=True)
+    rng = np.random.default_rng(0)
+    store = CohortStore(root)
+    store.append(to_table(pd.DataFrame({
+        "ID": [f"P{i:06d}" for i in range(n)],
+        "Sex": rng.choice(["M", "F"], n),
+        "Age": rng.integers(20, 90, n),
+        "Height_cm": rng.normal(170, 10, n),
+        "SMI": rng.normal(45, 8, n),
+        "Sarcopenia": rng.choice(["Yes", "No"], n),
+        "ScoredAt": pd.to_datetime(time.time() - rng.uniform(0, 90 * 86400, n), unit="s", utc=True),
+    })), compact=False)
+
+    def run():
+        result = store.query(group_by="Sex", agg={"SMI": ["mean", "median", "count"]}, where=[("Age", ">=", 65)])
+        if result["SMI_count"].sum() == 0:
+            raise RuntimeError("cohort query returned no rows")
+        return {"disk_bytes": sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(root) for f in fs)}
+    return run, _noop
+
+def _overlay_case(renderer):
+    def setup(dicom_dir, patient_dir, scratch, work_dir):
+        from overlay_utils import save_overlay_slices
+        out = os.path.join(scratch, "overlays")
+
+        def run():
+            save_overlay_slices(os.path.join(patient_dir, "nifti"), os.path.join(patient_dir, "segmentation"),
+                                out, num_slices=3, renderer=renderer)
+        return run, lambda: shutil.rmtree(out, ignore_errors=True)
+    return setup
+
+def _case_viewer_scroll(dicom_dir, patient_dir, scratch, work_dir):
+    """Scroll once through the volume and back in the slice viewer (no Tk): misses, then cache hits."""
+    from slice_viewer import SliceStack
+
+    def run():
+        stack = SliceStack(patient_dir)
+        try:
+            for k in list(range(stack.n_slices)) + list(range(stack.n_slices - 1, -1, -1)):
+                stack.get(k)
+            return {"cache_hits": stack.cache.hits, "cache_misses": stack.cache.misses}
+        finally:
+            stack.close()
+    return run, _noop
+
+def _case_report_docx(dicom_dir, patient_dir, scratch, work_dir):
+    from overlay_utils import save_overlay_slices
+    from docx_report import build_report_docx
+    overlays = os.path.join(scratch, "overlays")
+    save_overlay_slices(os.path.join(patient_dir, "nifti"), os.path.join(patient_dir, "segmentation"),
+                        overlays, num_slices=3, renderer="fast")
+    return (lambda: build_report_docx(SAMPLE_MARKDOWN, os.path.join(scratch, "final_output.docx"), overlays)), _noop
+
+def _case_pipeline(dicom_dir, patient_dir, scratch, work_dir):
+    from llm_stub import StubLLMServer
+    server = StubLLMServer(reply=SAMPLE_MARKDOWN).start()
+    os.environ["SARC_LLM_BASE_URL"] = server.url
+    from pipeline import run_patient
+    fields = {"Age": "60", "Weight": "75", "Gender": "M", "Height": "175"}
+    results = os.path.join(scratch, "results")
+
+    def run():
+        status = run_patient(dicom_dir, "BENCH", fields, results_dir=results, log=_noop, use_cache=False)
+        if status.get("state") != "done":
+            raise RuntimeError(f"pipeline failed: {status.get('stages')}")
+    return run, lambda: shutil.rmtree(results, ignore_errors=True)
+
+CASES = {
+    "metadata": _case_metadata,
+    "series_plan": _case_series_plan,
+    "conversion": _conversion_case("gzip"),
+    "conversion_raw": _conversion_case("raw"),
+    "conversion_native": _conversion_case("gzip", "native"),
+    "nifti_load_gzip": _nifti_load_case("gzip"),
+    "nifti_load_raw": _nifti_load_case("raw"),
+    "archive_gzip": _case_archive_gzip,
+    "segmentation": _case_segmentation,
+    "body_composition": _case_body_composition,
+    "scoring": _case_scoring,
+    "overlays_fast": _overlay_case("fast"),
+    "overlays_matplotlib": _overlay_case("matplotlib"),
+    "report_docx": _case_report_docx,
+    "viewer_scroll": _case_viewer_scroll,
+    "cohort_query": _case_cohort_query,
+    "pipeline": _case_pipeline,
+}
+
+
+def run_case(stage, size, data_dir, work_dir, repeat):
+    """Run one case in this process (called in a fresh worker process). Returns its record."""
+    from overlay_utils import peak_rss_mb
+    dicom_dir, patient_dir = prepare_data(data_dir, size)
+    os.chdir(work_dir)
+    scratch = tempfile.mkdtemp(prefix=f"{stage}_", dir=work_dir)
+    try:
+        run, reset = CASES[stage](dicom_dir, patient_dir, scratch, work_dir)
+        baseline_rss = peak_rss_mb()
+        timings, extra = [], None
+        for _ in range(repeat):
+            reset()
+            with StageTimer(stage, scope="process") as timer:  # one case per worker process
+                extra = run()
+            timings.append(timer.record)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    wall = [t["wall_s"] for t in timings]
+    children = [t.get("children", {}) for t in timings]
+    extra = {k: extra[k] for k in RECORD_EXTRAS if k in extra} if isinstance(extra, dict) else {}
+    return dict(extra, **{
+        "stage": stage,
+        "size": size,
+        "params": SIZES[size],
+        "repeat": repeat,
+        "wall_s": wall,
+        "median_s": round(statistics.median(wall), 4),
+        "min_s": round(min(wall), 4),
+        "cpu_s": round(statistics.median(t["cpu_s"] for t in timings), 4),
+        "children_cpu_s": round(statistics.median(c.get("user_s", 0) + c.get("sys_s", 0) for c in children), 4),
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "children_peak_rss_mb": max((c.get("peak_rss_mb", 0) for c in children), default=None),
+    })
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def environment():
+    import numpy
+    return {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": numpy.__version__,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print current vs baseline median time and peak RSS per case. Returns the regressed cases."""
+    base = {(r["stage"], r["size"]): r for r in baseline.get("results", [])}
+    regressions = []
+    print(f"\n{'stage':<22}{'size':<8}{'base s':>9}{'now s':>9}{'ratio':>8}{'base MB':>9}{'now MB':>9}")
+    for r in results:
+        b = base.get((r["stage"], r["size"]))
+        if not b or "error" in r or "error" in b:
+            continue
+        ratio = r["median_s"] / b["median_s"] if b["median_s"] else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  ⚠️ slower"
+            regressions.append(r)
+        print(f"{r['stage']:<22}{r['size']:<8}{b['median_s']:>9.3f}{r['median_s']:>9.3f}{ratio:>8.2f}"
+              f"{b.get('peak_rss_mb') or 0:>9.0f}{r.get('peak_rss_mb') or 0:>9.0f}{flag}")
+    return regressions
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmarks on synthetic data")
+    parser.add_argument("--sizes", default="small,medium", help=f"Comma-separated, from {', '.join(SIZES)}")
+    parser.add_argument("--stages", default=",".join(CASES), help="Comma-separated stages to run")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case (median is reported)")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "sarc_bench", "data"),
+                        help="Where synthetic studies are generated (reused across runs)")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "sarc_bench", "work"),
+                        help="Bundle-like folder holding the stub executables")
+    parser.add_argument("--out", default="benchmark_results.json", help="Results JSON")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed slowdown before flagging (0.15 = 15%%)")
+    parser.add_argument("--case", nargs=2, metavar=("STAGE", "SIZE"), help=argparse.SUPPRESS)
+    parser.add_argument("--case-out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    data_dir = os.path.abspath(args.data_dir)
+    work_dir = os.path.abspath(args.work_dir)
+
+    if args.case:  # worker process: one case, result to --case-out
+        record = run_case(args.case[0], args.case[1], data_dir, work_dir, args.repeat)
+        with open(args.case_out, "w") as f:
+            json.dump(record, f)
+        return
+
+    sizes = [s for s in args.sizes.split(",") if s]
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = [s for s in sizes if s not in SIZES] + [s for s in stages if s not in CASES]
+    if unknown:
+        print(f"❌ Unknown size/stage: {', '.join(unknown)}")
+        sys.exit(2)
+
+    stubs.make_workdir(work_dir)
+    for size in sizes:
+        prepare_data(data_dir, size)
+
+    results = []
+    for size in sizes:
+        for stage in stages:
+            case_out = os.path.join(work_dir, f".case_{stage}_{size}.json")
+            cmd = [sys.executable, os.path.abspath(__file__), "--case", stage, size, "--repeat", str(args.repeat),
+                   "--data-dir", data_dir, "--work-dir", work_dir, "--case-out", case_out]
+            proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            if proc.returncode != 0:
+                error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}"
+                print(f"❌ {stage:<22}{size:<8}{error}", flush=True)
+                results.append({"stage": stage, "size": size, "params": SIZES[size], "error": error})
+                continue
+            with open(case_out) as f:
+                record = json.load(f)
+            os.remove(case_out)
+            results.append(record)
+            disk = f"{record['disk_bytes'] / 1024 ** 2:>9.1f} MB on disk" if "disk_bytes" in record else ""
+            print(f"✅ {stage:<22}{size:<8}{record['median_s']:>9.3f} s{record['peak_rss_mb'] or 0:>8.0f} MB{disk}",
+                  flush=True)
+
+    report = {"meta": environment(), "results": results}
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\n✅ Results written to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n⚠️ {len(regressions)} case(s) slower than the baseline by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# benchmarks/stubs.py
+"""
+Stand-ins for the external executables, laid out like the app bundle so the
+normal lookups find them: binary_utils._resolve_binary checks the working
+directory for dcm2niix, and pipeline.resource_path resolves the repo scripts
+and CT-Muscle-and-Fat-Segmentation/ relative to it.
+"""
+import os
+import sys
+import stat
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DCM2NIIX_STUB = r'''#!{python}
+"""Offline dcm2niix stand-in: -z y|n -o OUT -f FORMAT FOLDER -> <ProtocolName>_<SeriesNumber>.nii[.gz] + .json"""
+import os, sys, json, glob
+import numpy as np
+import nibabel as nib
+import pydicom
+
+args = sys.argv[1:]
+opts = dict(zip(args[:-1:2], args[1:-1:2]))
+folder, out_dir = args[-1], opts["-o"]
+files = sorted(p for p in glob.glob(os.path.join(folder, "*")) if os.path.isfile(p))
+print(f"Chris Rorden's dcm2niiX stub: {{len(files)}} files in {{folder}}", flush=True)
+dss = [pydicom.dcmread(p) for p in files]
+if not dss:
+    sys.exit(1)
+normal = np.cross(*np.reshape(np.asarray(dss[0].ImageOrientationPatient, float), (2, 3)))
+dss.sort(key=lambda d: float(np.dot(normal, np.asarray(d.ImagePositionPatient, float))))
+# dcm2niix layout: i along the columns, j along the rows stored bottom-up, RAS affine from the headers
+vol = np.stack([(d.pixel_array * float(d.RescaleSlope) + float(d.RescaleIntercept)).astype(np.int16)[::-1].T
+                for d in dss], axis=2)
+x, y = np.reshape(np.asarray(dss[0].ImageOrientationPatient, float), (2, 3))
+dr, dc = (float(v) for v in dss[0].PixelSpacing)
+ipp0, ipp1 = (np.asarray(d.ImagePositionPatient, float) for d in (dss[0], dss[-1]))
+lps = np.eye(4)
+lps[:3, 0], lps[:3, 1] = x * dc, -y * dr
+lps[:3, 2] = (ipp1 - ipp0) / (len(dss) - 1) if len(dss) > 1 else normal * float(dss[0].SliceThickness or 1.0)
+lps[:3, 3] = ipp0 + y * dr * (vol.shape[1] - 1)
+name = f"{{dss[0].get('ProtocolName', 'series')}}_{{dss[0].get('SeriesNumber', 1)}}".replace(" ", "_")
+ext = ".nii" if opts.get("-z") == "n" else ".nii.gz"
+nib.save(nib.Nifti1Image(vol, np.diag([-1.0, -1.0, 1.0, 1.0]) @ lps), os.path.join(out_dir, name + ext))
+with open(os.path.join(out_dir, name + ".json"), "w") as f:
+    json.dump({{"SeriesDescription": str(dss[0].get("SeriesDescription", "")),
+               "ConvolutionKernel": str(dss[0].get("ConvolutionKernel", ""))}}, f)
+print(f"Convert {{len(dss)}} DICOM as {{name}} ({{vol.shape}})", flush=True)
+'''
+
+SEGMENTATION_STUB = r'''#!{python}
+"""Offline predict_muscle_fat.py stand-in: HU-threshold labels via seg_worker.StubModel."""
+import os, sys, argparse
+sys.path.insert(0, {repo!r})
+import numpy as np
+import nibabel as nib
+from overlay_utils import find_nii
+from seg_worker import StubModel, BATCH_SLICES
+from nifti_io import load_nifti, nifti_stem
+from body_composition import measure_patient
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", required=True)
+parser.add_argument("--output", required=True)
+args, _ = parser.parse_known_args()
+
+ct_path = find_nii(args.input)
+img = load_nifti(ct_path)
+labels = np.zeros(img.shape[:3], dtype=np.uint8)
+model = StubModel()
+for z0 in range(0, labels.shape[2], BATCH_SLICES):
+    chunk = np.asarray(img.dataobj[:, :, z0:z0 + BATCH_SLICES], dtype=np.float32)
+    labels[:, :, z0:z0 + chunk.shape[2]] = np.moveaxis(model.predict(np.moveaxis(chunk, 2, 0)), 0, 2)
+    print(f"Segmenting: {{100 * min(labels.shape[2], z0 + BATCH_SLICES) // labels.shape[2]}}%", flush=True)
+os.makedirs(args.output, exist_ok=True)
+ext = ".nii" if ct_path.endswith(".nii") else ".nii.gz"
+nib.save(nib.Nifti1Image(labels, img.affine), os.path.join(args.output, f"{{nifti_stem(ct_path)}}_seg{{ext}}"))
+# Like --body_composition_type 2D, measure the L3 slice (the phantom's middle slice)
+measure_patient(os.path.dirname(os.path.abspath(args.output)), slice_index=labels.shape[2] // 2)
+print("Segmentation done", flush=True)
+'''
+
+
+def _write_executable(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+def make_workdir(work_dir):
+    """
+    Populate work_dir with the stub dcm2niix, the stub segmentation script and
+    symlinks to the repo's scripts. Run benchmarks with work_dir as the cwd.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    _write_executable(os.path.join(work_dir, "dcm2niix"), DCM2NIIX_STUB.format(python=sys.executable))
+
+    seg_dir = os.path.join(work_dir, "CT-Muscle-and-Fat-Segmentation")
+    os.makedirs(seg_dir, exist_ok=True)
+    _write_executable(os.path.join(seg_dir, "predict_muscle_fat.py"),
+                      SEGMENTATION_STUB.format(python=sys.executable, repo=REPO_DIR))
+
+    for name in os.listdir(REPO_DIR):
+        if name.endswith((".py", ".sh")):
+            link = os.path.join(work_dir, name)
+            if not os.path.lexists(link):
+                os.symlink(os.path.join(REPO_DIR, name), link)
+    return work_dir
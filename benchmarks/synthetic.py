@@ -0,0 +1,174 @@
+# benchmarks/synthetic.py
+"""Synthetic CT studies (DICOM series, NIfTI volumes, label volumes) for offline benchmarks."""
+import os
+import csv
+import json
+
+import numpy as np
+import nibabel as nib
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+# Tissue HU values and the labels body_composition.LABELS uses for them
+AIR, FAT, MUSCLE, ORGAN, BONE = -1000, -100, 45, 35, 700
+LABEL_MUSCLE, LABEL_SFAT, LABEL_VFAT = 1, 2, 3
+
+# Series written per study, best first; extra series reuse the last entry
+SERIES_LAYOUT = [
+    {"SeriesDescription": "ABD 5mm L3", "ConvolutionKernel": "B30f", "thickness": 5.0, "step": 1},
+    {"SeriesDescription": "ABD 1mm BONE", "ConvolutionKernel": "B70f", "thickness": 1.0, "step": 1},
+    {"SeriesDescription": "Topogram", "ConvolutionKernel": "T20f", "thickness": 0.6, "step": 0},
+    {"SeriesDescription": "ABD 3mm", "ConvolutionKernel": "B31f", "thickness": 3.0, "step": 1},
+]
+
+
+def phantom_slice(matrix, z_frac=0.5, noise=8.0, rng=None):
+    """
+    One axial slice (int16 HU, [rows, cols]) and its labels: air around an
+    elliptical body with a subcutaneous fat rim, a muscle ring, visceral fat,
+    organs and a vertebra. z_frac (0..1) varies the body size along the scan.
+    """
+    rng = rng or np.random.default_rng(0)
+    y, x = np.mgrid[0:matrix, 0:matrix].astype(np.float32)
+    cx = cy = (matrix - 1) / 2.0
+    scale = 0.9 + 0.1 * np.sin(np.pi * z_frac)
+    ax, ay = 0.42 * matrix * scale, 0.32 * matrix * scale
+    r = np.sqrt(((x - cx) / ax) ** 2 + ((y - cy) / ay) ** 2)
+
+    hu = np.full((matrix, matrix), AIR, dtype=np.float32)
+    labels = np.zeros((matrix, matrix), dtype=np.uint8)
+    body = r <= 1.0
+    hu[body], labels[body] = FAT, LABEL_SFAT
+    muscle = r <= 0.85
+    hu[muscle], labels[muscle] = MUSCLE, LABEL_MUSCLE
+    inner = r <= 0.7
+    hu[inner], labels[inner] = FAT, LABEL_VFAT
+    organs = (r <= 0.55) & (np.sin(x / 6.0) * np.cos(y / 7.0) > 0)
+    hu[organs], labels[organs] = ORGAN, 0
+    spine = ((x - cx) / (0.08 * matrix)) ** 2 + ((y - cy - 0.18 * matrix) / (0.07 * matrix)) ** 2 <= 1.0
+    hu[spine], labels[spine] = BONE, 0
+
+    hu[body] += rng.normal(0.0, noise, size=int(body.sum())).astype(np.float32)
+    return np.round(hu).astype(np.int16), labels
+
+
+def phantom_volume(matrix, n_slices, seed=0):
+    """[X, Y, Z] int16 HU volume and uint8 label volume in NIfTI (column, row, slice) order."""
+    rng = np.random.default_rng(seed)
+    hu = np.empty((matrix, matrix, n_slices), dtype=np.int16)
+    labels = np.empty((matrix, matrix, n_slices), dtype=np.uint8)
+    for k in range(n_slices):
+        s_hu, s_lab = phantom_slice(matrix, k / max(1, n_slices - 1), rng=rng)
+        hu[:, :, k] = s_hu.T
+        labels[:, :, k] = s_lab.T
+    return hu, labels
+
+
+def _ct_dataset(study, series, k, n_slices, matrix, spacing, pixels):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = CT_IMAGE_STORAGE
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study["uid"]
+    ds.SeriesInstanceUID = series["uid"]
+    ds.Modality = "CT"
+    ds.PatientName = study["patient"]
+    ds.PatientID = study["patient"]
+    ds.PatientSex = study["sex"]
+    ds.PatientAge = study["age"]
+    ds.PatientWeight = study["weight"]
+    ds.TableHeight = "160.0"
+    ds.SeriesNumber = series["number"]
+    ds.SeriesDescription = series["SeriesDescription"]
+    ds.ProtocolName = series["SeriesDescription"]
+    ds.ConvolutionKernel = series["ConvolutionKernel"]
+    ds.InstanceNumber = k + 1
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.ImagePositionPatient = [-matrix * spacing / 2, -matrix * spacing / 2, -k * series["thickness"]]
+    ds.SliceThickness = series["thickness"]
+    ds.PixelSpacing = [spacing, spacing]
+    ds.Rows = ds.Columns = matrix
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.RescaleIntercept = "0"
+    ds.RescaleSlope = "1"
+    ds.PixelData = pixels.tobytes()
+    return ds
+
+
+def make_dicom_study(out_dir, n_slices=40, matrix=128, n_series=1, spacing=0.8, seed=0, patient="BENCH"):
+    """
+    Write a synthetic CT study (n_series series of n_slices, matrix x matrix) as one
+    folder per series under out_dir. Returns the list of series folders.
+    """
+    rng = np.random.default_rng(seed)
+    study = {"uid": generate_uid(), "patient": patient, "sex": "M", "age": "060Y", "weight": "75"}
+    slices = [phantom_slice(matrix, k / max(1, n_slices - 1), rng=rng)[0] for k in range(n_slices)]
+
+    folders = []
+    for s in range(n_series):
+        layout = dict(SERIES_LAYOUT[min(s, len(SERIES_LAYOUT) - 1)])
+        layout.update(uid=generate_uid(), number=s + 1)
+        count = 2 if layout["step"] == 0 else n_slices  # scouts are tiny
+        folder = os.path.join(out_dir, f"series_{s + 1:02d}")
+        os.makedirs(folder, exist_ok=True)
+        for k in range(count):
+            ds = _ct_dataset(study, layout, k, count, matrix, spacing, slices[k])
+            ds.save_as(os.path.join(folder, f"IM{k + 1:05d}.dcm"), enforce_file_format=True)
+        folders.append(folder)
+    return folders
+
+
+def make_nifti_pair(ct_dir, seg_dir, n_slices=40, matrix=128, spacing=0.8, thickness=5.0, seed=0):
+    """Write a CT NIfTI and its label NIfTI (same grid). Returns (ct_path, seg_path)."""
+    hu, labels = phantom_volume(matrix, n_slices, seed)
+    affine = np.diag([-spacing, -spacing, thickness, 1.0])
+    os.makedirs(ct_dir, exist_ok=True)
+    os.makedirs(seg_dir, exist_ok=True)
+    ct_path = os.path.join(ct_dir, "BENCH_L3.nii.gz")
+    seg_path = os.path.join(seg_dir, "BENCH_L3_seg.nii.gz")
+    nib.save(nib.Nifti1Image(hu, affine), ct_path)
+    nib.save(nib.Nifti1Image(labels, affine), seg_path)
+    return ct_path, seg_path
+
+
+def make_patient_folder(patient_folder, n_slices=40, matrix=128, seed=0):
+    """
+    A results/<patient> folder as left by conversion and segmentation:
+    nifti/ with the L3 record (the phantom's middle slice), segmentation/ with
+    the label NIfTI and metadata.csv.
+    """
+    make_nifti_pair(os.path.join(patient_folder, "nifti"), os.path.join(patient_folder, "segmentation"),
+                    n_slices=n_slices, matrix=matrix, seed=seed)
+    with open(os.path.join(patient_folder, "nifti", "l3.json"), "w") as f:
+        json.dump({"slice_index": n_slices // 2}, f)
+    row = {"ID": os.path.basename(patient_folder), "Age": 60, "Weight": 75, "Gender": "M", "Height": 175,
+           "PatientSex": "M", "PatientAge": 60, "TableHeight": 160}
+    with open(os.path.join(patient_folder, "segmentation", "metadata.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=row.keys())
+        writer.writeheader()
+        writer.writerow(row)
+    return patient_folder
+
+
+def write_manifest(folder, **params):
+    with open(os.path.join(folder, "synthetic.json"), "w") as f:
+        json.dump(params, f, indent=2)
+
+def read_manifest(folder):
+    try:
+        with open(os.path.join(folder, "synthetic.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
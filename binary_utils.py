@@ -33,7 +33,4 @@ def get_totalseg_bin():
     return _resolve_binary("TotalSegmentator", "TotalSegmentator.exe")
 
 def get_dcm2niix_bin():
-    return _resolve_binary("dcm2niix", "dcm2niix.exe")
-
-def get_pandoc_bin():
-    return _resolve_binary("pandoc", "pandoc.exe")
\ No newline at end of file
+    return _resolve_binary("dcm2niix", "dcm2niix.exe")
\ No newline at end of file
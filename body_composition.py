@@ -0,0 +1,161 @@
+# body_composition.py
+import os
+import sys
+import json
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from overlay_utils import find_nii
+from nifti_io import load_nifti
+
+# Segmentation label value -> tissue name used in column names
+LABELS = {
+    1: "muscle",
+    2: "sfat",   # subcutaneous fat
+    3: "vfat",   # visceral fat
+    4: "mfat",   # intermuscular fat (IMAT)
+}
+
+# Slices per chunk: bounds the temporary key/weight arrays, the pass itself stays vectorized
+CHUNK_SLICES = 32
+
+# Where the L3 level of a patient's CT is recorded, relative to the patient folder:
+# {"z_mm": position} (written by conversion when the patient's L3_z / --slab-z is
+# given) or {"slice_index": k}. Without it there is no slice to measure in-process.
+L3_RECORD = os.path.join("nifti", "l3.json")
+
+
+def measure_volume(ct_img, seg_img, labels=None, chunk_slices=CHUNK_SLICES):
+    """
+    Per-slice, per-label area (mm²) and HU mean/std from a CT and its label volume.
+
+    Voxels are binned with np.bincount over (label, slice) keys, so each chunk of
+    slices is one array pass instead of a Python loop per slice. Both images are
+    read through their array proxies a chunk at a time, never as whole float volumes.
+
+    Returns a DataFrame with one row per axial slice.
+    """
+    labels = LABELS if labels is None else labels
+    nx, ny, nz = seg_img.shape[:3]
+    sx, sy = (float(z) for z in seg_img.header.get_zooms()[:2])
+    n_bins = (max(labels) + 1) * nz
+
+    counts = np.zeros(n_bins, dtype=np.int64)
+    hu_sum = np.zeros(n_bins, dtype=np.float64)
+    hu_sq = np.zeros(n_bins, dtype=np.float64)
+    max_label = max(labels)
+
+    for z0 in range(0, nz, chunk_slices):
+        z1 = min(nz, z0 + chunk_slices)
+        seg = np.asarray(seg_img.dataobj[:, :, z0:z1]).astype(np.intp, copy=False)
+        ct = np.asarray(ct_img.dataobj[:, :, z0:z1], dtype=np.float64)
+
+        keep = (seg > 0) & (seg <= max_label)
+        lab = seg[keep]
+        zz = np.broadcast_to(np.arange(z0, z1, dtype=np.intp), seg.shape)[keep]
+        key = lab * nz + zz
+        hu = ct[keep]
+        counts += np.bincount(key, minlength=n_bins)
+        hu_sum += np.bincount(key, weights=hu, minlength=n_bins)
+        hu_sq += np.bincount(key, weights=hu * hu, minlength=n_bins)
+
+    counts = counts.reshape(-1, nz)
+    hu_sum = hu_sum.reshape(-1, nz)
+    hu_sq = hu_sq.reshape(-1, nz)
+
+    z_mm = nib.affines.apply_affine(seg_img.affine, np.c_[np.zeros(nz), np.zeros(nz), np.arange(nz)])[:, 2]
+    profile = pd.DataFrame({"slice": np.arange(nz), "z_mm": np.round(z_mm, 3)})
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for value, name in labels.items():
+            n = counts[value]
+            mean = hu_sum[value] / n
+            var = np.maximum(hu_sq[value] / n - mean * mean, 0.0)
+            profile[f"{name}_area_mm2"] = np.round(n * sx * sy, 2)
+            profile[f"{name}_hu_mean"] = np.where(n > 0, mean, np.nan)
+            profile[f"{name}_hu_std"] = np.where(n > 0, np.sqrt(var), np.nan)
+    return profile
+
+
+def summarize_slice(profile, slice_index):
+    """One body_composition_2d.csv style row for a single slice of the profile."""
+    row = profile.iloc[[slice_index]].reset_index(drop=True)
+    return row.rename(columns={"slice": "slice_index"})
+
+
+def recorded_l3_slice(patient_folder, profile):
+    """
+    Index of the L3 slice from the patient's L3 record: its slice_index, or
+    the slice nearest z_mm (which must lie within the volume). None without a record.
+    """
+    try:
+        with open(os.path.join(patient_folder, L3_RECORD)) as f:
+            record = json.load(f)
+    except FileNotFoundError:
+        return None
+    if "slice_index" in record:
+        k = int(record["slice_index"])
+        if not 0 <= k < len(profile):
+            raise ValueError(f"Recorded L3 slice {k} is outside the volume (0-{len(profile) - 1})")
+        return k
+    z = float(record["z_mm"])
+    z_mm = profile["z_mm"].to_numpy()
+    k = int(np.abs(z_mm - z).argmin())
+    spacing = float(np.median(np.abs(np.diff(z_mm)))) if len(z_mm) > 1 else 0.0
+    if abs(z_mm[k] - z) > max(spacing, 1e-3):
+        raise ValueError(f"Recorded L3 position {z} mm is outside the volume ({z_mm.min()} to {z_mm.max()} mm)")
+    return k
+
+
+def measure_patient(patient_folder, slice_index=None, labels=None):
+    """
+    Measure a patient folder's nifti/ CT and segmentation/ labels in-process and
+    write segmentation/body_composition_profile.csv (all slices) and
+    segmentation/body_composition_2d.csv (the L3 slice), the file scoring reads.
+    The L3 slice is slice_index, else the one in the L3 record; with neither,
+    ValueError is raised rather than scoring some other level.
+    Returns the one-row summary DataFrame, or None if the volumes are missing.
+    """
+    ct_path = find_nii(os.path.join(patient_folder, "nifti"))
+    seg_path = find_nii(os.path.join(patient_folder, "segmentation"))
+    if not ct_path or not seg_path:
+        print(f"Missing CT or segmentation NIfTI in {patient_folder}")
+        return None
+
+    ct_img = load_nifti(ct_path)
+    seg_img = load_nifti(seg_path)
+    if ct_img.shape[:3] != seg_img.shape[:3]:
+        raise ValueError(f"CT {ct_img.shape} and segmentation {seg_img.shape} shapes differ")
+
+    profile = measure_volume(ct_img, seg_img, labels=labels)
+    seg_dir = os.path.join(patient_folder, "segmentation")
+    profile.to_csv(os.path.join(seg_dir, "body_composition_profile.csv"), index=False)
+
+    if slice_index is None:
+        slice_index = recorded_l3_slice(patient_folder, profile)
+    if slice_index is None:
+        raise ValueError(f"No L3 slice known for {patient_folder}: give the patient's L3 position "
+                         f"(L3_z, recorded in {L3_RECORD} by conversion) or pass the slice index")
+    summary = summarize_slice(profile, slice_index)
+    summary.to_csv(os.path.join(seg_dir, "body_composition_2d.csv"), index=False)
+    print(f"✅ Measured {len(profile)} slices from {seg_path}")
+    return summary
+
+
+def main():
+    """CLI entrypoint"""
+    if len(sys.argv) < 2:
+        print("❌ Usage: python body_composition.py <patient_folder> [L3 slice_index]")
+        sys.exit(1)
+
+    slice_index = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    try:
+        summary = measure_patient(sys.argv[1], slice_index)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    if summary is None:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
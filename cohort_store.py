@@ -0,0 +1,367 @@
+# cohort_store.py
+import os
+import re
+import sys
+import time
+import uuid
+import datetime
+import argparse
+import threading
+
+# rule_based_sarcopenia.py puts an empty stand-in "pyarrow" module in sys.modules
+# so that pandas never loads it; this module needs the real one
+if "pyarrow" in sys.modules and getattr(sys.modules["pyarrow"], "__file__", None) is None:
+    del sys.modules["pyarrow"]
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from result_cache import PIPELINE_VERSION, STAGE_VERSIONS
+
+# Cohort store location; default <results>/.cohort (ignored by the results index)
+COHORT_DIR = os.environ.get("SARC_COHORT_DIR")
+COHORT_NAME = ".cohort"
+
+# A date partition holding more files than this is compacted after an append
+COMPACT_FILES = int(os.environ.get("SARC_COHORT_COMPACT_FILES", "64"))
+
+# One row per scored patient run. Report columns keep their report.csv names,
+# DICOM acquisition tags their keyword; the partition column "date" is the scoring date (UTC).
+SCHEMA = pa.schema([
+    ("ID", pa.string()),
+    ("PatientName", pa.string()),
+    ("Sex", pa.string()),
+    ("Age", pa.float32()),
+    ("Height_cm", pa.float32()),
+    ("Weight_kg", pa.float32()),
+    ("SMI", pa.float32()),
+    ("SMI_cutoff", pa.float32()),
+    ("Sarcopenia", pa.string()),
+    ("MuscleArea_mm2", pa.float32()),
+    ("VfatArea_mm2", pa.float32()),
+    ("SfatArea_mm2", pa.float32()),
+    ("MfatArea_mm2", pa.float32()),
+    ("MuscleHU_mean", pa.float32()),
+    ("MuscleHU_std", pa.float32()),
+    ("IMAT_HU_mean", pa.float32()),
+    ("IMAT_HU_std", pa.float32()),
+    ("StudyInstanceUID", pa.string()),
+    ("SeriesInstanceUID", pa.string()),
+    ("SliceThickness", pa.float32()),
+    ("PixelSpacing_mm", pa.float32()),
+    ("ConvolutionKernel", pa.string()),
+    ("ContrastBolusAgent", pa.string()),
+    ("PipelineVersion", pa.string()),
+    ("SegmentationVersion", pa.string()),
+    ("ScoringVersion", pa.string()),
+    ("ScoredAt", pa.timestamp("ms", tz="UTC")),
+])
+PARTITIONING = ds.partitioning(pa.schema([("date", pa.date32())]), flavor="hive")
+
+AGGREGATES = ("count", "mean", "median", "min", "max", "std", "sum")
+_OPS = {"==": "__eq__", "!=": "__ne__", ">=": "__ge__", "<=": "__le__", ">": "__gt__", "<": "__lt__"}
+_NUMBER_RE = r"(-?\d+(?:\.\d+)?)"
+
+
+def _number(series):
+    """First number in each value: "060Y" -> 60, "[0.8, 0.8]" -> 0.8, "NA" -> NaN."""
+    numbers = pd.to_numeric(series, errors="coerce")
+    text = numbers.isna() & series.notna()
+    if text.any():
+        numbers[text] = pd.to_numeric(series[text].astype(str).str.extract(_NUMBER_RE)[0], errors="coerce")
+    return numbers
+
+def _column(df, name):
+    return df[name] if name in df.columns else pd.Series(np.nan, index=df.index)
+
+def _text(series):
+    text = series.astype(str)
+    return text.where(series.notna() & ~text.isin(["", "NA", "nan"]), None)
+
+def to_table(frame, scored_at=None):
+    """
+    Typed cohort rows (SCHEMA) from a frame with report.csv columns plus the
+    metadata.csv tags of each patient.
+    """
+    if not isinstance(scored_at, pd.Timestamp):
+        scored_at = pd.Timestamp(time.time() if scored_at is None else scored_at, unit="s", tz="UTC")
+    out = {}
+    for field in SCHEMA:
+        name = field.name
+        if name == "ScoredAt":
+            stamps = pd.Series(scored_at, index=frame.index) if "ScoredAt" not in frame.columns \
+                else pd.to_datetime(frame["ScoredAt"], utc=True)
+            out[name] = stamps.dt.floor("ms")
+        elif name == "PipelineVersion":
+            out[name] = _column(frame, name).fillna(PIPELINE_VERSION)
+        elif name == "SegmentationVersion":
+            out[name] = _column(frame, name).fillna(STAGE_VERSIONS["segmentation"])
+        elif name == "ScoringVersion":
+            out[name] = _column(frame, name).fillna(STAGE_VERSIONS["scoring"])
+        elif name == "PixelSpacing_mm":
+            out[name] = _number(_column(frame, "PixelSpacing_mm") if "PixelSpacing_mm" in frame.columns
+                                else _column(frame, "PixelSpacing"))
+        elif pa.types.is_floating(field.type):
+            out[name] = _number(_column(frame, name))
+        else:
+            out[name] = _text(_column(frame, name))
+    return pa.Table.from_pandas(pd.DataFrame(out), schema=SCHEMA, preserve_index=False)
+
+def patient_record(patient_folder):
+    """
+    One patient's report.csv joined with the acquisition tags of its
+    segmentation/metadata.csv, as a frame (None if the patient was not scored).
+    """
+    report_path = os.path.join(patient_folder, "report.csv")
+    if not os.path.exists(report_path):
+        return None
+    report = pd.read_csv(report_path, dtype=str, keep_default_na=False)
+    if report.empty:
+        return None
+    row = report.iloc[[0]].reset_index(drop=True)
+    metadata_path = os.path.join(patient_folder, "segmentation", "metadata.csv")
+    if os.path.exists(metadata_path):
+        meta = pd.read_csv(metadata_path, dtype=str, keep_default_na=False)
+        if not meta.empty:
+            for tag in ("StudyInstanceUID", "SeriesInstanceUID", "SliceThickness", "PixelSpacing",
+                        "ConvolutionKernel", "ContrastBolusAgent"):
+                if tag in meta.columns:
+                    row[tag] = meta[tag].iloc[0]
+    return row
+
+
+class CohortStore:
+    """
+    Append-only columnar store of every scored patient: Parquet files under
+    date=YYYY-MM-DD/ partitions, one file per append. compact() merges a
+    partition's small files into one so queries open few files; query() reads
+    only the partitions and columns it needs.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def for_results(cls, results_dir):
+        """The store used by the pipeline for a results folder (SARC_COHORT_DIR overrides it)."""
+        return cls(COHORT_DIR or os.path.join(results_dir, COHORT_NAME))
+
+    def _partition_dir(self, day):
+        return os.path.join(self.root, f"date={day.isoformat()}")
+
+    def _files(self, partition):
+        return sorted(os.path.join(partition, f) for f in os.listdir(partition)
+                      if f.endswith(".parquet") and not f.startswith("."))
+
+    def append(self, table, compact=True):
+        """Write rows (SCHEMA table or frame) as new files, one per scoring date. Returns the row count."""
+        if isinstance(table, pd.DataFrame):
+            table = to_table(table)
+        if table.num_rows == 0:
+            return 0
+        days = pc.cast(pc.cast(table["ScoredAt"], pa.timestamp("ms")), pa.date32())
+        for day in pc.unique(days).to_pylist():
+            part = table.filter(pc.equal(days, pa.scalar(day, pa.date32())))
+            partition = self._partition_dir(day)
+            os.makedirs(partition, exist_ok=True)
+            name = f"part-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+            tmp = os.path.join(partition, "." + name + ".tmp")
+            pq.write_table(part, tmp, compression="zstd")
+            os.replace(tmp, os.path.join(partition, name))
+            if compact and len(self._files(partition)) > COMPACT_FILES:
+                self._compact_partition(partition)
+        return table.num_rows
+
+    def append_patient(self, patient_folder, scored_at=None):
+        """Append a patient folder's scored report. Returns False when it has no report.csv."""
+        record = patient_record(patient_folder)
+        if record is None:
+            return False
+        self.append(to_table(record, scored_at))
+        return True
+
+    def backfill(self, results_dir, workers=16):
+        """Append every scored patient under results_dir in one write (for folders scored before the store existed)."""
+        from concurrent.futures import ThreadPoolExecutor
+        folders = [os.path.join(results_dir, d) for d in sorted(os.listdir(results_dir))
+                   if not d.startswith(".") and os.path.isdir(os.path.join(results_dir, d))]
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            pairs = [(f, r) for f, r in zip(folders, pool.map(patient_record, folders)) if r is not None]
+        if not pairs:
+            return 0
+        tables = [to_table(r, os.path.getmtime(os.path.join(f, "report.csv"))) for f, r in pairs]
+        return self.append(pa.concat_tables(tables))
+
+    def _compact_partition(self, partition):
+        with self._lock:
+            lock = os.path.join(partition, ".compacting")
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if time.time() - os.path.getmtime(lock) < 600:
+                    return 0  # another process is compacting this partition
+                os.remove(lock)
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.close(fd)
+            try:
+                files = self._files(partition)
+                if len(files) < 2:
+                    return 0
+                table = pa.concat_tables([pq.read_table(f, schema=SCHEMA) for f in files])
+                table = table.sort_by("ScoredAt")
+                name = f"compact-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+                tmp = os.path.join(partition, "." + name + ".tmp")
+                pq.write_table(table, tmp, compression="zstd", row_group_size=128 * 1024)
+                os.replace(tmp, os.path.join(partition, name))
+                for f in files:
+                    os.remove(f)
+                return len(files)
+            finally:
+                os.remove(lock)
+
+    def compact(self):
+        """Merge the files of every date partition into one per partition. Returns the files merged."""
+        return sum(self._compact_partition(os.path.join(self.root, d)) for d in sorted(os.listdir(self.root))
+                   if d.startswith("date=") and os.path.isdir(os.path.join(self.root, d)))
+
+    def dataset(self):
+        return ds.dataset(self.root, schema=SCHEMA.append(pa.field("date", pa.date32())), format="parquet",
+                          partitioning=PARTITIONING)
+
+    def query(self, columns=None, where=(), since=None, until=None, group_by=None, agg=None, latest=True):
+        """
+        Cohort rows as a frame, reading only the needed columns and date partitions.
+          columns  - columns to return (default all)
+          where    - [(column, op, value)] filters, op one of == != >= <= > < in
+          since/until - scoring date range (inclusive), date or "YYYY-MM-DD"
+          group_by, agg - e.g. "Sex", {"SMI": ["mean", "count"]} -> one row per group
+          latest   - keep only the most recent row of each patient ID (re-runs append new rows)
+        """
+        date_expr = _all(_date_filters(since, until))
+        value_expr = _all([_filter(c, op, v) for c, op, v in where])
+        group_cols = [group_by] if isinstance(group_by, str) else list(group_by or [])
+        wanted = list(columns or ([] if agg else [f.name for f in SCHEMA] + ["date"]))
+        needed = list(dict.fromkeys(wanted + group_cols + list(agg or {}) +
+                                    (["ID", "ScoredAt"] + [c for c, _, _ in where] if latest else [])))
+
+        if not latest:
+            df = self.dataset().to_table(columns=needed, filter=_all([date_expr, value_expr])).to_pandas()
+        else:
+            # Superseded runs must not match the filters: keep each patient's latest
+            # run first (only the date range is pushed down), then filter the values
+            table = self.dataset().to_table(columns=needed, filter=date_expr)
+            if table.num_rows:
+                newest = table.group_by("ID").aggregate([("ScoredAt", "max")])
+                newest = newest.select(["ID", "ScoredAt_max"]).rename_columns(["ID", "ScoredAt"])
+                table = table.join(newest, ["ID", "ScoredAt"], join_type="inner")
+            if value_expr is not None:
+                table = table.filter(value_expr)
+            df = table.to_pandas()
+            if len(df):  # runs of one patient with the same timestamp
+                df = df.sort_values("ScoredAt", kind="stable").drop_duplicates("ID", keep="last")
+        if agg:
+            result = df.groupby(group_cols, observed=True).agg(agg) if group_cols else df.agg(agg)
+            if isinstance(result.columns, pd.MultiIndex):
+                result.columns = [f"{c}_{fn}" for c, fn in result.columns]
+            return result.reset_index() if group_cols else result
+        return df[wanted].reset_index(drop=True)
+
+
+def _all(terms):
+    """AND of the filter expressions, None when there are none."""
+    terms = [t for t in terms if t is not None]
+    expr = terms[0] if terms else None
+    for term in terms[1:]:
+        expr = expr & term
+    return expr
+
+def _as_date(value):
+    return value if isinstance(value, datetime.date) else datetime.date.fromisoformat(str(value))
+
+def _date_filters(since, until):
+    terms = []
+    if since is not None:
+        terms.append(ds.field("date") >= pa.scalar(_as_date(since), pa.date32()))
+    if until is not None:
+        terms.append(ds.field("date") <= pa.scalar(_as_date(until), pa.date32()))
+    return terms
+
+def _filter(column, op, value):
+    field = ds.field(column)
+    if op == "in":
+        return field.isin(list(value))
+    if op not in _OPS:
+        raise ValueError(f"Unknown operator: {op}")
+    return getattr(field, _OPS[op])(value)
+
+def parse_where(text):
+    """ "Age>=65" -> ("Age", ">=", 65.0); values that are not numbers stay strings."""
+    match = re.match(r"\s*(\w+)\s*(==|!=|>=|<=|>|<)\s*(.+?)\s*$", text)
+    if not match:
+        raise ValueError(f"Cannot parse filter: {text}")
+    column, op, value = match.groups()
+    try:
+        value = float(value)
+    except ValueError:
+        value = value.strip("'\"")
+    return column, op, value
+
+def parse_agg(text):
+    """ "SMI:mean,SMI:count,Age:median" -> {"SMI": ["mean", "count"], "Age": ["median"]}"""
+    agg = {}
+    for item in filter(None, (s.strip() for s in text.split(","))):
+        column, _, fn = item.partition(":")
+        if fn not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate {fn!r}, use one of {', '.join(AGGREGATES)}")
+        agg.setdefault(column, []).append(fn)
+    return agg
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Cohort store: query every scored patient")
+    parser.add_argument("results_dir", help="Results folder (the store is <results>/.cohort or $SARC_COHORT_DIR)")
+    parser.add_argument("--backfill", action="store_true", help="Append every scored patient folder first")
+    parser.add_argument("--compact", action="store_true", help="Merge each date partition into one file")
+    parser.add_argument("--since", help="First scoring date, YYYY-MM-DD")
+    parser.add_argument("--until", help="Last scoring date, YYYY-MM-DD")
+    parser.add_argument("--where", action="append", default=[], help='Filter such as "Sex==F" or "Age>=65" (repeatable)')
+    parser.add_argument("--columns", help="Comma-separated columns to output")
+    parser.add_argument("--group-by", help="Comma-separated grouping columns")
+    parser.add_argument("--agg", help='Aggregates such as "SMI:mean,SMI:count"')
+    parser.add_argument("--all-runs", action="store_true", help="Keep every run of a patient, not only the latest")
+    parser.add_argument("--out", help="Write the result to this CSV instead of printing it")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.results_dir):
+        print(f"❌ Not a folder: {args.results_dir}")
+        sys.exit(1)
+    store = CohortStore.for_results(args.results_dir)
+    if args.backfill:
+        print(f"✅ Appended {store.backfill(args.results_dir)} patient(s)")
+    if args.compact:
+        print(f"✅ Merged {store.compact()} file(s)")
+
+    started = time.perf_counter()
+    result = store.query(columns=args.columns.split(",") if args.columns else None,
+                         where=[parse_where(w) for w in args.where], since=args.since, until=args.until,
+                         group_by=args.group_by.split(",") if args.group_by else None,
+                         agg=parse_agg(args.agg) if args.agg else None, latest=not args.all_runs)
+    elapsed = time.perf_counter() - started
+    if args.out:
+        result.to_csv(args.out, index=not isinstance(result.index, pd.RangeIndex))
+        print(f"✅ {len(result)} row(s) written to {args.out} in {elapsed:.3f} s")
+    else:
+        with pd.option_context("display.max_rows", 50, "display.width", 160):
+            print(result)
+        print(f"   {len(result)} row(s) in {elapsed:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+# dicom_index.py
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+from dicom_utils import DICOM_TAGS, SERIES_TAGS, parse_patient_age, slice_position
+
+# Every tag the pipeline reads from a header: metadata.csv fields plus series grouping fields
+INDEX_TAGS = list(dict.fromkeys(list(DICOM_TAGS) + SERIES_TAGS))
+
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    is_dicom INTEGER NOT NULL,
+    study_uid TEXT,
+    series_uid TEXT,
+    series_description TEXT,
+    series_number TEXT,
+    modality TEXT,
+    image_type TEXT,
+    kernel TEXT,
+    slice_thickness REAL,
+    instance INTEGER,
+    position REAL,
+    header TEXT
+);
+CREATE INDEX IF NOT EXISTS files_series ON files(series_uid);
+CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _text(value):
+    """Header value as it ends up in metadata.csv ("NA" when missing)."""
+    return "NA" if value is None else str(value)
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def read_header(path):
+    """
+    Read the indexed tags of one file (no pixel data). Returns the row values
+    for the files table; is_dicom is 0 for files pydicom cannot read or that
+    carry no SeriesInstanceUID, so they are not retried on the next scan.
+    """
+    try:
+        dcm = pydicom.dcmread(path, stop_before_pixels=True, force=True, specific_tags=INDEX_TAGS)
+        uid = getattr(dcm, "SeriesInstanceUID", None)
+    except Exception:
+        uid, dcm = None, None
+    if not uid:
+        return {"is_dicom": 0}
+
+    header = {tag: _text(getattr(dcm, tag, None)) for tag in INDEX_TAGS}
+    instance = getattr(dcm, "InstanceNumber", None)
+    try:
+        instance = int(instance) if instance is not None else None
+    except (TypeError, ValueError):
+        instance = None
+    try:
+        position = slice_position(dcm)
+    except (TypeError, ValueError):
+        position = None
+    return {
+        "is_dicom": 1,
+        "study_uid": header["StudyInstanceUID"],
+        "series_uid": str(uid),
+        "series_description": header["SeriesDescription"],
+        "series_number": header["SeriesNumber"],
+        "modality": header["Modality"],
+        "image_type": header["ImageType"],
+        "kernel": header["ConvolutionKernel"],
+        "slice_thickness": _float(getattr(dcm, "SliceThickness", None)),
+        "instance": instance,
+        "position": position,
+        "header": json.dumps(header),
+    }
+
+
+class DicomIndex:
+    """
+    SQLite index of DICOM headers keyed on path, size and mtime.
+
+    scan() walks a folder and reads (in parallel, header only) just the files
+    that are new or changed since the last scan; metadata(), group_series()
+    and series() then answer from the index instead of crawling the folder.
+    Safe to share between processes (WAL journal, one write transaction per scan).
+    """
+
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(_SCHEMA)
+            row = conn.execute("SELECT value FROM info WHERE key = 'schema'").fetchone()
+            if row is None or int(row[0]) != SCHEMA_VERSION:
+                conn.execute("DELETE FROM files")
+                conn.execute("INSERT OR REPLACE INTO info VALUES ('schema', ?)", (str(SCHEMA_VERSION),))
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @staticmethod
+    def _prefix_range(folder):
+        # Every path under folder sorts between these bounds (folder + sep, folder + next char)
+        base = os.path.abspath(folder).rstrip(os.sep) + os.sep
+        return base, base[:-1] + chr(ord(os.sep) + 1)
+
+    def _walk(self, folder):
+        """{path: (size, mtime_ns)} of every non-hidden file under folder."""
+        found = {}
+        stack = [os.path.abspath(folder)]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith("."):  # skip hidden files like .DS_Store
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        found[entry.path] = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+        return found
+
+    def scan(self, folder, workers=8):
+        """
+        Bring the index up to date for folder: read headers of new or changed files,
+        drop files that disappeared. Returns counts of files seen/read/removed.
+        """
+        start = time.perf_counter()
+        on_disk = self._walk(folder)
+        lo, hi = self._prefix_range(folder)
+        conn = self._conn()
+        known = {row["path"]: (row["size"], row["mtime_ns"])
+                 for row in conn.execute("SELECT path, size, mtime_ns FROM files WHERE path >= ? AND path < ?", (lo, hi))}
+
+        changed = [p for p, stat in on_disk.items() if known.get(p) != stat]
+        removed = [p for p in known if p not in on_disk]
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            headers = list(pool.map(read_header, changed))
+
+        columns = ["path", "size", "mtime_ns", "is_dicom", "study_uid", "series_uid", "series_description",
+                   "series_number", "modality", "image_type", "kernel", "slice_thickness", "instance",
+                   "position", "header"]
+        rows = []
+        for path, header in zip(changed, headers):
+            size, mtime_ns = on_disk[path]
+            values = dict(header, path=path, size=size, mtime_ns=mtime_ns)
+            rows.append(tuple(values.get(c) for c in columns))
+        with conn:
+            conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in removed])
+            conn.executemany(f"INSERT OR REPLACE INTO files ({', '.join(columns)}) "
+                             f"VALUES ({', '.join('?' * len(columns))})", rows)
+        return {"files": len(on_disk), "read": len(changed), "removed": len(removed),
+                "seconds": round(time.perf_counter() - start, 3)}
+
+    def file_stats(self, folder):
+        """{path: (size, mtime_ns)} of every indexed file under folder, as of the last scan."""
+        lo, hi = self._prefix_range(folder)
+        return {row["path"]: (row["size"], row["mtime_ns"]) for row in self._conn().execute(
+            "SELECT path, size, mtime_ns FROM files WHERE path >= ? AND path < ?", (lo, hi))}
+
+    def metadata(self, folder):
+        """
+        extract_dicom_metadata from the index: DICOM_TAGS of the first DICOM file
+        (in path order) under folder, PatientAge parsed to years. {} if none.
+        """
+        lo, hi = self._prefix_range(folder)
+        row = self._conn().execute(
+            "SELECT header FROM files WHERE is_dicom = 1 AND path >= ? AND path < ? ORDER BY path LIMIT 1",
+            (lo, hi)).fetchone()
+        if row is None:
+            return {}
+        header = json.loads(row["header"])
+        metadata = {tag: header.get(tag, "NA") for tag in DICOM_TAGS}
+        metadata["PatientAge"] = parse_patient_age(metadata["PatientAge"])  # normalize age
+        return metadata
+
+    def group_series(self, folder):
+        """Same result as dicom_utils.group_series(folder), answered from the index."""
+        lo, hi = self._prefix_range(folder)
+        series = {}
+        for row in self._conn().execute(
+                "SELECT path, series_uid, instance, position, header FROM files "
+                "WHERE is_dicom = 1 AND path >= ? AND path < ? ORDER BY series_uid, path", (lo, hi)):
+            entry = series.get(row["series_uid"])
+            if entry is None:
+                header = json.loads(row["header"])
+                entry = {tag: header.get(tag, "NA") for tag in SERIES_TAGS}
+                entry["SeriesInstanceUID"] = row["series_uid"]
+                entry.update(files=[], positions=[], instances=[])
+                series[row["series_uid"]] = entry
+            entry["files"].append(row["path"])
+            entry["positions"].append(row["position"])
+            entry["instances"].append(row["instance"])
+        return list(series.values())
+
+    def series(self, folder=None, description=None):
+        """
+        One summary row per series (optionally only under folder and/or whose
+        SeriesDescription matches the regex description, e.g. r"\\bL3\\b").
+        """
+        sql = ("SELECT series_uid, study_uid, series_number, series_description, modality, kernel, "
+               "slice_thickness, COUNT(*) AS slices, MIN(position) AS z_min, MAX(position) AS z_max, "
+               "MIN(path) AS first_file FROM files WHERE is_dicom = 1")
+        params = []
+        if folder:
+            sql += " AND path >= ? AND path < ?"
+            params += self._prefix_range(folder)
+        if description:
+            sql += " AND series_description REGEXP ?"
+            params.append(description)
+        sql += " GROUP BY series_uid ORDER BY first_file"
+        conn = self._conn()
+        conn.create_function("REGEXP", 2, _regexp, deterministic=True)
+        return [dict(row) for row in conn.execute(sql, params)]
+
+
+def _regexp(pattern, value):
+    import re
+    return value is not None and re.search(pattern, value, re.IGNORECASE) is not None
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Index DICOM headers of an archive into SQLite")
+    parser.add_argument("folder", help="Archive (or study) folder to scan")
+    parser.add_argument("--db", default=os.environ.get("SARC_DICOM_INDEX", "dicom_index.sqlite"),
+                        help="Index database (default: $SARC_DICOM_INDEX or ./dicom_index.sqlite)")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel header readers")
+    parser.add_argument("--series", action="store_true", help="List the indexed series after scanning")
+    parser.add_argument("--match", help="With --series, only descriptions matching this regex (e.g. L3)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        print(f"❌ Not a folder: {args.folder}")
+        sys.exit(1)
+    index = DicomIndex(args.db)
+    stats = index.scan(args.folder, workers=args.workers)
+    print(f"✅ Indexed {args.folder}: {stats['files']} files, {stats['read']} (re)read, "
+          f"{stats['removed']} removed in {stats['seconds']} s")
+    if args.series:
+        for s in index.series(args.folder, args.match):
+            print(f"   series {s['series_number']}: \"{s['series_description']}\" {s['slices']} slices, "
+                  f"thickness {s['slice_thickness']}, kernel {s['kernel']}")
+
+
+if __name__ == "__main__":
+    main()
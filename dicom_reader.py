@@ -0,0 +1,134 @@
+# dicom_reader.py
+import os
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pydicom
+
+from dicom_utils import slice_position
+from nifti_io import NIFTI_STORAGE, STORAGE_MODES, nifti_ext
+
+# int16 range every CT volume is clipped to (dcm2niix writes CT as int16 too)
+_INT16 = np.iinfo(np.int16)
+
+
+def _read_position(path):
+    """(slice position along the normal, InstanceNumber) from a header-only read."""
+    dcm = pydicom.dcmread(path, stop_before_pixels=True, force=True,
+                          specific_tags=["ImagePositionPatient", "ImageOrientationPatient", "InstanceNumber"])
+    return slice_position(dcm), int(getattr(dcm, "InstanceNumber", 0) or 0)
+
+def sort_slices(files, positions=None, workers=8):
+    """
+    files ordered by position along the slice normal (from ImagePositionPatient),
+    falling back to InstanceNumber where positions are missing. positions may come
+    from group_series / the header index so no header is read twice.
+    """
+    if positions is None or any(p is None for p in positions):
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            keys = list(pool.map(_read_position, files))
+        if any(p is None for p, _ in keys):
+            return [f for _, f in sorted(zip([k[1] for k in keys], files))]
+        positions = [p for p, _ in keys]
+    return [f for _, f in sorted(zip(positions, files), key=lambda pair: pair[0])]
+
+
+def _rescale_into(volume, k, dcm):
+    """Decode one slice, apply RescaleSlope/Intercept and store it as volume[:, :, k] (int16)."""
+    pixels = dcm.pixel_array
+    slope = float(getattr(dcm, "RescaleSlope", 1) or 1)
+    intercept = float(getattr(dcm, "RescaleIntercept", 0) or 0)
+    if slope == 1 and intercept.is_integer():
+        hu = np.add(pixels, int(intercept), dtype=np.int32)
+    else:
+        hu = np.rint(pixels * np.float32(slope) + np.float32(intercept))
+    np.clip(hu, _INT16.min, _INT16.max, out=hu)
+    # DICOM rows run top to bottom; like dcm2niix, store them bottom-up (i = column, j = flipped row)
+    volume[:, :, k] = hu[::-1].T
+
+def series_affine(first, last, n_slices, rows):
+    """
+    NIfTI (RAS) affine of a sorted series from its first and last slice headers,
+    following dcm2niix: i along the columns, j along the rows flipped bottom-up,
+    k from the first to the last ImagePositionPatient.
+    """
+    iop = np.asarray(first.ImageOrientationPatient, dtype=float)
+    x, y = iop[:3], iop[3:]
+    row_spacing, col_spacing = (float(v) for v in first.PixelSpacing)
+    origin = np.asarray(first.ImagePositionPatient, dtype=float)
+    if n_slices > 1:
+        step = (np.asarray(last.ImagePositionPatient, dtype=float) - origin) / (n_slices - 1)
+    else:
+        step = np.cross(x, y) * float(getattr(first, "SliceThickness", 1) or 1)
+
+    lps = np.eye(4)
+    lps[:3, 0] = x * col_spacing
+    lps[:3, 1] = -y * row_spacing
+    lps[:3, 2] = step
+    lps[:3, 3] = origin + y * row_spacing * (rows - 1)
+    return np.diag([-1.0, -1.0, 1.0, 1.0]) @ lps  # DICOM LPS -> NIfTI RAS
+
+
+def read_series(files, positions=None, workers=8):
+    """
+    Decode one series in-process: pixel data is read with pydicom on a thread
+    pool, each slice is rescaled to HU straight into a preallocated int16
+    volume (Fortran order, as nibabel writes it) at its sorted position.
+    Returns (volume [columns, rows, slices], affine).
+    """
+    ordered = sort_slices(files, positions, workers)
+    if not ordered:
+        raise ValueError("No slices to read")
+    first = pydicom.dcmread(ordered[0], stop_before_pixels=True, force=True)
+    last = pydicom.dcmread(ordered[-1], stop_before_pixels=True, force=True)
+    rows, cols = int(first.Rows), int(first.Columns)
+    volume = np.empty((cols, rows, len(ordered)), dtype=np.int16, order="F")
+
+    def read(k):
+        dcm = pydicom.dcmread(ordered[k], force=True)
+        if (int(dcm.Rows), int(dcm.Columns)) != (rows, cols):
+            raise ValueError(f"{ordered[k]} is {dcm.Rows}x{dcm.Columns}, series is {rows}x{cols}")
+        _rescale_into(volume, k, dcm)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(read, range(len(ordered))))
+    return volume, series_affine(first, last, len(ordered), rows)
+
+def to_nifti(volume, affine):
+    """In-memory Nifti1Image of a volume, with scanner-space qform/sform in mm like dcm2niix."""
+    import nibabel as nib
+    img = nib.Nifti1Image(volume, affine)
+    img.header.set_xyzt_units("mm", "sec")
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    return img
+
+def read_series_image(files, positions=None, workers=8):
+    """read_series as a Nifti1Image (nothing is written to disk)."""
+    return to_nifti(*read_series(files, positions, workers))
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Read one DICOM series into a NIfTI without dcm2niix")
+    parser.add_argument("series_folder", help="Folder holding the files of a single series")
+    parser.add_argument("output", help="Output path without extension")
+    parser.add_argument("--workers", type=int, default=8, help="Slices decoded in parallel")
+    parser.add_argument("--storage", choices=STORAGE_MODES, default=NIFTI_STORAGE, help="gzip or raw output")
+    args = parser.parse_args()
+
+    files = sorted(os.path.join(args.series_folder, f) for f in os.listdir(args.series_folder)
+                   if not f.startswith("."))
+    if not files:
+        print(f"❌ No files in {args.series_folder}")
+        sys.exit(1)
+    img = read_series_image(files, workers=args.workers)
+    path = args.output + nifti_ext(args.storage)
+    img.to_filename(path)
+    print(f"✅ {len(files)} slices -> {path} {img.shape}, zooms {tuple(round(float(z), 3) for z in img.header.get_zooms())}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import os
+import pydicom
+from concurrent.futures import ThreadPoolExecutor
+
+DICOM_TAGS = {
+    "SOPInstanceUID": "NA",
+    "SeriesInstanceUID": "NA",
+    "StudyInstanceUID": "NA",
+    "InstanceNumber": "NA",
+    "ImagePositionPatient": "NA",
+    "Rows": "NA",
+    "Columns": "NA",
+    "PixelSpacing": "NA",
+    "RescaleIntercept": "NA",
+    "RescaleSlope": "NA",
+    "SliceThickness": "NA",
+    "ConvolutionKernel": "NA",
+    "ContrastBolusAgent": "NA",
+    "PatientSex": "NA",
+    "PatientAge": "NA",
+    "TableHeight": "NA"
+}
+
+def parse_patient_age(age_str):
+    """Convert PatientAge (e.g., '042Y', '055M') into years as float."""
+    if not age_str or age_str == "NA":
+        return None
+    try:
+        num = int(age_str[:3])
+        unit = age_str[-1].upper()
+        if unit == "Y":  # years
+            return num
+        elif unit == "M":  # months
+            return round(num / 12, 2)
+        elif unit == "W":  # weeks
+            return round(num / 52, 2)
+        elif unit == "D":  # days
+            return round(num / 365, 2)
+        else:
+            return num  # fallback
+    except Exception:
+        return None
+
+def extract_dicom_metadata(dicom_folder):
+    """Extract metadata from the first valid DICOM file found (recursively)."""
+    first_file = None
+
+    # Walk through all subdirectories to find the first valid dicom
+    for root, _, files in os.walk(dicom_folder):
+        for f in files:
+            if f.startswith("."):  # skip hidden files like .DS_Store
+                continue
+            file_path = os.path.join(root, f)
+            try:
+                dcm = pydicom.dcmread(file_path, stop_before_pixels=True, force=True)
+                first_file = file_path
+                break
+            except Exception:
+                continue
+        if first_file:
+            break
+
+    if not first_file:
+        print("No valid DICOM files found.")
+        return {}
+
+    try:
+        dcm = pydicom.dcmread(first_file, stop_before_pixels=True, force=True)
+
+        metadata = {}
+        for tag in DICOM_TAGS.keys():
+            value = getattr(dcm, tag, "NA")
+            if tag == "PatientAge":
+                value = parse_patient_age(value)  # normalize age
+            metadata[tag] = value
+
+        return metadata
+
+    except Exception as e:
+        print(f"Could not read DICOM metadata from {first_file}: {e}")
+        return {}
+
+# Header fields needed to group files into series and rank them before conversion
+SERIES_TAGS = [
+    "SeriesInstanceUID",
+    "SeriesDescription",
+    "SeriesNumber",
+    "Modality",
+    "ImageType",
+    "InstanceNumber",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "SliceThickness",
+    "ConvolutionKernel",
+    "Rows",
+    "Columns",
+]
+
+def _read_series_header(file_path):
+    try:
+        dcm = pydicom.dcmread(file_path, stop_before_pixels=True, force=True, specific_tags=SERIES_TAGS)
+    except Exception:
+        return None
+    uid = getattr(dcm, "SeriesInstanceUID", None)
+    if not uid:
+        return None  # not an image DICOM (or not DICOM at all)
+    return file_path, dcm
+
+def slice_position(dcm):
+    """
+    Position (mm) of a slice along its normal, from ImagePositionPatient and
+    ImageOrientationPatient (plain z if orientation is missing). None if unknown.
+    """
+    ipp = getattr(dcm, "ImagePositionPatient", None)
+    if ipp is None or len(ipp) != 3:
+        return None
+    iop = getattr(dcm, "ImageOrientationPatient", None)
+    if iop is None or len(iop) != 6:
+        return float(ipp[2])
+    r, c = [float(v) for v in iop[:3]], [float(v) for v in iop[3:]]
+    normal = (r[1] * c[2] - r[2] * c[1], r[2] * c[0] - r[0] * c[2], r[0] * c[1] - r[1] * c[0])
+    return sum(float(p) * n for p, n in zip(ipp, normal))
+
+def group_series(dicom_folder, workers=8):
+    """
+    Read only the headers of every file under dicom_folder and group them by
+    SeriesInstanceUID. Returns one dict per series with its files, their slice
+    positions (see slice_position) and instance numbers, and the header values
+    of its first file.
+    """
+    paths = []
+    for root, _, files in os.walk(dicom_folder):
+        for f in files:
+            if f.startswith("."):  # skip hidden files like .DS_Store
+                continue
+            paths.append(os.path.join(root, f))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        headers = [h for h in pool.map(_read_series_header, paths) if h]
+
+    series = {}
+    for file_path, dcm in headers:
+        uid = str(dcm.SeriesInstanceUID)
+        entry = series.get(uid)
+        if entry is None:
+            entry = {tag: getattr(dcm, tag, "NA") for tag in SERIES_TAGS}
+            entry["SeriesInstanceUID"] = uid
+            entry["files"] = []
+            series[uid] = entry
+        instance = getattr(dcm, "InstanceNumber", None)
+        entry["files"].append((file_path, slice_position(dcm), int(instance) if instance is not None else None))
+
+    for entry in series.values():
+        entry["files"].sort()
+        entry["positions"] = [pos for _, pos, _ in entry["files"]]
+        entry["instances"] = [inst for _, _, inst in entry["files"]]
+        entry["files"] = [path for path, _, _ in entry["files"]]
+    return list(series.values())
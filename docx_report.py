@@ -0,0 +1,207 @@
+# docx_report.py
+import io
+import os
+from html.parser import HTMLParser
+
+import markdown
+from PIL import Image
+from docx import Document
+from docx.shared import Inches, Pt
+
+# Overlays are embedded at this resolution and width; larger PNGs are downscaled
+REPORT_IMAGE_DPI = int(os.environ.get("SARC_REPORT_DPI", 150))
+REPORT_IMAGE_WIDTH_IN = 4.0
+
+MONOSPACE_FONT = "Courier New"
+_HEADINGS = {f"h{i}": i for i in range(1, 7)}
+
+
+class _MarkdownDocxBuilder(HTMLParser):
+    """
+    Appends the HTML produced by markdown.markdown to a python-docx Document:
+    headings, paragraphs, bold/italic/code runs, nested bullet and numbered
+    lists, blockquotes, code blocks and tables.
+    """
+
+    def __init__(self, doc):
+        super().__init__(convert_charrefs=True)
+        self.doc = doc
+        self.paragraph = None
+        self.bold = 0
+        self.italic = 0
+        self.code = 0
+        self.pre = False
+        self.quote = 0
+        self.lists = []     # "ul"/"ol" per nesting level
+        self.table = None   # rows of cells, each cell a list of (text, bold, italic, code)
+        self.cell = None
+
+    # -- paragraphs -------------------------------------------------------
+    def _new_paragraph(self, style=None):
+        self.paragraph = self.doc.add_paragraph(style=style)
+        return self.paragraph
+
+    def _list_style(self):
+        base = "List Bullet" if self.lists[-1] == "ul" else "List Number"
+        depth = min(len(self.lists), 3)
+        return base if depth == 1 else f"{base} {depth}"
+
+    def _add_text(self, text):
+        if self.cell is not None:
+            self.cell.append((text, self.bold > 0, self.italic > 0, self.code > 0))
+            return
+        if self.paragraph is None:
+            if not text.strip():
+                return  # whitespace between block elements
+            self._new_paragraph("Quote" if self.quote else None)
+        run = self.paragraph.add_run(text)
+        run.bold = self.bold > 0 or None
+        run.italic = self.italic > 0 or None
+        if self.code or self.pre:
+            run.font.name = MONOSPACE_FONT
+            run.font.size = Pt(9)
+
+    # -- HTMLParser hooks -------------------------------------------------
+    def handle_starttag(self, tag, attrs):
+        if tag in _HEADINGS:
+            self.paragraph = self.doc.add_heading(level=_HEADINGS[tag])
+        elif tag == "p":
+            if self.lists and self.paragraph is not None:
+                return  # loose list item: keep text in the item's paragraph
+            self._new_paragraph("Quote" if self.quote else None)
+        elif tag in ("ul", "ol"):
+            self.lists.append(tag)
+            self.paragraph = None
+        elif tag == "li":
+            self._new_paragraph(self._list_style())
+        elif tag in ("strong", "b"):
+            self.bold += 1
+        elif tag in ("em", "i"):
+            self.italic += 1
+        elif tag == "code":
+            self.code += 1
+        elif tag == "pre":
+            self.pre = True
+            self._new_paragraph()
+        elif tag == "blockquote":
+            self.quote += 1
+            self.paragraph = None
+        elif tag == "br":
+            if self.cell is not None:
+                self.cell.append(("\n", False, False, False))
+            elif self.paragraph is not None:
+                self.paragraph.add_run().add_break()
+        elif tag == "hr":
+            self.paragraph = None
+            self.doc.add_paragraph()
+        elif tag == "table":
+            self.table = []
+            self.paragraph = None
+        elif tag == "tr" and self.table is not None:
+            self.table.append([])
+        elif tag in ("td", "th") and self.table is not None:
+            self.cell = []
+            self.table[-1].append((tag == "th", self.cell))
+
+    def handle_endtag(self, tag):
+        if tag in _HEADINGS or tag in ("p", "li", "pre"):
+            if tag == "pre":
+                self.pre = False
+            if not (tag == "p" and self.lists):
+                self.paragraph = None
+        elif tag in ("ul", "ol"):
+            if self.lists:
+                self.lists.pop()
+            self.paragraph = None
+        elif tag in ("strong", "b"):
+            self.bold = max(0, self.bold - 1)
+        elif tag in ("em", "i"):
+            self.italic = max(0, self.italic - 1)
+        elif tag == "code":
+            self.code = max(0, self.code - 1)
+        elif tag == "blockquote":
+            self.quote = max(0, self.quote - 1)
+            self.paragraph = None
+        elif tag in ("td", "th"):
+            self.cell = None
+        elif tag == "table" and self.table is not None:
+            self._flush_table()
+
+    def handle_data(self, data):
+        if not self.pre:
+            data = " ".join(data.split("\n"))
+        self._add_text(data)
+
+    def _flush_table(self):
+        rows = [r for r in self.table if r]
+        self.table = None
+        if not rows:
+            return
+        n_cols = max(len(r) for r in rows)
+        table = self.doc.add_table(rows=len(rows), cols=n_cols)
+        table.style = "Table Grid"
+        for r, row in enumerate(rows):
+            for c, (header, runs) in enumerate(row):
+                paragraph = table.cell(r, c).paragraphs[0]
+                for text, bold, italic, code in runs:
+                    if text == "\n":
+                        paragraph.add_run().add_break()
+                        continue
+                    run = paragraph.add_run(text)
+                    run.bold = (bold or header) or None
+                    run.italic = italic or None
+                    if code:
+                        run.font.name = MONOSPACE_FONT
+
+
+def add_markdown(doc, markdown_text):
+    """Append markdown (as written by the LLM) to a python-docx Document."""
+    html_text = markdown.markdown(markdown_text, extensions=["tables", "fenced_code"])
+    builder = _MarkdownDocxBuilder(doc)
+    builder.feed(html_text)
+    builder.close()
+    return doc
+
+
+def prepare_image(path, dpi=REPORT_IMAGE_DPI, width_in=REPORT_IMAGE_WIDTH_IN):
+    """
+    Downscale an image to width_in * dpi pixels (never upscale) and recompress it
+    as an optimized PNG. Returns an in-memory stream for Document.add_picture.
+    """
+    with Image.open(path) as img:
+        img.load()
+        if img.mode not in ("RGB", "RGBA", "L", "P"):
+            img = img.convert("RGB")
+        target = int(round(width_in * dpi))
+        if img.width > target:
+            height = max(1, int(round(img.height * target / img.width)))
+            img = img.resize((target, height), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, format="PNG", optimize=True, dpi=(dpi, dpi))
+    buf.seek(0)
+    return buf
+
+def add_overlays(doc, overlay_dir, dpi=REPORT_IMAGE_DPI, width_in=REPORT_IMAGE_WIDTH_IN):
+    """Append a heading and every overlay PNG (with its file name as caption)."""
+    # Add a heading before images
+    doc.add_heading("Segmentation Overlays", level=1)
+
+    # Insert each overlay PNG
+    for img_file in sorted(os.listdir(overlay_dir)):
+        if img_file.endswith(".png"):
+            doc.add_picture(prepare_image(os.path.join(overlay_dir, img_file), dpi, width_in), width=Inches(width_in))
+            doc.add_paragraph(img_file)  # caption
+    return doc
+
+
+def build_report_docx(markdown_text, output_path, overlay_dir=None, dpi=REPORT_IMAGE_DPI):
+    """
+    Build the patient report in one pass: explanation markdown, then the overlay
+    images, saved once to output_path. No pandoc involved.
+    """
+    doc = Document()
+    add_markdown(doc, markdown_text)
+    if overlay_dir and os.path.isdir(overlay_dir):
+        add_overlays(doc, overlay_dir, dpi=dpi)
+    doc.save(output_path)
+    return output_path
@@ -0,0 +1,336 @@
+# job_api.py
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import threading
+import mimetypes
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+import metrics
+from pipeline import RESULTS_DIR, PATIENT_FIELDS, parse_l3_z, read_status
+from stage_scheduler import get_scheduler
+from watch_folder import submit_logged
+
+API_ADDRESS = os.environ.get("SARC_API_ADDRESS", "127.0.0.1:6020")
+API_WORKERS = int(os.environ.get("SARC_API_WORKERS", "2"))        # patients in flight at once
+API_MAX_QUEUE = int(os.environ.get("SARC_API_MAX_QUEUE", "16"))   # waiting jobs before POST answers 429
+
+# Finished jobs remembered for GET /jobs/<id> (their results stay in results/ regardless)
+MAX_FINISHED_JOBS = 1000
+MAX_BODY_BYTES = 64 * 1024
+
+# Files of a finished job that can be downloaded, relative to the patient folder
+SERVED_FILES = re.compile(r"^(report\.csv|final_output\.docx|overlays/[\w.-]+\.png)$")
+
+
+def patient_name_for(name):
+    """Patient folder name for a submitted name (path separators replaced), or None if unusable."""
+    name = re.sub(r"[\\/]+", "_", str(name or "").strip())
+    return None if name in ("", ".", "..") or name.startswith(".") else name
+
+
+class Job:
+    def __init__(self, input_dir, patient_name, fields):
+        self.id = uuid.uuid4().hex[:12]
+        self.input_dir = input_dir
+        self.patient_name = patient_name
+        self.fields = fields
+        self.state = "queued"   # queued -> running -> done | failed | cancelled
+        self.error = None
+        self.submitted = time.time()
+        self.started = self.finished = None
+
+    def summary(self):
+        stamp = lambda t: time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(t)) if t else None
+        return {"id": self.id, "patient": self.patient_name, "input": self.input_dir, "state": self.state,
+                "error": self.error, "submitted": stamp(self.submitted), "started": stamp(self.started),
+                "finished": stamp(self.finished)}
+
+
+class JobQueue:
+    """
+    Jobs waiting for and running on the shared stage scheduler. At most workers
+    patients are in flight; up to max_queue more wait in line, beyond that
+    submit() refuses. Nothing here blocks on pipeline work: a job is handed to
+    the scheduler and the next one is started from its completion callback.
+    """
+
+    def __init__(self, results_dir=RESULTS_DIR, workers=API_WORKERS, max_queue=API_MAX_QUEUE, scheduler=None):
+        self.results_dir = os.path.abspath(results_dir)
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.scheduler = scheduler or get_scheduler()
+        self.accepting = True
+        self._jobs = OrderedDict()  # id -> Job, oldest first
+        self._waiting = deque()
+        self._running = 0
+        self._lock = threading.RLock()
+        os.makedirs(self.results_dir, exist_ok=True)
+        metrics.QUEUE_DEPTH.set_function(lambda: {("api",): len(self._waiting)}, "api")
+
+    def depth(self):
+        with self._lock:
+            return {"queued": len(self._waiting), "running": self._running,
+                    "workers": self.workers, "max_queue": self.max_queue}
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def submit(self, input_dir, patient_name, fields):
+        """Queue a job. Returns (job, None) or (None, (http code, reason)) when it is refused."""
+        with self._lock:
+            if not self.accepting:
+                return None, (503, "shutting down")
+            if len(self._waiting) >= self.max_queue:
+                return None, (429, f"queue full ({self.max_queue} jobs waiting)")
+            if any(j.patient_name == patient_name and j.state in ("queued", "running") for j in self._jobs.values()):
+                return None, (409, f"a job for {patient_name} is already queued or running")
+            job = Job(input_dir, patient_name, fields)
+            self._jobs[job.id] = job
+            self._waiting.append(job)
+            self._forget_finished()
+            self._dispatch()
+            return job, None
+
+    def _dispatch(self):
+        while self._waiting and self._running < self.workers:
+            job = self._waiting.popleft()
+            job.state, job.started = "running", time.time()
+            self._running += 1
+            try:
+                future = submit_logged(job.input_dir, job.patient_name, job.fields, self.results_dir, self.scheduler)
+            except Exception as e:
+                self._finish(job, None, e)
+                continue
+            future.add_done_callback(lambda f, job=job: self._finish(job, f))
+
+    def _finish(self, job, future, error=None):
+        with self._lock:
+            if error is None:
+                try:
+                    state = future.result().get("state")
+                except Exception as e:
+                    state, error = "failed", e
+            job.state = "done" if error is None and state == "done" else "failed"
+            job.error = str(error) if error is not None else None
+            job.finished = time.time()
+            self._running -= 1
+            self._dispatch()
+
+    def _forget_finished(self):
+        finished = [j.id for j in self._jobs.values() if j.finished is not None]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def close(self, wait=True):
+        """Stop accepting jobs, cancel the waiting ones and (with wait) let the running ones finish."""
+        with self._lock:
+            self.accepting = False
+            while self._waiting:
+                job = self._waiting.popleft()
+                job.state, job.finished = "cancelled", time.time()
+        if wait:
+            self.scheduler.wait()
+
+    def status(self, job):
+        """Job summary plus the stage progress from status.json and the download links once done."""
+        patient_output = os.path.join(self.results_dir, job.patient_name)
+        info = job.summary()
+        if job.state == "queued":
+            with self._lock:
+                info["position"] = next((i for i, j in enumerate(self._waiting) if j is job), None)
+            return info
+        status = read_status(patient_output)
+        info["stages"] = {stage: s.get("state") for stage, s in status.get("stages", {}).items()}
+        if job.state == "done":
+            info["files"] = [f"/jobs/{job.id}/files/{rel}" for rel in served_files(patient_output)]
+        return info
+
+
+def served_files(patient_output):
+    """Relative paths of the downloadable files present in a patient folder."""
+    found = []
+    for rel in ("report.csv", "final_output.docx"):
+        if os.path.isfile(os.path.join(patient_output, rel)):
+            found.append(rel)
+    overlays = os.path.join(patient_output, "overlays")
+    if os.path.isdir(overlays):
+        found += [f"overlays/{f}" for f in sorted(os.listdir(overlays)) if SERVED_FILES.match(f"overlays/{f}")]
+    return found
+
+
+class JobServer(ThreadingHTTPServer):
+    """
+    Local HTTP front end of a JobQueue:
+      POST /jobs                  {"dicom_path", "name", "age", "weight", "gender", "height", "l3_z"} -> 202 + job id
+      GET  /jobs                  all known jobs and the queue depth
+      GET  /jobs/<id>             state, stage progress and download links
+      GET  /jobs/<id>/files/<rel> report.csv, final_output.docx or overlays/*.png of a finished job
+      GET  /health                queue depth
+      GET  /metrics               OpenMetrics text (see metrics.py)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=API_ADDRESS, queue=None):
+        super().__init__(metrics.parse_address(address) if isinstance(address, str) else address, _Handler)
+        self.queue = queue or JobQueue()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve on a background thread; returns self."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass  # job progress is in each patient's pipeline.log
+
+    def _send_json(self, code, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _parts(self):
+        return [unquote(p) for p in urlsplit(self.path).path.strip("/").split("/") if p]
+
+    def do_GET(self):
+        queue = self.server.queue
+        parts = self._parts()
+        if parts == ["health"]:
+            self._send_json(200, queue.depth())
+        elif parts == ["metrics"]:
+            metrics.send_metrics(self)
+        elif parts == ["jobs"]:
+            self._send_json(200, {**queue.depth(), "jobs": [j.summary() for j in queue.jobs()]})
+        elif len(parts) >= 2 and parts[0] == "jobs":
+            job = queue.get(parts[1])
+            if job is None:
+                self._send_json(404, {"error": f"unknown job {parts[1]}"})
+            elif len(parts) == 2:
+                self._send_json(200, queue.status(job))
+            elif parts[2] == "files" and len(parts) > 3:
+                self._send_file(job, "/".join(parts[3:]))
+            else:
+                self._send_json(404, {"error": "not found"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def _send_file(self, job, rel):
+        if not SERVED_FILES.match(rel):
+            self._send_json(404, {"error": f"{rel} is not served"})
+            return
+        if job.state != "done":
+            self._send_json(409, {"error": f"job is {job.state}"})
+            return
+        path = os.path.join(self.server.queue.results_dir, job.patient_name, *rel.split("/"))
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self._send_json(404, {"error": f"{rel} not found (removed by retention?)"})
+            return
+        with f:
+            self.send_response(200)
+            self.send_header("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_POST(self):
+        if self._parts() != ["jobs"]:
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            self._send_json(400, {"error": "invalid Content-Length"})
+            return
+        if length > MAX_BODY_BYTES:
+            self._send_json(413, {"error": "request too large"})
+            return
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            self._send_json(400, {"error": f"invalid JSON: {e}"})
+            return
+        request = {str(k).lower(): v for k, v in request.items()}
+
+        input_dir = request.get("dicom_path") or request.get("input")
+        patient_name = patient_name_for(request.get("name"))
+        if not input_dir or not os.path.isdir(input_dir):
+            self._send_json(400, {"error": f"dicom_path is not a folder: {input_dir}"})
+            return
+        if patient_name is None:
+            self._send_json(400, {"error": "name is required"})
+            return
+        fields = {key: str(request.get(key.lower(), "") or "") for key in PATIENT_FIELDS}
+        try:
+            parse_l3_z(fields["L3_z"])
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        job, refused = self.server.queue.submit(os.path.abspath(input_dir), patient_name, fields)
+        if refused:
+            code, reason = refused
+            headers = {"Retry-After": "30"} if code in (429, 503) else None
+            self._send_json(code, {"error": reason, **self.server.queue.depth()}, headers)
+            return
+        self._send_json(202, {**self.server.queue.status(job), "status_url": f"/jobs/{job.id}"},
+                        {"Location": f"/jobs/{job.id}"})
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Local HTTP API to submit studies and poll the sarcopenia pipeline")
+    parser.add_argument("--address", default=API_ADDRESS, help="host:port to listen on (default 127.0.0.1:6020)")
+    parser.add_argument("--results", default=RESULTS_DIR, help="Results base folder")
+    parser.add_argument("--workers", type=int, default=API_WORKERS, help="Number of patients in flight at once")
+    parser.add_argument("--max-queue", type=int, default=API_MAX_QUEUE, help="Jobs allowed to wait before POST returns 429")
+    args = parser.parse_args()
+
+    queue = JobQueue(args.results, workers=args.workers, max_queue=args.max_queue)
+    try:
+        server = JobServer(args.address, queue)
+    except OSError as e:
+        print(f"❌ Cannot listen on {args.address}: {e}")
+        sys.exit(1)
+    print(f"🌐 Job API on {server.url} -> {queue.results_dir}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping, waiting for running patients...", flush=True)
+    finally:
+        server.server_close()
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()
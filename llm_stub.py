@@ -0,0 +1,108 @@
+# llm_stub.py
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_REPLY = """## Your Results
+
+Your scan was analyzed and your **Skeletal Muscle Index** was calculated.
+
+- Muscle area and fat areas were measured on the CT.
+- Please discuss these results with your healthcare provider.
+"""
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    """
+    Local OpenAI-compatible chat completion endpoint standing in for the
+    inference provider. Can delay replies and fail the first N requests with
+    HTTP 503 to exercise timeouts and retries.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), reply=STUB_REPLY, delay=0.0, fail_first=0):
+        super().__init__(address, _Handler)
+        self.reply = reply
+        self.delay = delay
+        self.fail_first = fail_first
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve on a background thread; returns self."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass  # keep test output quiet
+
+    def _send_json(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send_json(200, {"requests": self.server.requests})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": "not found"})
+            return
+
+        with self.server._lock:
+            self.server.requests += 1
+            n = self.server.requests
+        if n <= self.server.fail_first:
+            self._send_json(503, {"error": "stub: temporarily unavailable"})
+            return
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        self._send_json(200, {
+            "id": f"stub-{n}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "system_fingerprint": "stub",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.server.reply},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Local stub for the LLM chat completion provider")
+    parser.add_argument("--port", type=int, default=8009)
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before answering")
+    parser.add_argument("--fail-first", type=int, default=0, help="Answer the first N requests with HTTP 503")
+    args = parser.parse_args()
+
+    server = StubLLMServer(("127.0.0.1", args.port), delay=args.delay, fail_first=args.fail_first)
+    print(f"🤖 Stub LLM listening on {server.url} (set SARC_LLM_BASE_URL to use it)", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
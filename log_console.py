@@ -0,0 +1,127 @@
+# log_console.py
+import queue
+import threading
+import tkinter as tk
+
+# Lines kept in the on-screen console; the full log goes to the patient's pipeline.log
+MAX_LINES = 2000
+# How often the Tk main loop drains queued lines, and how many it takes per tick
+DRAIN_INTERVAL_MS = 50
+DRAIN_BATCH = 1000
+
+
+def is_progress_line(line):
+    """tqdm / carriage-return style status lines that replace each other on screen."""
+    return "\r" in line or "%" in line
+
+
+class LogConsole:
+    """
+    Thread-safe log pump for a Tk Text widget.
+
+    Any thread calls write(); text is queued without touching Tk (a run's log
+    file is written by its RunLog). The Tk main loop drains the queue every
+    DRAIN_INTERVAL_MS, collapses consecutive progress lines of the same source
+    (the patient a RunLog writes for) into one, inserts the batch in one go and
+    trims the widget to the last max_lines lines. Progress lines of a named
+    source are shown as "<source>: <line>", so runs going at once stay apart.
+    """
+
+    def __init__(self, master, text_widget, max_lines=MAX_LINES,
+                 interval_ms=DRAIN_INTERVAL_MS, batch=DRAIN_BATCH):
+        self.master = master
+        self.text = text_widget
+        self.max_lines = max_lines
+        self.interval_ms = interval_ms
+        self.batch = batch
+        self._queue = queue.Queue()
+        self._last_progress = False  # last line on screen is a progress line
+        self._last_source = None     # and who wrote it
+        self.master.after(self.interval_ms, self._drain)
+
+    # -- any thread -------------------------------------------------------
+    def write(self, message, tag=None, source=None):
+        """Queue a message (one or more lines) for the console."""
+        self._queue.put((message, tag, source))
+
+    def error(self, message, source=None):
+        self.write(message, "error", source)
+
+    # -- Tk main loop only ------------------------------------------------
+    def _collect(self):
+        """Drain up to self.batch messages into [(text, tag, progress, source)] lines."""
+        lines = []
+        for _ in range(self.batch):
+            try:
+                message, tag, source = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            for line in message.replace("\r", "\n").split("\n"):
+                line = line.rstrip()
+                if not line.strip():
+                    continue
+                progress = "\r" in message or is_progress_line(line)
+                if progress and source:
+                    line = f"{source}: {line}"
+                if progress and lines and lines[-1][2] and lines[-1][3] == source:
+                    lines[-1] = (line, tag, True, source)  # collapse within the batch
+                else:
+                    lines.append((line, tag, progress, source))
+        return lines
+
+    def _drain(self):
+        try:
+            lines = self._collect()
+            if lines:
+                self._show(lines)
+        finally:
+            self.master.after(self.interval_ms, self._drain)
+
+    def _show(self, lines):
+        if lines[0][2] and self._last_progress and lines[0][3] == self._last_source:
+            self.text.delete("end-2l", "end-1l")  # replace the previous progress line
+
+        # One insert per run of lines sharing a tag
+        chunk, chunk_tag = [], lines[0][1]
+        for line, tag, _, _ in lines:
+            if tag != chunk_tag and chunk:
+                self.text.insert(tk.END, "\n".join(chunk) + "\n", chunk_tag or ())
+                chunk = []
+            chunk_tag = tag
+            chunk.append(line)
+        self.text.insert(tk.END, "\n".join(chunk) + "\n", chunk_tag or ())
+        self._last_progress, self._last_source = lines[-1][2], lines[-1][3]
+
+        excess = int(self.text.index("end-1c").split(".")[0]) - 1 - self.max_lines
+        if excess > 0:
+            self.text.delete("1.0", f"{excess + 1}.0")
+        self.text.see(tk.END)
+
+
+class RunLog:
+    """
+    Log of one pipeline run: messages are appended to that run's own file and
+    shown on the shared console under name, so runs going at the same time
+    never write into each other's pipeline.log or progress line.
+    """
+
+    def __init__(self, console, path, name=None):
+        self.console = console
+        self.name = name
+        self._file = open(path, "a", buffering=1, encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, message, tag=None):
+        with self._lock:
+            if self._file is not None:
+                self._file.write(message if message.endswith("\n") else message + "\n")
+        self.console.write(message, tag, self.name)
+
+    def error(self, message):
+        self.write(message, "error")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,259 @@
+# metrics.py
+import os
+import math
+import threading
+
+# Opt-in exporters: an HTTP endpoint ("host:port", scraped at /metrics) and/or a
+# file rewritten every METRICS_INTERVAL seconds (for node_exporter's textfile collector)
+METRICS_ADDRESS = os.environ.get("SARC_METRICS_ADDRESS")
+METRICS_FILE = os.environ.get("SARC_METRICS_FILE")
+METRICS_INTERVAL = float(os.environ.get("SARC_METRICS_INTERVAL", "15"))
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Stage latencies range from under a second (scoring, DOCX) to many minutes (segmentation on CPU)
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """[(suffix, label values, extra labels, value)] for render()."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# TYPE {self.name} {self.kind}", f"# HELP {self.name} {_escape(self.help)}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_label_text(self.labelnames, values, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonic count, exposed as <name>_total."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [("_total", key, (), value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """
+    Current value. Either set() explicitly or read at scrape time from functions
+    given to set_function(), each returning a number (no labels) or
+    {label values tuple: number}; source names the function so it can be replaced.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function, source="default"):
+        with self._lock:
+            self._functions[source] = function
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = list(self._functions.values())
+        for function in functions:
+            try:
+                result = function()
+            except Exception:
+                continue  # a failing source only drops its own samples
+            if not isinstance(result, dict):
+                result = {(): result}
+            values.update({tuple(str(v) for v in key): value for key, value in result.items()})
+        return [("", key, (), value) for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    """Cumulative bucket counts, sum and count of observed values."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    out.append(("_bucket", key, (("le", _format_value(float(bound))),), count))
+                out.append(("_count", key, (), counts[-1]))
+                out.append(("_sum", key, (), total))
+        return out
+
+
+REGISTRY = {}
+_registry_lock = threading.Lock()
+
+def _register(cls, name, help_text, labels=(), **kwargs):
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = cls(name, help_text, labels, **kwargs)
+        return REGISTRY[name]
+
+def counter(name, help_text, labels=()):
+    return _register(Counter, name, help_text, labels)
+
+def gauge(name, help_text, labels=()):
+    return _register(Gauge, name, help_text, labels)
+
+def histogram(name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, help_text, labels, buckets=buckets)
+
+def render():
+    """Every registered metric in the OpenMetrics text format."""
+    with _registry_lock:
+        metrics = list(REGISTRY.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+# Metrics recorded by the pipeline, scheduler, LLM service and job API
+PATIENTS_STARTED = counter("sarc_patients_started", "Patients whose pipeline run started")
+PATIENTS_SUCCEEDED = counter("sarc_patients_succeeded", "Patients whose pipeline run finished with every stage done")
+PATIENTS_FAILED = counter("sarc_patients_failed", "Patients with a failed or skipped stage, or a crashed run")
+STAGE_SECONDS = histogram("sarc_stage_duration_seconds",
+                          "Wall time of stages that ran (llm and docx are the two parts of report)", ("stage",))
+STAGE_RUNS = counter("sarc_stage_runs", "Stage outcomes: done, cached, resumed, failed, skipped", ("stage", "state"))
+CACHE_REQUESTS = counter("sarc_cache_requests", "Result cache (per stage) and LLM cache lookups", ("cache", "result"))
+SUBPROCESS_EXITS = counter("sarc_subprocess_exits", "Exit codes of stage subprocesses", ("stage", "code"))
+QUEUE_DEPTH = gauge("sarc_queue_depth", "Stage tasks waiting for a pool thread, API jobs waiting, LLM requests in flight", ("queue",))
+IN_FLIGHT = gauge("sarc_patients_in_flight", "Patients submitted to the stage scheduler and not finished")
+
+
+def parse_address(address):
+    """'host:port' -> (host, port)."""
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def serve(address):
+    """
+    Answer GET /metrics on address ("host:port") from a background thread.
+    Returns the server (http.server is only imported when an endpoint is wanted).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            pass  # scraped every few seconds
+
+        def do_GET(self):
+            if self.path.split("?")[0].rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            send_metrics(self)
+
+    server = ThreadingHTTPServer(parse_address(address), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="sarc-metrics-http", daemon=True).start()
+    return server
+
+def send_metrics(handler):
+    """Answer an http.server request handler with the current metrics."""
+    body = render().encode()
+    handler.send_response(200)
+    handler.send_header("Content-Type", CONTENT_TYPE)
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def write_file(path):
+    """Write render() to path atomically (scrapers never see a half-written file)."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+def _write_loop(path, interval, stop):
+    while True:
+        try:
+            write_file(path)
+        except OSError as e:
+            print(f"Could not write metrics to {path}: {e}")
+        if stop.wait(interval):
+            return
+
+
+_exporters = {}
+_exporters_lock = threading.Lock()
+
+def start_exporters(address=METRICS_ADDRESS, path=METRICS_FILE, interval=METRICS_INTERVAL):
+    """
+    Start the configured exporters once per process (nothing when neither
+    SARC_METRICS_ADDRESS nor SARC_METRICS_FILE is set). Returns the running ones.
+    """
+    with _exporters_lock:
+        if address and "server" not in _exporters:
+            try:
+                _exporters["server"] = serve(address)
+            except OSError as e:
+                print(f"Could not serve metrics on {address}: {e}")
+        if path and "file" not in _exporters:
+            stop = threading.Event()
+            threading.Thread(target=_write_loop, args=(path, interval, stop), name="sarc-metrics-file",
+                             daemon=True).start()
+            _exporters["file"] = stop
+        return dict(_exporters)
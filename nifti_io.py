@@ -0,0 +1,136 @@
+# nifti_io.py
+import io
+import os
+import sys
+import gzip
+import shutil
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# How the working NIfTI files (conversion output, segmentation labels) are stored:
+#   "gzip" - .nii.gz, smallest on disk; every stage that reads it decompresses it again on one core
+#   "raw"  - uncompressed .nii, memory-mapped by the readers; compressed once when a patient is archived
+NIFTI_STORAGE = os.environ.get("SARC_NIFTI_STORAGE", "gzip")
+STORAGE_MODES = ("gzip", "raw")
+
+# Final compression (archives, nifti_io.py CLI): gzip level and compression threads
+GZIP_LEVEL = int(os.environ.get("SARC_GZIP_LEVEL", "6"))
+GZIP_WORKERS = int(os.environ.get("SARC_GZIP_WORKERS", os.cpu_count() or 1))
+
+# Uncompressed bytes per gzip member; each member is compressed on its own thread
+GZIP_BLOCK = 8 * 1024 * 1024
+
+
+def nifti_ext(storage=None):
+    """File extension for a storage mode (".nii" for raw, ".nii.gz" for gzip)."""
+    return ".nii" if (storage or NIFTI_STORAGE) == "raw" else ".nii.gz"
+
+def nifti_stem(path):
+    """File name without its .nii/.nii.gz extension."""
+    name = os.path.basename(str(path))
+    for ext in (".nii.gz", ".nii"):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def load_nifti(path):
+    """
+    nib.load tuned for slice/chunk reads: an uncompressed .nii is memory-mapped,
+    and a .nii.gz keeps one decompressor open so that reading the next chunk
+    continues where the previous one stopped instead of decompressing from the start.
+    """
+    import nibabel as nib
+    path = str(path)
+    if path.endswith(".gz"):
+        return nib.load(path, keep_file_open=True)
+    return nib.load(path, mmap="r")
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Write-only file object producing gzip output on several threads (like pigz):
+    the input is cut into GZIP_BLOCK sized blocks and each is compressed into its
+    own gzip member. Concatenated members are a valid gzip file for gzip, tarfile
+    and nibabel. Memory is bounded to about 2 * workers blocks.
+    """
+
+    def __init__(self, fileobj, level=GZIP_LEVEL, workers=GZIP_WORKERS, block_size=GZIP_BLOCK):
+        super().__init__()
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.workers = max(1, workers)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        self._pending = deque()
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        # zlib releases the GIL, so members compress in parallel
+        self._pending.append(self._pool.submit(gzip.compress, block, self.level, mtime=0))
+        while len(self._pending) > 2 * self.workers:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._pending:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown()
+            super().close()
+
+
+def gzip_file(src, dst=None, level=GZIP_LEVEL, workers=GZIP_WORKERS, remove=True):
+    """Compress src to dst (default src + ".gz") with ParallelGzipWriter. Returns dst."""
+    dst = dst or src + ".gz"
+    tmp = dst + ".tmp"
+    with open(src, "rb") as fin, open(tmp, "wb") as fout:
+        with ParallelGzipWriter(fout, level, workers) as gz:
+            shutil.copyfileobj(fin, gz, GZIP_BLOCK)
+    os.replace(tmp, dst)
+    if remove:
+        os.remove(src)
+    return dst
+
+def compress_niftis(folder, level=GZIP_LEVEL, workers=GZIP_WORKERS):
+    """gzip every uncompressed .nii under folder in place. Returns the new paths."""
+    done = []
+    for root, _, files in os.walk(folder):
+        for f in sorted(files):
+            if f.endswith(".nii"):
+                done.append(gzip_file(os.path.join(root, f), level=level, workers=workers))
+    return done
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="gzip the uncompressed NIfTI files of a patient or results folder")
+    parser.add_argument("folder", help="Folder searched recursively for .nii files")
+    parser.add_argument("--level", type=int, default=GZIP_LEVEL, help="gzip level 1-9 (default $SARC_GZIP_LEVEL or 6)")
+    parser.add_argument("--workers", type=int, default=GZIP_WORKERS, help="Compression threads")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        print(f"❌ Not a folder: {args.folder}")
+        sys.exit(1)
+    for path in compress_niftis(args.folder, args.level, args.workers):
+        print(f"✅ {path} ({os.path.getsize(path) / 1024 ** 2:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# overlay_render.py
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+# (window center, window width) in HU
+WINDOW_PRESETS = {
+    "abdomen": (40, 400),
+    "soft_tissue": (50, 350),
+    "bone": (400, 1800),
+}
+
+# Segmentation label -> RGB; label 0 (background) stays transparent
+LABEL_COLORS = {
+    1: (220, 40, 40),    # muscle
+    2: (250, 200, 40),   # subcutaneous fat
+    3: (40, 200, 80),    # visceral fat
+    4: (40, 120, 250),   # intermuscular fat
+}
+
+def build_label_lut(colors=None, alpha=0.4, size=256):
+    """
+    Lookup table mapping label values to RGBA (uint8), alpha pre-scaled to 0..256
+    in the fourth channel (uint16) so blending stays integer math.
+    """
+    colors = LABEL_COLORS if colors is None else colors
+    lut = np.zeros((size, 4), dtype=np.uint16)
+    a = int(round(alpha * 256))
+    for label, rgb in colors.items():
+        if 0 < label < size:
+            lut[label, :3] = rgb
+            lut[label, 3] = a
+    return lut
+
+_DEFAULT_LUT = build_label_lut()
+
+def window_to_uint8(ct_slice, window="abdomen"):
+    """Vectorized HU window/level to 0..255 grey. window is a preset name or (center, width)."""
+    center, width = WINDOW_PRESETS[window] if isinstance(window, str) else window
+    lo = center - width / 2.0
+    scaled = (np.asarray(ct_slice, dtype=np.float32) - lo) * (255.0 / width)
+    return np.clip(np.rint(scaled), 0, 255).astype(np.uint8)
+
+def render_overlay(ct_slice, seg_slice, window="abdomen", lut=None):
+    """
+    Blend a CT slice and its label slice into an RGB uint8 image.
+    Pure integer array math after windowing, so output is pixel-deterministic.
+    """
+    lut = _DEFAULT_LUT if lut is None else lut
+    grey = window_to_uint8(ct_slice, window).astype(np.uint16)
+    labels = np.clip(np.asarray(seg_slice), 0, lut.shape[0] - 1).astype(np.intp)
+    rgba = lut[labels]
+    a = rgba[..., 3]
+    inv = 256 - a
+    rgb = (grey[..., None] * inv[..., None] + rgba[..., :3] * a[..., None]) >> 8
+    return rgb.astype(np.uint8)
+
+def save_png(rgb, output_path, compress_level=6):
+    """Write an RGB uint8 array as PNG (fixed settings, no metadata, so bytes are reproducible)."""
+    Image.fromarray(rgb).save(output_path, format="PNG", compress_level=compress_level)
+    return output_path
+
+def render_to_png(ct_slice, seg_slice, output_path, window="abdomen", lut=None):
+    """render_overlay + save_png; a top-level function so it can be sent to thread or process pools."""
+    return save_png(render_overlay(ct_slice, seg_slice, window, lut), output_path)
+
+def render_slices(jobs, window="abdomen", lut=None, workers=4):
+    """
+    Render many (ct_slice, seg_slice, output_path) jobs on a thread pool
+    (NumPy and PNG compression release the GIL). Returns the written paths in order.
+    """
+    jobs = list(jobs)
+    if workers <= 1 or len(jobs) <= 1:
+        return [render_to_png(ct, seg, path, window, lut) for ct, seg, path in jobs]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda job: render_to_png(job[0], job[1], job[2], window, lut), jobs))
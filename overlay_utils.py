@@ -1,27 +1,64 @@
 import os
-import nibabel as nib
+import sys
 import numpy as np
-import matplotlib.pyplot as plt
+from overlay_render import render_slices
+from nifti_io import load_nifti
 
-def save_overlay_slices(ct_folder, seg_folder, output_dir, num_slices=3):
+def _pyplot():
+    # Imported on first use: the fast renderer does not need matplotlib at all
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (None where the resource module is unavailable)."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def find_nii(folder):
+    """First .nii/.nii.gz file found (recursively) under folder, or None."""
+    for root, _, files in os.walk(folder):
+        for f in files:
+            if f.endswith(".nii.gz") or f.endswith(".nii"):
+                return os.path.join(root, f)
+    return None
+
+def read_axial_slice(img, slice_idx):
+    """
+    Read one axial slice through the image's array proxy without loading the volume.
+    Unscaled images keep their on-disk dtype (int16 CT, uint8 labels).
+    """
+    return np.asanyarray(img.dataobj[:, :, slice_idx])
+
+def save_overlay_slices(ct_folder, seg_folder, output_dir, num_slices=3, lazy=True,
+                        renderer="matplotlib", window="abdomen", workers=4, ct_img=None):
     """
     Save multiple overlay slices (CT + segmentation) as PNGs.
 
     Args:
-        ct_folder (str): Folder containing CT .nii.gz
-        seg_folder (str): Folder containing segmentation .nii.gz
+        ct_folder (str): Folder containing CT .nii/.nii.gz
+        seg_folder (str): Folder containing segmentation .nii/.nii.gz
         output_dir (str): Folder to save PNGs
         num_slices (int): Number of slices to save (default 3)
+        lazy (bool): Read only the drawn slices through the NIfTI proxies instead
+            of loading both volumes as float64; peak memory then scales with the
+            number of slices, not the volume size (default True)
+        renderer (str): "matplotlib" (autoscaled grey + jet overlay) or "fast"
+            (NumPy window/level + label LUT written straight to PNG)
+        window (str or tuple): HU window preset for the fast renderer
+            ("abdomen", "soft_tissue", "bone") or (center, width)
+        workers (int): Threads used by the fast renderer
+        ct_img (Nifti1Image): CT already in memory (native conversion); ct_folder
+            is not read when given
     """
-    def find_nii(folder):
-        for root, _, files in os.walk(folder):
-            for f in files:
-                if f.endswith(".nii.gz") or f.endswith(".nii"):
-                    return os.path.join(root, f)
-        return None
-
     # Find files
-    ct_path = find_nii(ct_folder)
+    ct_path = find_nii(ct_folder) if ct_img is None else "memory"
     seg_path = find_nii(seg_folder)
 
     if not ct_path or not seg_path:
@@ -29,31 +66,51 @@ def save_overlay_slices(ct_folder, seg_folder, output_dir, num_slices=3):
             f"Could not find CT in {ct_folder} or segmentation in {seg_folder}"
         )
 
-    # Load volumes
-    ct_img = nib.load(ct_path).get_fdata()
-    seg_img = nib.load(seg_path).get_fdata()
+    ct_nii = load_nifti(ct_path) if ct_img is None else ct_img
+    seg_nii = load_nifti(seg_path)
+    if lazy:
+        ct_img, seg_img = None, None
+    else:
+        # Load volumes
+        ct_img = ct_nii.get_fdata()
+        seg_img = seg_nii.get_fdata()
 
     # Make sure output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
     # Pick evenly spaced slices across the volume
-    total_slices = ct_img.shape[2]
+    total_slices = ct_nii.shape[2]
     slice_indices = np.linspace(total_slices // 4,
                                 3 * total_slices // 4,
                                 num_slices,
                                 dtype=int)
 
+    jobs = []
     for i, slice_idx in enumerate(slice_indices):
-        ct_slice = ct_img[:, :, slice_idx]
-        seg_slice = seg_img[:, :, slice_idx]
+        if lazy:
+            ct_slice = read_axial_slice(ct_nii, slice_idx)
+            seg_slice = read_axial_slice(seg_nii, slice_idx)
+        else:
+            ct_slice = ct_img[:, :, slice_idx]
+            seg_slice = seg_img[:, :, slice_idx]
+
+        output_path = os.path.join(output_dir, f"overlay_slice_{i+1}.png")
+        if renderer == "fast":
+            jobs.append((ct_slice, seg_slice, output_path))
+            continue
 
+        plt = _pyplot()
         plt.figure(figsize=(6, 6))
         plt.imshow(ct_slice, cmap="gray")
         plt.imshow(seg_slice, cmap="jet", alpha=0.4)
         plt.axis("off")
 
-        output_path = os.path.join(output_dir, f"overlay_slice_{i+1}.png")
         plt.savefig(output_path, bbox_inches="tight", pad_inches=0)
         plt.close()
 
-    print(f"Saved {num_slices} overlay slices to {output_dir}")
\ No newline at end of file
+    if jobs:
+        render_slices(jobs, window=window, workers=workers)
+
+    rss = peak_rss_mb()
+    rss_msg = f" (peak RSS {rss:.0f} MB)" if rss is not None else ""
+    print(f"Saved {num_slices} overlay slices to {output_dir}{rss_msg}")
\ No newline at end of file
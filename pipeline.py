@@ -0,0 +1,532 @@
+# pipeline.py
+import os
+import sys
+import csv
+import json
+import time
+import threading
+import subprocess
+import traceback
+
+# Stage dependencies (pydicom, nibabel, pandas, huggingface_hub, python-docx, ...)
+# are imported inside the functions that run the stage, so importing this module
+# (and starting the GUI) stays cheap.
+from result_cache import ResultCache, content_digest, input_stat_digest
+from stage_timing import StageTimer, profile_path_for, write_timings
+from results_store import ResultsStore, RetentionPolicy
+from nifti_io import NIFTI_STORAGE
+from stage_scheduler import OK_STATES, clear_checkpoint, get_scheduler, read_checkpoint, write_checkpoint
+import metrics
+
+def app_base_dir():
+    """Return base directory for saving results, works in dev and PyInstaller bundle."""
+    if getattr(sys, "frozen", False):  # running as bundle
+        return os.path.dirname(sys.executable)
+    return os.path.abspath(".")
+
+RESULTS_DIR = os.path.join(app_base_dir(), "results")
+CACHE_DIR = os.environ.get("SARC_CACHE_DIR", os.path.join(app_base_dir(), "cache"))
+LLM_CACHE_DIR = os.path.join(CACHE_DIR, "llm")
+
+# Fields collected by the form (or a sidecar file) for every patient. L3_z is optional:
+# the L3 position in mm along the slice normal, see parse_l3_z
+PATIENT_FIELDS = ("Age", "Weight", "Gender", "Height", "L3_z")
+
+# Parallel dcm2niix jobs per patient (series folders converted at once)
+CONVERSION_WORKERS = int(os.environ.get("SARC_CONVERSION_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Optional partial conversion: a slab this many mm thick, centred on the patient's L3_z
+# when given, else at a fraction of the scan from its inferior end (mid-scan by default),
+# which does not locate L3
+SLAB_MM = os.environ.get("SARC_SLAB_MM")
+SLAB_CENTER = os.environ.get("SARC_SLAB_CENTER", "0.5")
+
+# "dcm2niix" (subprocess) or "native": decode the chosen series in-process with
+# dicom_reader.py and hand the volume to the overlay stage without re-reading it
+CONVERSION_BACKEND = os.environ.get("SARC_CONVERSION_BACKEND", "dcm2niix")
+
+# Address of a running seg_worker.py server; when set, segmentation is sent to
+# that warm worker instead of starting predict_muscle_fat.py per patient
+SEG_WORKER = os.environ.get("SARC_SEG_WORKER")
+# Model the warm worker must be running (as given to seg_worker.py serve --model);
+# part of the segmentation cache key, so switching models re-segments
+SEG_MODEL = os.environ.get("SARC_SEG_MODEL", "stub")
+# Checkpoint predict_muscle_fat.py loads when there is no worker
+SEG_CHECKPOINT = "best"
+
+# SQLite index of DICOM headers shared by all runs: metadata and series planning
+# re-read only new or changed files. Set SARC_DICOM_INDEX to "" to crawl instead.
+DICOM_INDEX = os.environ.get("SARC_DICOM_INDEX", os.path.join(CACHE_DIR, "dicom_index.sqlite"))
+
+# Optional SMI cutoff table (CSV/JSON) for rule_based_sarcopenia.py
+THRESHOLDS_FILE = os.environ.get("SARC_THRESHOLDS")
+
+STAGES = ("conversion", "segmentation", "scoring", "overlays", "report")
+
+
+def resource_path(relative_path):
+    """Get absolute path to resource for PyInstaller bundle or dev mode."""
+    if getattr(sys, 'frozen', False):  # Running in bundle
+        base_path = sys._MEIPASS
+    else:  # Running in normal Python
+        base_path = os.path.abspath(".")
+    return os.path.join(base_path, relative_path)
+
+def _log_default(msg):
+    print(msg, end="", flush=True)
+
+
+def read_dicom_metadata(input_dir, log=None):
+    """DICOM metadata of a study, from the header index when enabled (crawling the folder otherwise)."""
+    if DICOM_INDEX:
+        try:
+            from dicom_index import DicomIndex
+            index = DicomIndex(DICOM_INDEX)
+            index.scan(input_dir)
+            meta = index.metadata(input_dir)
+            index.close()
+            if meta:
+                return meta
+        except Exception as e:
+            (log or _log_default)(f" DICOM index unavailable ({e}), reading headers directly\n")
+    from dicom_utils import extract_dicom_metadata
+    return extract_dicom_metadata(input_dir)
+
+def input_fingerprint(input_dir):
+    """
+    Digest of the input files' relative paths, sizes and mtimes (no file is read),
+    taken from the header index that read_dicom_metadata has just brought up to
+    date when it is enabled, from a stat walk otherwise.
+    """
+    stats = None
+    if DICOM_INDEX:
+        try:
+            from dicom_index import DicomIndex
+            index = DicomIndex(DICOM_INDEX)
+            stats = index.file_stats(input_dir) or None
+            index.close()
+        except Exception:
+            stats = None
+    return input_stat_digest(input_dir, stats)
+
+def write_patient_metadata(patient_output, patient_name, fields, dicom_meta):
+    """
+    Merge user-provided fields with DICOM metadata and write segmentation/metadata.csv.
+    Returns the path of the written file.
+    """
+    row_data = {"ID": patient_name}
+    for key in PATIENT_FIELDS:
+        row_data[key] = (fields or {}).get(key, "")
+    row_data.update(dicom_meta)
+
+    # Save metadata with dynamic columns
+    metadata_file = os.path.join(patient_output, "segmentation", "metadata.csv")
+    os.makedirs(os.path.dirname(metadata_file), exist_ok=True)
+    with open(metadata_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=row_data.keys())
+        writer.writeheader()
+        writer.writerow(row_data)
+    return metadata_file
+
+
+def parse_l3_z(value):
+    """
+    The L3_z patient field as a float (mm), or None when it is empty. Conversion
+    centres a slab on it and records it in nifti/l3.json, the slice scoring
+    measures when segmentation leaves no body_composition_2d.csv.
+    """
+    if value is None or str(value).strip() == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"L3_z must be a position in mm, got {value!r}") from None
+
+def build_commands(input_dir, patient_output, patient_name, results_dir=RESULTS_DIR, l3_z=None):
+    """Subprocess steps of the pipeline as (stage, command) pairs."""
+    return [
+        # Step 1: Convert DICOM to NIfTI (only the series picked from the DICOM headers)
+        ("conversion", [
+            "python", resource_path("DiCOM_to_nifti.py"),
+            input_dir,
+            os.path.abspath(results_dir),   # base results dir
+            patient_name,                   # patient ID
+            "--workers", str(CONVERSION_WORKERS)
+        ] + (["--slab-mm", SLAB_MM, "--slab-center", SLAB_CENTER] if SLAB_MM else [])
+          + (["--slab-z", str(l3_z)] if l3_z is not None else [])
+          + (["--index", DICOM_INDEX] if DICOM_INDEX else [])
+          + ["--storage", NIFTI_STORAGE]),
+
+        # Step 2: Run segmentation
+        ("segmentation", [
+            "python", resource_path("seg_worker.py"), "segment",
+            "--input", os.path.abspath(os.path.join(patient_output, "nifti")),
+            "--output", os.path.abspath(os.path.join(patient_output, "segmentation")),
+            "--address", SEG_WORKER,
+            "--model", SEG_MODEL
+        ]) if SEG_WORKER else ("segmentation", {
+            "cmd": [
+                "python", "predict_muscle_fat.py",
+                "--input", os.path.abspath(os.path.join(patient_output, "nifti")),
+                "--output", os.path.abspath(os.path.join(patient_output, "segmentation")),
+                "--checkpoint_type", SEG_CHECKPOINT,
+                "--body_composition_type", "2D",
+                "--overwrite", "True"
+            ],
+            "cwd": resource_path("CT-Muscle-and-Fat-Segmentation")
+        }),
+
+        # Step 3: Rule-based sarcopenia detection
+        ("scoring", [
+            "python", resource_path("rule_based_sarcopenia.py"),
+            os.path.abspath(patient_output),   # patient_folder
+            os.path.abspath(os.path.join(patient_output, "report.csv"))  # output_csv
+        ] + (["--thresholds", THRESHOLDS_FILE] if THRESHOLDS_FILE else [])),
+    ]
+
+
+def run_command(cmd_info, on_line=None, on_usage=None):
+    """
+    Run one pipeline command, streaming every output line to on_line.
+    cmd_info is either an argv list or a dict with "cmd" and optional "cwd".
+    Where os.wait4 exists, on_usage gets the process's own rusage.
+    Returns the process exit code.
+    """
+    if isinstance(cmd_info, dict):
+        cmd = cmd_info["cmd"]
+        cwd = cmd_info.get("cwd", None)
+    else:
+        cmd = cmd_info
+        cwd = None
+
+    on_line = on_line or _log_default
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+        cwd=cwd  # run in the right folder
+    )
+    for line in iter(process.stdout.readline, ''):
+        on_line(line)
+    process.stdout.close()
+    if on_usage is not None and hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        on_usage(usage)
+        return process.returncode
+    return process.wait()
+
+
+def read_status(patient_output):
+    """Return the parsed status.json of a patient folder, or {} if there is none."""
+    try:
+        with open(os.path.join(patient_output, "status.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_status(patient_output, **updates):
+    """Merge updates into the patient's status.json (written atomically)."""
+    status = read_status(patient_output)
+    stages = dict(status.get("stages", {}))
+    stages.update(updates.pop("stages", {}))
+    status.update(updates)
+    status["stages"] = stages
+    status["updated"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    path = os.path.join(patient_output, "status.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(status, f, indent=2, default=str)
+    os.replace(tmp, path)
+    return status
+
+
+# Files/folders (relative to the patient folder) each stage produces, as cached by ResultCache
+STAGE_ARTIFACTS = {
+    "conversion": (["nifti"], ()),
+    "segmentation": (["segmentation"], (os.path.join("segmentation", "metadata.csv"),)),
+    "scoring": (["report.csv"], ()),
+    "overlays": (["overlays"], ()),
+    "report": (["final_output.docx"], ()),
+}
+
+
+def _run_native_conversion(input_dir, results_dir, patient_name, log, l3_z=None):
+    """In-process conversion (CONVERSION_BACKEND "native"). Returns the CT image held in memory."""
+    from DiCOM_to_nifti import dicom_to_volume
+    img, final_path = dicom_to_volume(input_dir, results_dir, patient_name, log,
+                                      slab_mm=float(SLAB_MM) if SLAB_MM else None, slab_center=float(SLAB_CENTER),
+                                      slab_z=l3_z, index=DICOM_INDEX or None, storage=NIFTI_STORAGE)
+    if final_path is None:
+        raise RuntimeError(f"no DICOM series converted from {input_dir}")
+    return img
+
+def _run_overlays(patient_output, log, ct_img=None):
+    from overlay_utils import save_overlay_slices
+    ct_folder = os.path.join(patient_output, "nifti")
+    seg_folder = os.path.join(patient_output, "segmentation")
+    overlay_dir = os.path.join(patient_output, "overlays")
+    save_overlay_slices(ct_folder, seg_folder, overlay_dir, num_slices=3, renderer="fast", ct_img=ct_img)
+    log(f"\n Overlay images saved in {overlay_dir}\n")
+
+def _submit_explanation(patient_output, log):
+    """Start the LLM request as soon as report.csv exists; returns a Future or None."""
+    try:
+        from ai_api import get_service, read_report_row
+        return get_service(cache_dir=LLM_CACHE_DIR).submit(read_report_row(patient_output))
+    except Exception as e:
+        log(f"\n Could not start AI explanation: {e}\n")
+        return None
+
+def _record_cohort(patient_output, results_dir, log):
+    """Append the scored patient to the cohort store (cohort_store.py)."""
+    try:
+        from cohort_store import CohortStore
+        CohortStore.for_results(results_dir).append_patient(patient_output)
+    except Exception as e:
+        log(f"\n Could not add the patient to the cohort store: {e}\n")
+
+def _report_fingerprint():
+    from ai_api import prompt_fingerprint
+    return prompt_fingerprint()
+
+def _run_report(patient_output, log, explanation=None):
+    from ai_api import generate_ai_explanation
+    ai_doc = generate_ai_explanation(patient_output, explanation=explanation, cache_dir=LLM_CACHE_DIR)
+    log(f"AI Explanation saved: {ai_doc}\n")
+
+
+class PatientRun:
+    """
+    One patient's pass through the pipeline, run stage by stage by a StageScheduler:
+    prepare() writes metadata.csv, run_stage() runs one stage (or reuses its
+    checkpoint or cached result), finish() writes timings and applies retention.
+    Stages of one patient may run on different threads at the same time.
+    """
+
+    def __init__(self, input_dir, patient_name, fields=None, results_dir=RESULTS_DIR, log=None,
+                 use_cache=True, resume=True):
+        self.input_dir = input_dir
+        self.patient_name = patient_name
+        self.fields = fields
+        self.results_dir = results_dir
+        self.log = log or _log_default
+        self.use_cache = use_cache
+        self.resume = resume
+        self.patient_output = os.path.join(results_dir, patient_name)
+        self._lock = threading.Lock()  # status.json is updated from several stage threads
+
+    def _status(self, **updates):
+        with self._lock:
+            return write_status(self.patient_output, **updates)
+
+    def prepare(self):
+        out = self.patient_output
+        metrics.PATIENTS_STARTED.inc()
+        os.makedirs(out, exist_ok=True)
+        self.started = time.perf_counter()
+        self._status(patient=self.patient_name, input=os.path.abspath(self.input_dir),
+                     state="running", started=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     stages={s: {"state": "pending"} for s in STAGES})
+        store = ResultsStore(self.results_dir)
+        store.begin(self.patient_name)  # pinned: retention never touches a patient while it runs
+        store.close()
+        try:
+            self._plan()
+        except BaseException:
+            self._unpin()  # finish() will not run for this patient
+            raise
+
+    def _unpin(self):
+        store = ResultsStore(self.results_dir)
+        try:
+            store.unpin(self.patient_name)
+        finally:
+            store.close()
+
+    def _plan(self):
+        out, log = self.patient_output, self.log
+        self.l3_z = l3_z = parse_l3_z((self.fields or {}).get("L3_z"))
+        if SEG_WORKER and l3_z is None:
+            log("\n⚠️ No L3 position (L3_z) given: the segmentation worker does not pick L3, "
+                "so scoring will fail for this patient\n")
+        dicom_meta = read_dicom_metadata(self.input_dir, log)
+        metadata_file = write_patient_metadata(out, self.patient_name, self.fields, dicom_meta)
+        log(f" Saved patient metadata: {metadata_file}\n")
+
+        self.cache = ResultCache(CACHE_DIR) if self.use_cache else None
+        self.commands = dict(build_commands(self.input_dir, out, self.patient_name, self.results_dir, l3_z))
+        digests = self.digests = {}  # stage -> content digest of its outputs
+        self.key_parts = {
+            "conversion": lambda: [dicom_meta.get("StudyInstanceUID"), dicom_meta.get("SeriesInstanceUID"),
+                                   input_fingerprint(self.input_dir), [SLAB_MM, SLAB_CENTER] if SLAB_MM else "whole",
+                                   ["L3_z", l3_z], NIFTI_STORAGE, CONVERSION_BACKEND],
+            "segmentation": lambda: [digests.get("conversion"), ["worker", SEG_MODEL] if SEG_WORKER
+                                     else ["predict_muscle_fat", SEG_CHECKPOINT]],
+            "scoring": lambda: [digests.get("segmentation"),
+                                content_digest(out, [os.path.join("segmentation", "metadata.csv")]),
+                                content_digest(os.path.dirname(THRESHOLDS_FILE), [os.path.basename(THRESHOLDS_FILE)])
+                                if THRESHOLDS_FILE else "default"],
+            "overlays": lambda: [digests.get("conversion"), digests.get("segmentation")],
+            "report": lambda: [digests.get("scoring"), digests.get("overlays"), _report_fingerprint()],
+        }
+        self.pending = {}  # LLM explanation future, started once scoring is done so it overlaps overlays
+        self.volumes = {}  # images produced in-process, handed to later stages without a re-read
+        self.in_process = {
+            "overlays": lambda out, log: _run_overlays(out, log, self.volumes.pop("ct", None)),
+            "report": lambda out, log: _run_report(out, log, self.pending.get("explanation")),
+        }
+        if CONVERSION_BACKEND == "native":
+            del self.commands["conversion"]
+            self.in_process["conversion"] = lambda out, log: self.volumes.update(
+                ct=_run_native_conversion(self.input_dir, self.results_dir, self.patient_name, log, l3_z))
+        self.records = {}  # per-stage timings, written to timings.json
+
+    def _reused(self, stage, state, fp, digest, message):
+        self.digests[stage] = digest
+        self.log(message)
+        self._status(stages={stage: {"state": state, "fingerprint": fp}})
+        if stage == "scoring" and state == "cached":  # a resumed report does not need it
+            self.pending["explanation"] = _submit_explanation(self.patient_output, self.log)
+            _record_cohort(self.patient_output, self.results_dir, self.log)
+        return state
+
+    def run_stage(self, stage):
+        timer = StageTimer(stage, profile_path_for(self.patient_output, stage) if stage in self.in_process else None)
+        self.records[stage] = timer.record
+        with timer:
+            try:
+                state = self._run_stage(stage, timer)
+            except Exception as e:
+                self.log(f"\n {stage} failed: {e}\n{traceback.format_exc()}")
+                self._status(stages={stage: {"state": "failed", "error": str(e)}})
+                state = "failed"
+            timer.record["state"] = state
+        metrics.STAGE_RUNS.inc(stage=stage, state=state)
+        if state == "done":
+            metrics.STAGE_SECONDS.observe(timer.record["wall_s"], stage=stage)
+        return state
+
+    def _run_stage(self, stage, timer):
+        out, log, cache = self.patient_output, self.log, self.cache
+        relpaths, exclude = STAGE_ARTIFACTS[stage]
+        fp = ResultCache.fingerprint(stage, self.key_parts[stage]()) if cache or self.resume else None
+
+        checkpoint = read_checkpoint(out, stage, fp) if self.resume else None
+        if checkpoint is not None:
+            return self._reused(stage, "resumed", fp, checkpoint["digest"],
+                                f"\n⏩ {stage}: already done ({checkpoint['finished']}), resuming after it\n")
+        clear_checkpoint(out, stage)
+        digest = cache.restore(stage, fp, out) if cache else None
+        if cache:
+            metrics.CACHE_REQUESTS.inc(cache=stage, result="miss" if digest is None else "hit")
+        if digest is not None:
+            write_checkpoint(out, stage, fp, digest, relpaths, exclude)
+            return self._reused(stage, "cached", fp, digest, f"\n♻️ {stage}: reusing cached result {fp[:12]}\n")
+
+        self._status(stages={stage: {"state": "running"}})
+        if stage in self.commands:
+            cmd_info = self.commands[stage]
+            cmd = cmd_info["cmd"] if isinstance(cmd_info, dict) else cmd_info
+            log(f"\nRunning: {' '.join(cmd)}\n")
+            try:
+                ret = run_command(cmd_info, on_line=log, on_usage=timer.add_child)
+            except Exception as e:
+                log(f"\nSubprocess error: {e}\n{traceback.format_exc()}")
+                ret = None
+            metrics.SUBPROCESS_EXITS.inc(stage=stage, code="error" if ret is None else ret)
+            ok = ret == 0
+            if not ok:
+                log(f"\nCommand failed: {' '.join(cmd)}\n")
+            result = {"state": "done" if ok else "failed", "returncode": ret}
+        else:
+            try:
+                self.in_process[stage](out, log)
+                ok = True
+                result = {"state": "done"}
+            except Exception as e:
+                ok = False
+                log(f"\n {stage} failed: {e}\n")
+                result = {"state": "failed", "error": str(e)}
+
+        if ok:
+            if cache:
+                self.digests[stage] = cache.store(stage, fp, out, relpaths, exclude)
+            else:
+                self.digests[stage] = content_digest(out, relpaths, exclude)
+            if fp is not None:
+                write_checkpoint(out, stage, fp, self.digests[stage], relpaths, exclude)
+            result["fingerprint"] = fp
+            if stage == "scoring":
+                self.pending["explanation"] = _submit_explanation(out, log)
+                _record_cohort(out, self.results_dir, log)
+        self._status(stages={stage: result})
+        return result["state"]
+
+    def skip_stage(self, stage, failed):
+        self.log(f"\n⏭️ {stage} skipped: {', '.join(failed)} did not finish\n")
+        clear_checkpoint(self.patient_output, stage)
+        self.records[stage] = {"stage": stage, "state": "skipped"}
+        metrics.STAGE_RUNS.inc(stage=stage, state="skipped")
+        self._status(stages={stage: {"state": "skipped", "after": failed}})
+
+    def finish(self, states):
+        out, log = self.patient_output, self.log
+        write_timings(out, [self.records[s] for s in STAGES if s in self.records],
+                      patient=self.patient_name, cached=self.use_cache,
+                      elapsed_s=round(time.perf_counter() - self.started, 4))
+
+        failed = any(state not in OK_STATES for state in states.values())
+        status = self._status(state="failed" if failed else "done", finished=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        # Record this patient's files, then apply the retention policy to the others
+        store = ResultsStore(self.results_dir)
+        try:
+            store.register(self.patient_name, pinned=True)
+            store.enforce(RetentionPolicy.from_env(), log=log)
+        except Exception as e:
+            log(f"\n Results retention failed: {e}\n")
+        finally:
+            try:
+                store.unpin(self.patient_name)
+            finally:
+                store.close()
+        return status
+
+
+def submit_patient(input_dir, patient_name, fields=None, results_dir=RESULTS_DIR, log=None,
+                   use_cache=True, resume=True, scheduler=None):
+    """Queue a patient on the shared stage scheduler. Returns a Future of its final status."""
+    run = PatientRun(input_dir, patient_name, fields, results_dir, log, use_cache, resume)
+    future = (scheduler or get_scheduler()).submit(run)
+    future.add_done_callback(_count_outcome)
+    return future
+
+def _count_outcome(future):
+    try:
+        done = future.result().get("state") == "done"
+    except Exception:
+        done = False
+    (metrics.PATIENTS_SUCCEEDED if done else metrics.PATIENTS_FAILED).inc()
+
+def run_patient(input_dir, patient_name, fields=None, results_dir=RESULTS_DIR, log=None,
+                use_cache=True, resume=True):
+    """
+    Run the full pipeline (conversion, segmentation, scoring, overlays, report)
+    for one patient without any GUI. Progress goes to log, per-stage status to
+    <results_dir>/<patient_name>/status.json.
+
+    Stages run as soon as their dependencies are done (see stage_scheduler.STAGE_GRAPH),
+    and stages depending on a failed one are skipped. With resume, a stage whose
+    checkpoint matches its inputs and whose outputs are still in place is not re-run.
+
+    With use_cache, every stage is keyed on a fingerprint of its inputs (study/series
+    UIDs and input file names, sizes and mtimes, upstream outputs, patient metadata, stage version)
+    and skipped when ResultCache already holds its outputs.
+
+    Wall/CPU time, peak RSS, IO and child-process usage of every stage are
+    written to timings.json (plus cProfile dumps with SARC_PROFILE=1).
+    """
+    return submit_patient(input_dir, patient_name, fields, results_dir, log, use_cache, resume).result()
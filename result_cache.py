@@ -0,0 +1,257 @@
+# result_cache.py
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import argparse
+
+# Bump PIPELINE_VERSION for changes that affect every stage, or a single
+# STAGE_VERSIONS entry when only that stage's outputs change (new model,
+# new thresholds, new prompt, ...).
+PIPELINE_VERSION = "1"
+STAGE_VERSIONS = {
+    "conversion": "1",
+    "segmentation": "1",
+    "scoring": "1",
+    "overlays": "2",  # 2: fast NumPy renderer
+    "report": "2",  # 2: native DOCX builder, downscaled overlays
+}
+
+DEFAULT_MAX_BYTES = int(float(os.environ.get("SARC_CACHE_MAX_GB", 20)) * 1024 ** 3)
+
+_CHUNK = 1024 * 1024
+
+
+def _walk_files(base, relpaths, exclude=()):
+    """Yield (relpath, abspath) of every file under the given relative files/dirs, sorted."""
+    found = []
+    for rel in relpaths:
+        path = os.path.join(base, rel)
+        if os.path.isfile(path):
+            found.append((rel, path))
+        elif os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for f in files:
+                    abspath = os.path.join(root, f)
+                    found.append((os.path.relpath(abspath, base), abspath))
+    excluded = {os.path.normpath(e) for e in exclude}
+    return sorted((r, p) for r, p in found if os.path.normpath(r) not in excluded)
+
+def _hash_file(h, path):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            h.update(chunk)
+
+def content_digest(base, relpaths, exclude=()):
+    """Content hash of files (and directories, recursively) under base. Names are part of the hash."""
+    h = hashlib.blake2b(digest_size=20)
+    for rel, path in _walk_files(base, relpaths, exclude):
+        h.update(rel.replace(os.sep, "/").encode() + b"\0")
+        _hash_file(h, path)
+        h.update(b"\0")
+    return h.hexdigest()
+
+def input_stat_digest(input_dir, stats=None):
+    """
+    Hash of the relative path, size and mtime of every non-hidden file in a DICOM
+    input folder; no file is read. stats ({abspath: (size, mtime_ns)}, e.g. from
+    the DICOM header index) saves the walk.
+    """
+    base = os.path.abspath(input_dir)
+    if stats is None:
+        stats = {}
+        for root, _, files in os.walk(base):
+            for f in files:
+                if f.startswith("."):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stats[path] = (st.st_size, st.st_mtime_ns)
+    h = hashlib.blake2b(digest_size=20)
+    for path in sorted(stats):
+        size, mtime_ns = stats[path]
+        h.update(f"{os.path.relpath(path, base).replace(os.sep, '/')}\0{size}\0{mtime_ns}\0".encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of pipeline stage outputs.
+
+    Every entry lives in <cache_dir>/<stage>/<fingerprint>/ with a copy of the
+    stage's artifacts and a manifest.json. Entries are published with an atomic
+    rename, so several worker processes can share one cache without locking.
+    Recency is tracked through the mtime of each manifest and the cache is kept
+    below max_bytes by evicting least recently used entries. Plain files directly
+    in a stage folder (the LLM answers in llm/, see ai_api.ExplanationService)
+    are entries of their own, aged by their mtime.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(stage, parts):
+        """
+        Key for a stage run: its version, the pipeline version and the given
+        input parts (UIDs, upstream digests, metadata...). None if any part is unknown.
+        """
+        if any(p is None for p in parts):
+            return None
+        payload = json.dumps([PIPELINE_VERSION, stage, STAGE_VERSIONS.get(stage, "0"), list(parts)],
+                             default=str, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _entry_dir(self, stage, fp):
+        return os.path.join(self.cache_dir, stage, fp)
+
+    def restore(self, stage, fp, patient_output):
+        """
+        Copy a cached stage's artifacts into patient_output.
+        Returns the artifacts' content digest, or None on a miss.
+        """
+        if fp is None:
+            return None
+        entry = self._entry_dir(stage, fp)
+        manifest_path = os.path.join(entry, "manifest.json")
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Drop stale outputs of an earlier run so only the cached artifacts remain
+        for _, path in _walk_files(patient_output, manifest.get("artifacts", []), manifest.get("exclude", [])):
+            os.remove(path)
+
+        files_dir = os.path.join(entry, "files")
+        for rel in manifest["files"]:
+            dst = os.path.join(patient_output, rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(os.path.join(files_dir, rel), dst)
+        try:
+            os.utime(manifest_path)  # mark as recently used
+        except OSError:
+            pass
+        return manifest["digest"]
+
+    def store(self, stage, fp, patient_output, relpaths, exclude=()):
+        """
+        Copy a finished stage's artifacts into the cache.
+        Returns their content digest (also when fp is None and nothing is stored).
+        """
+        files = _walk_files(patient_output, relpaths, exclude)
+        digest = content_digest(patient_output, relpaths, exclude)
+        if fp is None or not files:
+            return digest
+
+        entry = self._entry_dir(stage, fp)
+        if os.path.exists(entry):
+            return digest
+
+        tmp = os.path.join(self.cache_dir, stage, f".tmp-{uuid.uuid4().hex}")
+        size = 0
+        for rel, path in files:
+            dst = os.path.join(tmp, "files", rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(path, dst)
+            size += os.path.getsize(dst)
+        with open(os.path.join(tmp, "manifest.json"), "w") as f:
+            json.dump({"stage": stage, "fingerprint": fp, "digest": digest, "size": size,
+                       "artifacts": list(relpaths), "exclude": list(exclude),
+                       "files": [rel for rel, _ in files], "created": time.time()}, f, indent=2)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)  # another worker stored it first
+
+        self.evict()
+        return digest
+
+    def entries(self):
+        """(last_used, size, stage, entry path) of every cache entry."""
+        found = []
+        for stage in sorted(os.listdir(self.cache_dir)):
+            stage_dir = os.path.join(self.cache_dir, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for fp in os.listdir(stage_dir):
+                path = os.path.join(stage_dir, fp)
+                manifest_path = os.path.join(path, "manifest.json")
+                try:
+                    if os.path.isfile(path):
+                        st = os.stat(path)
+                        found.append((st.st_mtime, st.st_size, stage, path))
+                        continue
+                    with open(manifest_path) as f:
+                        size = json.load(f)["size"]
+                    found.append((os.path.getmtime(manifest_path), size, stage, os.path.join(stage_dir, fp)))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return found
+
+    def evict(self, max_bytes=None):
+        """Remove least recently used entries until the cache fits in max_bytes. Returns bytes freed."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        freed = 0
+        for _, size, _, entry in entries:
+            if total - freed <= max_bytes:
+                break
+            if os.path.isdir(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                try:
+                    os.remove(entry)
+                except OSError:
+                    continue
+            freed += size
+        return freed
+
+    def invalidate(self, stage, fp=None):
+        """Drop every cached result of a stage (or one fingerprint), leaving other stages intact."""
+        target = self._entry_dir(stage, fp) if fp else os.path.join(self.cache_dir, stage)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Inspect or trim the pipeline result cache")
+    parser.add_argument("cache_dir", help="Cache folder")
+    parser.add_argument("--invalidate", metavar="STAGE", choices=sorted(STAGE_VERSIONS) + ["llm"],
+                        help="Drop all cached results of one stage (or the LLM answers)")
+    parser.add_argument("--max-gb", type=float, help="Evict least recently used entries down to this size")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.cache_dir):
+        print(f"❌ Cache folder does not exist: {args.cache_dir}")
+        sys.exit(1)
+
+    cache = ResultCache(args.cache_dir)
+    if args.invalidate:
+        cache.invalidate(args.invalidate)
+        print(f"Invalidated stage: {args.invalidate}")
+    if args.max_gb is not None:
+        freed = cache.evict(int(args.max_gb * 1024 ** 3))
+        print(f"Evicted {freed / 1024 ** 2:.1f} MB")
+
+    per_stage = {}
+    for _, size, stage, _ in cache.entries():
+        count, total = per_stage.get(stage, (0, 0))
+        per_stage[stage] = (count + 1, total + size)
+    for stage, (count, total) in per_stage.items():
+        print(f"{stage:<14} {count:>6} entries {total / 1024 ** 2:>10.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+# results_store.py
+import os
+import time
+import socket
+import shutil
+import sqlite3
+import tarfile
+import argparse
+
+from nifti_io import GZIP_LEVEL, GZIP_WORKERS, ParallelGzipWriter
+
+# Retention policy, all optional (unset = no limit on that axis)
+MAX_PATIENTS = os.environ.get("SARC_RESULTS_MAX_PATIENTS")        # patients kept with all their files
+MAX_GB = os.environ.get("SARC_RESULTS_MAX_GB", "50")              # total size of results/
+MAX_AGE_DAYS = os.environ.get("SARC_RESULTS_MAX_AGE_DAYS")        # unused for longer -> trimmed
+ARCHIVE = os.environ.get("SARC_RESULTS_ARCHIVE", "") not in ("", "0")  # compress cold patients instead
+
+# A pin left by a run that crashed or was killed is dropped once its process is gone
+# (checked on POSIX, same host) or, in any case, after this many hours
+PIN_HOURS = float(os.environ.get("SARC_RESULTS_PIN_HOURS", "24"))
+
+INDEX_NAME = ".results_index.sqlite"
+ARCHIVE_NAME = "archive.tar.gz"
+
+# Eviction tiers, lowest evicted first: large intermediates, then overlays/profiles.
+# Tier 2 (reports, measurements, status, logs) is only removed with the whole patient.
+# With archiving, cold patients keep everything compressed except report, DOCX and status.
+TIER_INTERMEDIATE, TIER_DERIVED, TIER_KEEP = 0, 1, 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    name TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'full',
+    pinned_by TEXT,
+    pinned_at REAL
+);
+CREATE INDEX IF NOT EXISTS patients_last_used ON patients(last_used);
+CREATE TABLE IF NOT EXISTS artifacts (
+    patient TEXT NOT NULL,
+    relpath TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    tier INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    PRIMARY KEY (patient, relpath)
+);
+CREATE INDEX IF NOT EXISTS artifacts_tier ON artifacts(tier, patient);
+"""
+
+
+def _owner():
+    """Pin owner of this process: host:pid."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _owner_alive(owner):
+    host, _, pid = (owner or "").rpartition(":")
+    if os.name != "posix" or host != socket.gethostname() or not pid.isdigit():
+        return True  # cannot tell: only the age limit applies
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def classify(relpath):
+    """(kind, tier) of a file inside a patient folder."""
+    parts = relpath.replace("\\", "/").split("/")
+    name = parts[-1]
+    if parts[0] == "nifti":
+        return "nifti", TIER_INTERMEDIATE
+    if parts[0] == "segmentation":
+        if name.endswith((".nii", ".nii.gz")):
+            return "segmentation", TIER_INTERMEDIATE
+        return "measurements", TIER_KEEP
+    if parts[0] == "overlays":
+        return "overlays", TIER_DERIVED
+    if parts[0] == "profile":
+        return "profile", TIER_DERIVED
+    if name == "report.csv":
+        return "report", TIER_KEEP
+    if name.endswith(".docx"):
+        return "docx", TIER_KEEP
+    if name == ARCHIVE_NAME:
+        return "archive", TIER_KEEP
+    return "other", TIER_KEEP
+
+
+class RetentionPolicy:
+    """
+    max_patients: most recently used patients kept with all their files; older ones are trimmed.
+    max_bytes: total size of the store; trimmed oldest-first, whole patients removed last.
+    max_age_days: patients unused for longer are trimmed.
+    archive: compress cold patients into <patient>/archive.tar.gz instead of deleting their intermediates.
+    """
+
+    def __init__(self, max_patients=None, max_bytes=None, max_age_days=None, archive=False):
+        self.max_patients = max_patients
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.archive = archive
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_patients=int(MAX_PATIENTS) if MAX_PATIENTS else None,
+            max_bytes=int(float(MAX_GB) * 1024 ** 3) if MAX_GB else None,
+            max_age_days=float(MAX_AGE_DAYS) if MAX_AGE_DAYS else None,
+            archive=ARCHIVE,
+        )
+
+
+class ResultsStore:
+    """
+    SQLite index of patient folders under results/ and the files in them.
+
+    Runs register their patient when they start (pinned, never evicted) and
+    when they finish (file sizes recorded). enforce() then applies a
+    RetentionPolicy from the index alone, touching only what it evicts: large
+    intermediates (NIfTI, label volumes) go first, then overlays/profiles, and
+    only then whole patients. Reports, measurements and status stay with
+    trimmed patients.
+    """
+
+    def __init__(self, results_dir, index_path=None):
+        self.results_dir = os.path.abspath(results_dir)
+        os.makedirs(self.results_dir, exist_ok=True)
+        self.index_path = index_path or os.path.join(self.results_dir, INDEX_NAME)
+        migrate = not os.path.exists(self.index_path)
+        self.conn = sqlite3.connect(self.index_path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(patients)")}
+        for column, kind in (("pinned_by", "TEXT"), ("pinned_at", "REAL")):
+            if column not in columns:  # index written before pins recorded their owner
+                self.conn.execute(f"ALTER TABLE patients ADD COLUMN {column} {kind}")
+        if migrate:  # first use on an existing results/ folder: index what is already there
+            self.rebuild()
+
+    def close(self):
+        self.conn.close()
+
+    def _patient_dir(self, name):
+        return os.path.join(self.results_dir, name)
+
+    # -- registration -----------------------------------------------------
+    def begin(self, name):
+        """Mark a patient as in use (pinned, by this process) for the duration of a run."""
+        now = time.time()
+        self.conn.execute(
+            "INSERT INTO patients (name, created, last_used, pinned, pinned_by, pinned_at) VALUES (?, ?, ?, 1, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET last_used = excluded.last_used, pinned = 1, "
+            "pinned_by = excluded.pinned_by, pinned_at = excluded.pinned_at", (name, now, now, _owner(), now))
+
+    def register(self, name, pinned=False):
+        """Record (only) this patient's files and sizes; unpins it unless pinned."""
+        folder = self._patient_dir(name)
+        rows = []
+        for root, _, files in os.walk(folder):
+            for f in files:
+                path = os.path.join(root, f)
+                rel = os.path.relpath(path, folder)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                rows.append((name, rel, *classify(rel), size))
+        now = time.time()
+        if any(r[2] == "archive" for r in rows):
+            state = "archived"
+        else:
+            state = "full" if any(r[3] < TIER_KEEP for r in rows) else "trimmed"
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(
+                "INSERT INTO patients (name, created, last_used, pinned, state, pinned_by, pinned_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET last_used = excluded.last_used, pinned = excluded.pinned, "
+                "state = excluded.state, pinned_by = excluded.pinned_by, pinned_at = excluded.pinned_at",
+                (name, now, now, int(pinned), state, _owner() if pinned else None, now if pinned else None))
+            self.conn.execute("DELETE FROM artifacts WHERE patient = ?", (name,))
+            self.conn.executemany("INSERT INTO artifacts VALUES (?, ?, ?, ?, ?)", rows)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return sum(r[4] for r in rows)
+
+    def touch(self, name):
+        self.conn.execute("UPDATE patients SET last_used = ? WHERE name = ?", (time.time(), name))
+
+    def unpin(self, name):
+        self.conn.execute("UPDATE patients SET pinned = 0, pinned_by = NULL, pinned_at = NULL WHERE name = ?", (name,))
+
+    def expire_pins(self, max_hours=PIN_HOURS):
+        """Unpin patients whose run is gone: its process no longer exists or the pin is too old."""
+        cutoff = time.time() - max_hours * 3600
+        stale = [name for name, owner, at in self.conn.execute(
+                     "SELECT name, pinned_by, pinned_at FROM patients WHERE pinned = 1").fetchall()
+                 if (at or 0) < cutoff or not _owner_alive(owner)]
+        self.conn.executemany("UPDATE patients SET pinned = 0, pinned_by = NULL, pinned_at = NULL WHERE name = ?",
+                              [(name,) for name in stale])
+        return stale
+
+    def rebuild(self):
+        """One-off full scan: index every patient folder already in results/ (migration)."""
+        names = [d for d in os.listdir(self.results_dir)
+                 if not d.startswith(".") and os.path.isdir(self._patient_dir(d))]
+        for name in names:
+            self.register(name)
+            mtime = os.path.getmtime(self._patient_dir(name))
+            self.conn.execute("UPDATE patients SET last_used = ?, created = MIN(created, ?) WHERE name = ?",
+                              (mtime, mtime, name))
+        self.conn.execute("DELETE FROM patients WHERE name NOT IN (%s)" % ",".join("?" * len(names)), names)
+        self.conn.execute("DELETE FROM artifacts WHERE patient NOT IN (SELECT name FROM patients)")
+        return len(names)
+
+    # -- queries ----------------------------------------------------------
+    def total_bytes(self):
+        return self.conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM artifacts").fetchone()[0]
+
+    def patients(self):
+        """(name, last_used, state, bytes) of every indexed patient, newest first."""
+        return self.conn.execute(
+            "SELECT p.name, p.last_used, p.state, COALESCE(SUM(a.bytes), 0) FROM patients p "
+            "LEFT JOIN artifacts a ON a.patient = p.name GROUP BY p.name ORDER BY p.last_used DESC").fetchall()
+
+    # -- eviction ---------------------------------------------------------
+    def _remove_artifacts(self, name, rows):
+        folder = self._patient_dir(name)
+        for relpath, _ in rows:
+            try:
+                os.remove(os.path.join(folder, relpath))
+            except FileNotFoundError:
+                pass
+        for sub in ("nifti", "overlays", "profile"):
+            path = os.path.join(folder, sub)
+            if os.path.isdir(path) and not os.listdir(path):
+                os.rmdir(path)
+        self.conn.executemany("DELETE FROM artifacts WHERE patient = ? AND relpath = ?",
+                              [(name, relpath) for relpath, _ in rows])
+        return sum(size for _, size in rows)
+
+    def trim(self, name, max_tier=TIER_DERIVED, archive=False):
+        """
+        Make a cold patient small: delete its files up to max_tier or, with archive,
+        compress them (and the other non-report files) into archive.tar.gz instead.
+        Returns bytes freed.
+        """
+        if archive:
+            return self.archive(name)
+        rows = self.conn.execute("SELECT relpath, bytes FROM artifacts WHERE patient = ? AND tier <= ?",
+                                 (name, max_tier)).fetchall()
+        freed = self._remove_artifacts(name, rows)
+        self.conn.execute("UPDATE patients SET state = 'trimmed' WHERE name = ? AND state = 'full'", (name,))
+        return freed
+
+    def archive(self, name):
+        """
+        Compress a patient's files into <patient>/archive.tar.gz, leaving the report,
+        DOCX and status.json readable next to it. This is the one place raw (.nii)
+        intermediates get gzipped: on SARC_GZIP_WORKERS threads at SARC_GZIP_LEVEL.
+        Returns bytes freed.
+        """
+        folder = self._patient_dir(name)
+        rows = self.conn.execute("SELECT relpath, bytes FROM artifacts WHERE patient = ? "
+                                 "AND kind NOT IN ('archive', 'report', 'docx') AND relpath != 'status.json'",
+                                 (name,)).fetchall()
+        if not rows:
+            return 0
+        archive_path = os.path.join(folder, ARCHIVE_NAME)
+        with open(archive_path + ".tmp", "wb") as f, ParallelGzipWriter(f, GZIP_LEVEL, GZIP_WORKERS) as gz, \
+                tarfile.open(fileobj=gz, mode="w|") as tar:
+            if os.path.exists(archive_path):  # keep what an earlier archive held
+                with tarfile.open(archive_path, "r:gz") as old:
+                    for member in old.getmembers():
+                        tar.addfile(member, old.extractfile(member) if member.isfile() else None)
+            for relpath, _ in rows:
+                tar.add(os.path.join(folder, relpath), arcname=relpath)
+        os.replace(archive_path + ".tmp", archive_path)
+        freed = self._remove_artifacts(name, rows)
+        for root, dirs, _ in os.walk(folder, topdown=False):
+            for d in dirs:
+                try:
+                    os.rmdir(os.path.join(root, d))
+                except OSError:
+                    pass
+        size = os.path.getsize(archive_path)
+        self.conn.execute("INSERT OR REPLACE INTO artifacts VALUES (?, ?, 'archive', ?, ?)",
+                          (name, ARCHIVE_NAME, TIER_KEEP, size))
+        self.conn.execute("UPDATE patients SET state = 'archived' WHERE name = ?", (name,))
+        return freed - size
+
+    def restore(self, name):
+        """Unpack <patient>/archive.tar.gz back into the patient folder."""
+        folder = self._patient_dir(name)
+        archive_path = os.path.join(folder, ARCHIVE_NAME)
+        with tarfile.open(archive_path, "r:gz") as tar:
+            tar.extractall(folder, filter="data")
+        os.remove(archive_path)
+        self.register(name)
+
+    def delete(self, name):
+        shutil.rmtree(self._patient_dir(name), ignore_errors=True)
+        freed = self.conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM artifacts WHERE patient = ?",
+                                  (name,)).fetchone()[0]
+        self.conn.execute("DELETE FROM artifacts WHERE patient = ?", (name,))
+        self.conn.execute("DELETE FROM patients WHERE name = ?", (name,))
+        return freed
+
+    def enforce(self, policy=None, log=None):
+        """
+        Apply the retention policy. Pinned patients (runs in progress) are never
+        touched; stale pins are expired first (expire_pins). Returns a list of
+        (patient, action, bytes freed).
+        """
+        policy = policy or RetentionPolicy.from_env()
+        log = log or (lambda msg: print(msg, end="", flush=True))
+        actions = []
+        self.conn.execute("BEGIN IMMEDIATE")  # one enforcer at a time across processes
+        try:
+            for name in self.expire_pins():
+                log(f"📌 {name}: run no longer active, unpinned\n")
+
+            def trim_where(sql, params):
+                for (name,) in self.conn.execute(sql, params).fetchall():
+                    actions.append((name, "archived" if policy.archive else "trimmed",
+                                    self.trim(name, archive=policy.archive)))
+
+            if policy.max_patients is not None:
+                trim_where("SELECT name FROM patients WHERE pinned = 0 AND state = 'full' AND name NOT IN "
+                           "(SELECT name FROM patients ORDER BY last_used DESC LIMIT ?)", (policy.max_patients,))
+            if policy.max_age_days is not None:
+                trim_where("SELECT name FROM patients WHERE pinned = 0 AND state = 'full' AND last_used < ?",
+                           (time.time() - policy.max_age_days * 86400,))
+
+            if policy.max_bytes is not None:
+                excess = self.total_bytes() - policy.max_bytes
+                # Intermediates, then overlays, of the least recently used patients first
+                # (with archiving, a patient's files go into its archive in one step)
+                for tier in (TIER_INTERMEDIATE, TIER_DERIVED):
+                    while excess > 0:
+                        row = self.conn.execute(
+                            "SELECT p.name FROM patients p JOIN artifacts a ON a.patient = p.name "
+                            "WHERE p.pinned = 0 AND a.tier = ? ORDER BY p.last_used LIMIT 1", (tier,)).fetchone()
+                        if row is None:
+                            break
+                        freed = self.trim(row[0], max_tier=tier, archive=policy.archive)
+                        actions.append((row[0], "archived" if policy.archive else "trimmed", freed))
+                        excess -= freed
+                # Still too big: whole patients, oldest first
+                while excess > 0:
+                    row = self.conn.execute("SELECT name FROM patients WHERE pinned = 0 "
+                                            "ORDER BY last_used LIMIT 1").fetchone()
+                    if row is None:
+                        break
+                    freed = self.delete(row[0])
+                    actions.append((row[0], "deleted", freed))
+                    excess -= freed
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        for name, action, freed in actions:
+            log(f"🧹 {name}: {action}, freed {freed / 1024 ** 2:.1f} MB\n")
+        return actions
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Results store: list patients and apply a retention policy")
+    parser.add_argument("results_dir", help="Results folder")
+    parser.add_argument("--rebuild", action="store_true", help="Index every existing patient folder first")
+    parser.add_argument("--max-patients", type=int, help="Keep all files of only this many recent patients")
+    parser.add_argument("--max-gb", type=float, help="Keep the results folder below this size")
+    parser.add_argument("--max-age-days", type=float, help="Trim patients unused for longer than this")
+    parser.add_argument("--archive", action="store_true", help="Compress cold patients into archive.tar.gz instead")
+    parser.add_argument("--restore", metavar="PATIENT", help="Unpack a patient's archive.tar.gz")
+    args = parser.parse_args()
+
+    store = ResultsStore(args.results_dir)
+    if args.rebuild:
+        print(f"✅ Indexed {store.rebuild()} patient folder(s)")
+    if args.restore:
+        store.restore(args.restore)
+        print(f"✅ Restored {args.restore}")
+        return
+
+    if any(v is not None for v in (args.max_patients, args.max_gb, args.max_age_days)):
+        policy = RetentionPolicy(args.max_patients, int(args.max_gb * 1024 ** 3) if args.max_gb else None,
+                                 args.max_age_days, args.archive)
+        store.enforce(policy)
+
+    for name, last_used, state, size in store.patients():
+        print(f"   {name:<30}{state:<10}{size / 1024 ** 2:>10.1f} MB  {time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used))}")
+    print(f"   total {store.total_bytes() / 1024 ** 3:.2f} GB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,100 +1,274 @@
 import os
 import sys
+import json
 import types
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 if "pyarrow" not in sys.modules:
     fake_pa = types.ModuleType("pyarrow")
     fake_pa.__version__ = "0.0.0"
     sys.modules["pyarrow"] = fake_pa
 
+import numpy as np
 import pandas as pd
 
-def calculate_sarcopenia(patient_folder: str, output_csv: str):
+# SMI cutoffs. A row matches when sex and population equal the patient's
+# value (or are "*") and bmi_min <= BMI < bmi_max; the most specific match wins.
+DEFAULT_THRESHOLDS = pd.DataFrame([
+    {"sex": "M", "population": "*", "bmi_min": -np.inf, "bmi_max": np.inf, "smi_cutoff": 52.4},
+    {"sex": "F", "population": "*", "bmi_min": -np.inf, "bmi_max": np.inf, "smi_cutoff": 38.5},
+    {"sex": "*", "population": "*", "bmi_min": -np.inf, "bmi_max": np.inf, "smi_cutoff": 45.0},
+])
+
+REPORT_COLUMNS = [
+    "ID", "PatientName", "Sex", "Age", "Height_cm", "Weight_kg", "SMI",
+    "MuscleArea_mm2", "VfatArea_mm2", "SfatArea_mm2", "MfatArea_mm2", "Sarcopenia",
+]
+
+# Muscle-quality columns, reported when the body composition CSV has them
+# (written by body_composition.measure_patient)
+QUALITY_COLUMNS = {
+    "muscle_hu_mean": "MuscleHU_mean",
+    "muscle_hu_std": "MuscleHU_std",
+    "mfat_hu_mean": "IMAT_HU_mean",
+    "mfat_hu_std": "IMAT_HU_std",
+}
+
+
+def load_thresholds(path=None):
+    """
+    Load an SMI cutoff table from CSV or JSON (list of rows) with columns
+    sex, smi_cutoff and optionally population, bmi_min, bmi_max.
+    Without a path the built-in 52.4 / 38.5 / 45.0 table is returned.
+    """
+    if not path:
+        return DEFAULT_THRESHOLDS.copy()
+    if str(path).lower().endswith(".json"):
+        with open(path) as f:
+            table = pd.DataFrame(json.load(f))
+    else:
+        table = pd.read_csv(path)
+
+    if "smi_cutoff" not in table.columns:
+        raise ValueError(f"Threshold table {path} has no smi_cutoff column")
+    defaults = {"sex": "*", "population": "*", "bmi_min": -np.inf, "bmi_max": np.inf}
+    for col, value in defaults.items():
+        if col not in table.columns:
+            table[col] = value
+        table[col] = table[col].fillna(value)
+    table["sex"] = table["sex"].astype(str)
+    table["population"] = table["population"].astype(str)
+    return table[["sex", "population", "bmi_min", "bmi_max", "smi_cutoff"]]
+
+
+def _col(df, name, default=np.nan):
+    # object dtype keeps values as read (60 stays 60, not 60.0) when filling across columns
+    return df[name].astype(object) if name in df.columns else pd.Series(default, index=df.index, dtype=object)
+
+def _prefer(primary, fallback):
+    return primary.where(primary.notna(), fallback)
+
+def resolve_metadata(meta_df):
+    """
+    Vectorized fallbacks over a metadata frame: prefer user input, else the value
+    read from the scan (Gender/PatientSex, Age/PatientAge, Height/TableHeight,
+    Weight/ScannedWeight_kg).
+    """
+    return pd.DataFrame({
+        "PatientName": _prefer(_col(meta_df, "PatientName"), "NA"),
+        "Sex": _prefer(_col(meta_df, "Gender"), _col(meta_df, "PatientSex", "NA")),
+        "Age": _prefer(_col(meta_df, "Age"), _col(meta_df, "PatientAge", "NA")),
+        "Height_cm": pd.to_numeric(_prefer(_col(meta_df, "Height"), _col(meta_df, "TableHeight")), errors="coerce"),
+        "Weight_kg": _prefer(_col(meta_df, "Weight"), _col(meta_df, "ScannedWeight_kg", "NA")),
+        "Population": _prefer(_col(meta_df, "Population"), "*").astype(str),
+    }, index=meta_df.index)
+
+
+def score_frame(df, thresholds=None):
+    """
+    Score every row of a frame with ID, resolved metadata (see resolve_metadata)
+    and body composition areas at once. Rows without a height are dropped.
+    """
+    thresholds = DEFAULT_THRESHOLDS if thresholds is None else thresholds
+    df = df[df["Height_cm"].notna()].copy()
+
+    height_m2 = (df["Height_cm"] / 100.0) ** 2
+    df["SMI"] = df["MuscleArea_mm2"] / height_m2
+    bmi = pd.to_numeric(df["Weight_kg"], errors="coerce") / height_m2
+
+    # Most specific rows first: concrete sex / population beat "*"
+    order = (thresholds["sex"].ne("*").astype(int) * 2 + thresholds["population"].ne("*").astype(int))
+    cutoff = pd.Series(np.nan, index=df.index)
+    sex = df["Sex"].astype(str)
+    population = df["Population"].astype(str)
+    for _, row in thresholds.loc[order.sort_values(ascending=False, kind="stable").index].iterrows():
+        match = cutoff.isna()
+        if row["sex"] != "*":
+            match &= sex.eq(row["sex"])
+        if row["population"] != "*":
+            match &= population.eq(row["population"])
+        if np.isfinite(row["bmi_min"]) or np.isfinite(row["bmi_max"]):
+            match &= bmi.ge(row["bmi_min"]) & bmi.lt(row["bmi_max"])
+        cutoff[match] = row["smi_cutoff"]
+
+    df["SMI_cutoff"] = cutoff
+    df["Sarcopenia"] = np.where(df["SMI"] < cutoff, "Yes", np.where(cutoff.isna(), "NA", "No"))
+    df["SMI"] = df["SMI"].round(2)
+    return df
+
+
+def _read_patient(patient_folder):
+    seg_dir = os.path.join(patient_folder, "segmentation")
+    bodycomp_path = os.path.join(seg_dir, "body_composition_2d.csv")
+    metadata_path = os.path.join(seg_dir, "metadata.csv")
+    if not os.path.exists(bodycomp_path) or not os.path.exists(metadata_path):
+        return None
+    body_df = pd.read_csv(bodycomp_path)
+    meta_df = pd.read_csv(metadata_path)
+    if body_df.empty or meta_df.empty:
+        return None
+
+    row = meta_df.iloc[[0]].reset_index(drop=True)
+    body = body_df.iloc[[0]].reset_index(drop=True)
+    row["MuscleArea_mm2"] = body["muscle_area_mm2"]
+    for src, dst in (("vfat_area_mm2", "VfatArea_mm2"), ("sfat_area_mm2", "SfatArea_mm2"),
+                     ("mfat_area_mm2", "MfatArea_mm2")):
+        row[dst] = body[src] if src in body.columns else 0
+    for src, dst in QUALITY_COLUMNS.items():
+        if src in body.columns:
+            row[dst] = body[src]
+    row["ID"] = os.path.basename(os.path.normpath(patient_folder))
+    return row
+
+def _ensure_body_composition(patient_folder):
+    """
+    The body_composition_2d.csv that predict_muscle_fat.py writes (with its own
+    L3 pick) is used as is; this is the default path. Only when the segmentation
+    step left a label NIfTI but no such CSV (the warm worker) is body composition
+    measured in-process (body_composition.py), at the slice in nifti/l3.json.
+    Raises ValueError when that record is missing: scoring another level would be wrong.
+    """
+    seg_dir = os.path.join(patient_folder, "segmentation")
+    if os.path.exists(os.path.join(seg_dir, "body_composition_2d.csv")):
+        return
+    if not os.path.isdir(os.path.join(patient_folder, "nifti")) or not os.path.isdir(seg_dir):
+        return
+    from body_composition import measure_patient  # nibabel is only needed on this path
+    try:
+        measure_patient(patient_folder)
+    except ValueError:
+        raise
+    except Exception as e:
+        print(f"Could not measure body composition in {patient_folder}: {e}")
+
+def _report_columns(df):
+    return REPORT_COLUMNS + [c for c in QUALITY_COLUMNS.values() if c in df.columns]
+
+def load_cohort(patient_folders, workers=16):
+    """
+    Read body_composition_2d.csv and metadata.csv of many patient folders into
+    one frame (one row per patient, raw metadata columns plus areas).
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        rows = [r for r in pool.map(_read_patient, patient_folders) if r is not None]
+    if not rows:
+        return pd.DataFrame()
+    return pd.concat(rows, ignore_index=True, sort=False)
+
+def score_cohort(patient_folders, thresholds=None, workers=16):
+    """Load and score many patient folders in one vectorized pass. Returns the report frame."""
+    raw = load_cohort(patient_folders, workers=workers)
+    if raw.empty:
+        return pd.DataFrame(columns=REPORT_COLUMNS)
+
+    df = resolve_metadata(raw)
+    for col in ["ID", "MuscleArea_mm2", "VfatArea_mm2", "SfatArea_mm2", "MfatArea_mm2"] + \
+            [c for c in QUALITY_COLUMNS.values() if c in raw.columns]:
+        df[col] = raw[col]
+    scored = score_frame(df, thresholds)
+    skipped = len(df) - len(scored)
+    if skipped:
+        print(f"Missing height for {skipped} patient(s), skipping...")
+    return scored[_report_columns(scored) + ["SMI_cutoff"]].reset_index(drop=True)
+
+def patient_folders_under(results_dir):
+    """Every patient folder under a results directory that has a segmentation/ subfolder."""
+    return sorted(
+        os.path.join(results_dir, d) for d in os.listdir(results_dir)
+        if os.path.isdir(os.path.join(results_dir, d, "segmentation"))
+    )
+
+
+def calculate_sarcopenia(patient_folder: str, output_csv: str, thresholds=None):
     """
     Rule-based sarcopenia calculation for a single patient folder.
     Expected structure:
       patient_folder/
         segmentation/
-          body_composition_2d.csv
-          metadata.csv
+          body_composition_2d.csv   (from segmentation; when missing, measured
+          metadata.csv               in-process at the nifti/l3.json slice)
     """
 
     seg_dir = os.path.join(patient_folder, "segmentation")
     bodycomp_path = os.path.join(seg_dir, "body_composition_2d.csv")
     metadata_path = os.path.join(seg_dir, "metadata.csv")
+    _ensure_body_composition(patient_folder)
 
     if not os.path.exists(bodycomp_path) or not os.path.exists(metadata_path):
         print(f"Missing files in {seg_dir}")
         return
 
-    # Load files
-    body_df = pd.read_csv(bodycomp_path)
-    meta_df = pd.read_csv(metadata_path)
-
-    if body_df.empty or meta_df.empty:
+    raw = _read_patient(patient_folder)
+    if raw is None:
         print(f"Empty files in {seg_dir}, skipping...")
         return
 
-    meta = meta_df.iloc[0]
-
-    # --- Handle missing (NaN) values: prefer user input, else fallback to scanned ---
-    patient_name = meta.get("PatientName", "NA")
-    sex = meta.get("Gender") if pd.notna(meta.get("Gender")) else meta.get("PatientSex", "NA")
-    age = meta.get("Age") if pd.notna(meta.get("Age")) else meta.get("PatientAge", "NA")
-    height_cm = meta.get("Height") if pd.notna(meta.get("Height")) else meta.get("TableHeight", None)
-    weight_kg = meta.get("Weight") if pd.notna(meta.get("Weight")) else meta.get("ScannedWeight_kg", "NA")
+    df = resolve_metadata(raw)
+    for col in ["ID", "MuscleArea_mm2", "VfatArea_mm2", "SfatArea_mm2", "MfatArea_mm2"] + \
+            [c for c in QUALITY_COLUMNS.values() if c in raw.columns]:
+        df[col] = raw[col]
+    scored = score_frame(df, thresholds)
 
-    # --- Body composition ---
-    muscle_area = body_df["muscle_area_mm2"].iloc[0]
-    vfat_area = body_df.get("vfat_area_mm2", pd.Series([0])).iloc[0]
-    sfat_area = body_df.get("sfat_area_mm2", pd.Series([0])).iloc[0]
-    mfat_area = body_df.get("mfat_area_mm2", pd.Series([0])).iloc[0]
-
-    if pd.isna(height_cm):
-        print(f"Missing height for {patient_name}, skipping...")
+    if scored.empty:
+        print(f"Missing height for {df['PatientName'].iloc[0]}, skipping...")
         return
 
-    # Convert to m²
-    height_m2 = (height_cm / 100.0) ** 2
-    smi = muscle_area / height_m2
-
-    # --- Rule-based threshold ---
-    if sex == "M":
-        sarcopenia = smi < 52.4
-    elif sex == "F":
-        sarcopenia = smi < 38.5
-    else:
-        sarcopenia = smi < 45.0
-
-    result = {
-        "ID": os.path.basename(patient_folder),
-        "PatientName": patient_name,
-        "Sex": sex,
-        "Age": age,
-        "Height_cm": height_cm,
-        "Weight_kg": weight_kg,
-        "SMI": round(smi, 2),
-        "MuscleArea_mm2": muscle_area,
-        "VfatArea_mm2": vfat_area,
-        "SfatArea_mm2": sfat_area,
-        "MfatArea_mm2": mfat_area,
-        "Sarcopenia": "Yes" if sarcopenia else "No"
-    }
-
     # Save results
-    pd.DataFrame([result]).to_csv(output_csv, index=False)
+    scored[_report_columns(scored)].to_csv(output_csv, index=False)
     print(f"✅ Saved sarcopenia predictions to {output_csv}")
 
 
 def main():
     """CLI entrypoint"""
-    if len(sys.argv) < 3:
-        print("❌ Usage: python rule_based_sarcopenia.py <patient_folder> <output_csv>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Rule-based sarcopenia scoring")
+    parser.add_argument("patient_folder", help="Patient folder (with --cohort: results folder holding many patients)")
+    parser.add_argument("output_csv", help="Output report CSV")
+    parser.add_argument("--cohort", action="store_true",
+                        help="Score every patient under patient_folder into one CSV")
+    parser.add_argument("--thresholds", help="SMI cutoff table (CSV or JSON), default: built-in 52.4/38.5/45.0")
+    parser.add_argument("--write-reports", action="store_true",
+                        help="With --cohort, also rewrite each patient's report.csv")
+    args = parser.parse_args()
+
+    thresholds = load_thresholds(args.thresholds)
+    if not args.cohort:
+        try:
+            calculate_sarcopenia(args.patient_folder, args.output_csv, thresholds)
+        except ValueError as e:
+            print(f"❌ Cannot score {args.patient_folder}: {e}")
+            sys.exit(1)
+        return
+
+    folders = patient_folders_under(args.patient_folder)
+    report = score_cohort(folders, thresholds)
+    report.to_csv(args.output_csv, index=False)
+    print(f"✅ Scored {len(report)} of {len(folders)} patients into {args.output_csv}")
 
-    patient_folder = sys.argv[1]
-    output_csv = sys.argv[2]
-    calculate_sarcopenia(patient_folder, output_csv)
+    if args.write_reports:
+        for _, row in report.iterrows():
+            row[_report_columns(report)].to_frame().T.to_csv(
+                os.path.join(args.patient_folder, row["ID"], "report.csv"), index=False)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
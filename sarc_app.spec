@@ -16,35 +16,42 @@ if sys.platform == "win32":
     binaries = [
         (shutil.which("dcm2niix"), "."),
         (shutil.which("TotalSegmentator"), "."),
-        (shutil.which("pandoc"), "."),
     ]
 else:
     binaries = [
         ("/Users/jishaansayyed/Documents/SarcopeniaDetectionTool/test_env/bin/dcm2niix", "."),
         ("/Users/jishaansayyed/Documents/SarcopeniaDetectionTool/test_env/bin/TotalSegmentator", "."),
-        ("/opt/homebrew/bin/pandoc", "."),
     ]
 
 # --------------------------------------------------------------------
 # Datas (shared between mac + win)
 # --------------------------------------------------------------------
+# Scripts run as subprocesses via resource_path() are not analysed by PyInstaller,
+# so they and every local module they import must be listed here
 datas = [
     ("DiCOM_to_nifti.py", "."),
+    ("dicom_utils.py", "."),  # imported by DiCOM_to_nifti.py
     ("DiCOM_to_nifti.sh", "."),
     ("rule_based_sarcopenia.py", "."),
     ("ai_api.py", "."),
+    ("docx_report.py", "."),
     ("overlay_utils.py", "."),
     ("CT-Muscle-and-Fat-Segmentation", "CT-Muscle-and-Fat-Segmentation"),
     ("results", "results"),
     ("binary_utils.py", "."),
+    ("dicom_reader.py", "."),  # imported by DiCOM_to_nifti.py (--backend native)
+    ("nifti_io.py", "."),  # imported by DiCOM_to_nifti.py, seg_worker.py, body_composition.py
+    ("dicom_index.py", "."),  # imported by DiCOM_to_nifti.py (--index)
+    ("seg_worker.py", "."),  # warm segmentation worker client (SARC_SEG_WORKER)
+    ("body_composition.py", "."),  # imported by rule_based_sarcopenia.py
+    ("overlay_render.py", "."),  # imported by overlay_utils.py (used by body_composition.py)
 ]
 
-# Huggingface/pypandoc/pandas/pyarrow support
+# Huggingface/pandas/pyarrow support
 hiddenimports = []
 hiddenimports += collect_submodules("pandas")
 datas += collect_data_files("pandas")
 datas += collect_data_files("pyarrow")
-datas += collect_all("pypandoc")[0]
 datas += collect_all("huggingface_hub")[0]
 
 block_cipher = None
@@ -0,0 +1,293 @@
+# seg_worker.py
+import os
+import sys
+import queue
+import secrets
+import argparse
+import threading
+import importlib
+import traceback
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+import nibabel as nib
+from overlay_utils import find_nii
+from nifti_io import load_nifti, nifti_stem
+
+DEFAULT_ADDRESS = os.environ.get("SARC_SEG_WORKER", "127.0.0.1:6010")
+# Requests are unpickled, so every connection must prove it knows the key:
+# SARC_SEG_AUTHKEY if set, otherwise a random key that serve writes to a 0600 file
+AUTHKEY_FILE = os.environ.get("SARC_SEG_AUTHKEY_FILE", os.path.join(os.path.expanduser("~"), ".sarc_seg_worker.key"))
+
+# Model loaded by serve; clients name the model they expect and the worker refuses
+# jobs for another one (the pipeline's segmentation cache key includes it)
+SEG_MODEL = os.environ.get("SARC_SEG_MODEL", "stub")
+
+# Slices inferred per model call, gathered across all queued patients
+BATCH_SLICES = 32
+
+
+class StubModel:
+    """
+    Threshold "model" standing in for the network in tests and benchmarks:
+    muscle HU range -> 1, fat HU range -> 2. predict takes and returns [N, X, Y].
+    """
+
+    def predict(self, batch):
+        labels = np.zeros(batch.shape, dtype=np.uint8)
+        labels[(batch >= -29) & (batch <= 150)] = 1
+        labels[(batch >= -190) & (batch <= -30)] = 2
+        return labels
+
+
+def load_model(spec):
+    """
+    "stub" for StubModel, otherwise "package.module:factory" where factory()
+    loads the checkpoint once and returns an object with predict(batch) -> labels.
+    """
+    if spec == "stub":
+        return StubModel()
+    module_name, _, attr = spec.partition(":")
+    if not attr:
+        raise ValueError(f"Model spec must be 'stub' or 'module:factory', got {spec!r}")
+    return getattr(importlib.import_module(module_name), attr)()
+
+
+def read_authkey(path=AUTHKEY_FILE, create=False):
+    """
+    The shared authkey: SARC_SEG_AUTHKEY, else the key in path. With create, a
+    random key is written there (mode 0600) when the file does not exist yet.
+    """
+    if os.environ.get("SARC_SEG_AUTHKEY"):
+        return os.environ["SARC_SEG_AUTHKEY"].encode()
+    if create and not os.path.exists(path):
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass  # another worker created it first
+        else:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+    try:
+        if os.name == "posix" and os.stat(path).st_mode & 0o077:
+            raise PermissionError(f"{path} is readable by other users; chmod 600 it")
+        with open(path) as f:
+            key = f.read().strip()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"No worker key at {path}: start 'seg_worker.py serve' first or set SARC_SEG_AUTHKEY")
+    if not key:
+        raise ValueError(f"Worker key file {path} is empty")
+    return key.encode()
+
+
+def parse_address(address):
+    """'host:port' -> (host, port); anything else (a socket path) is used as-is."""
+    if isinstance(address, tuple):
+        return address
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return host or "127.0.0.1", int(port)
+    return address
+
+
+class _Job:
+    def __init__(self, input_dir, output_dir):
+        ct_path = find_nii(input_dir)
+        if not ct_path:
+            raise FileNotFoundError(f"No NIfTI found in {input_dir}")
+        self.ct_path = ct_path
+        self.output_dir = output_dir
+        self.img = load_nifti(ct_path)
+        self.labels = np.zeros(self.img.shape[:3], dtype=np.uint8)
+        self.next_slice = 0
+        self.done_slices = 0
+        self.failed = False
+        self.events = queue.Queue()
+
+    @property
+    def total(self):
+        return self.labels.shape[2]
+
+    def take(self, n):
+        """Next up to n slices as [k, X, Y] float32 plus their indices."""
+        z0 = self.next_slice
+        z1 = min(self.total, z0 + n)
+        self.next_slice = z1
+        chunk = np.asarray(self.img.dataobj[:, :, z0:z1], dtype=np.float32)
+        return np.moveaxis(chunk, 2, 0), range(z0, z1)
+
+    def save(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        # Labels are stored like the CT: uncompressed next to a raw .nii, gzipped otherwise
+        ext = ".nii" if self.ct_path.endswith(".nii") else ".nii.gz"
+        out_path = os.path.join(self.output_dir, f"{nifti_stem(self.ct_path)}_seg{ext}")
+        seg = nib.Nifti1Image(self.labels, self.img.affine, self.img.header)
+        seg.set_data_dtype(np.uint8)
+        seg.header.set_slope_inter(1, 0)
+        nib.save(seg, out_path)
+        # Measurements derived from an earlier segmentation are stale now
+        for stale in ("body_composition_2d.csv", "body_composition_profile.csv"):
+            if os.path.exists(os.path.join(self.output_dir, stale)):
+                os.remove(os.path.join(self.output_dir, stale))
+        return out_path
+
+
+class SegmentationWorker:
+    """
+    Long-lived segmentation server: loads the model once, accepts jobs over a local
+    socket and runs inference on batches of slices drawn from every queued patient.
+    """
+
+    def __init__(self, model, address=DEFAULT_ADDRESS, authkey=None, batch_slices=BATCH_SLICES, model_spec=SEG_MODEL):
+        self.model = model
+        self.model_spec = model_spec
+        self.address = parse_address(address)
+        self.authkey = authkey or read_authkey(create=True)
+        self.batch_slices = batch_slices
+        self.jobs = queue.Queue()
+
+    def _infer_loop(self):
+        active = []
+        while True:
+            if not active:
+                active.append(self.jobs.get())  # idle: block for the next job
+            while True:
+                try:
+                    active.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Fill one batch with slices from as many patients as needed
+            parts, budget = [], self.batch_slices
+            for job in active:
+                if budget <= 0:
+                    break
+                if not job.failed and job.next_slice < job.total:
+                    try:
+                        slices, idx = job.take(budget)
+                    except Exception as e:
+                        job.events.put({"event": "error", "error": f"could not read slices: {e}"})
+                        job.failed = True
+                        continue
+                    parts.append((job, slices, idx))
+                    budget -= len(idx)
+
+            try:
+                labels = self.model.predict(np.concatenate([p[1] for p in parts], axis=0)) if parts else []
+            except Exception as e:
+                for job, _, _ in parts:
+                    job.events.put({"event": "error", "error": f"inference failed: {e}"})
+                    active.remove(job)
+                continue
+
+            offset = 0
+            for job, _, idx in parts:
+                job.labels[:, :, idx.start:idx.stop] = np.moveaxis(labels[offset:offset + len(idx)], 0, 2)
+                offset += len(idx)
+                job.done_slices += len(idx)
+                job.events.put({"event": "progress", "done": job.done_slices, "total": job.total})
+
+            for job in [j for j in active if j.failed or j.done_slices >= j.total]:
+                active.remove(job)
+                if job.failed:
+                    continue
+                try:
+                    job.events.put({"event": "done", "output": job.save()})
+                except Exception as e:
+                    job.events.put({"event": "error", "error": f"could not save segmentation: {e}"})
+
+    def _serve_client(self, conn):
+        try:
+            request = conn.recv()
+            if request.get("model") not in (None, self.model_spec):
+                conn.send({"event": "error", "error": f"worker runs model {self.model_spec!r}, "
+                                                      f"job expects {request['model']!r}"})
+                return
+            try:
+                job = _Job(request["input"], request["output"])
+            except Exception as e:
+                conn.send({"event": "error", "error": str(e)})
+                return
+            self.jobs.put(job)
+            conn.send({"event": "queued", "input": job.ct_path, "total": job.total})
+            while True:
+                event = job.events.get()
+                conn.send(event)
+                if event["event"] in ("done", "error"):
+                    break
+        except (EOFError, OSError):
+            pass  # client went away
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        threading.Thread(target=self._infer_loop, daemon=True).start()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"🧠 Segmentation worker listening on {self.address}", flush=True)
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, EOFError, OSError) as e:
+                    print(f"⚠️ Rejected connection: {e}", flush=True)
+                    continue
+                threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+
+
+def segment(input_dir, output_dir, address=DEFAULT_ADDRESS, authkey=None, on_event=None, model=SEG_MODEL):
+    """
+    Submit one CT (first NIfTI in input_dir) to a running worker and wait for it.
+    The worker refuses the job unless it runs model. Events (queued/progress)
+    are passed to on_event. Returns the segmentation path.
+    """
+    with Client(parse_address(address), authkey=authkey or read_authkey()) as conn:
+        conn.send({"input": os.path.abspath(input_dir), "output": os.path.abspath(output_dir), "model": model})
+        while True:
+            event = conn.recv()
+            if on_event:
+                on_event(event)
+            if event["event"] == "done":
+                return event["output"]
+            if event["event"] == "error":
+                raise RuntimeError(event["error"])
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Warm segmentation worker")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve = sub.add_parser("serve", help="Load the model once and serve segmentation jobs")
+    serve.add_argument("--model", default=SEG_MODEL, help="'stub' or 'module:factory' returning a model with predict()")
+    serve.add_argument("--address", default=DEFAULT_ADDRESS, help="host:port or socket path")
+    serve.add_argument("--batch-slices", type=int, default=BATCH_SLICES, help="Slices per inference call")
+
+    client = sub.add_parser("segment", help="Send one patient to a running worker")
+    client.add_argument("--input", required=True, help="Folder containing the CT NIfTI")
+    client.add_argument("--output", required=True, help="Segmentation output folder")
+    client.add_argument("--address", default=DEFAULT_ADDRESS, help="host:port or socket path")
+    client.add_argument("--model", default=SEG_MODEL, help="Model the worker must be running")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        model = load_model(args.model)
+        SegmentationWorker(model, args.address, batch_slices=args.batch_slices, model_spec=args.model).serve_forever()
+        return
+
+    def show(event):
+        if event["event"] == "queued":
+            print(f"Queued {event['input']} ({event['total']} slices)", flush=True)
+        elif event["event"] == "progress":
+            print(f"Segmenting: {100 * event['done'] // event['total']}% ({event['done']}/{event['total']})", flush=True)
+
+    try:
+        out_path = segment(args.input, args.output, args.address, on_event=show, model=args.model)
+    except Exception as e:
+        print(f"❌ Segmentation failed: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+    print(f"✅ Segmentation saved to {out_path}")
+
+
+if __name__ == "__main__":
+    main()
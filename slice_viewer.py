@@ -0,0 +1,274 @@
+# slice_viewer.py
+import os
+import sys
+import time
+import argparse
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from nifti_io import load_nifti
+from overlay_render import WINDOW_PRESETS, build_label_lut, render_overlay, window_to_uint8
+from overlay_utils import find_nii, read_axial_slice
+
+# Rendered slices kept in memory, and slices rendered ahead in the scroll direction
+CACHE_MB = int(os.environ.get("SARC_VIEWER_CACHE_MB", "256"))
+PREFETCH = int(os.environ.get("SARC_VIEWER_PREFETCH", "8"))
+
+# Larger slices are shown downsampled by an integer factor to fit this many pixels
+MAX_DISPLAY = 640
+
+
+class SliceCache:
+    """Thread-safe LRU of rendered slices, bounded by total bytes instead of entries."""
+
+    def __init__(self, max_bytes=CACHE_MB * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.bytes -= len(self._items.pop(key))
+            self._items[key] = value
+            self.bytes += len(value)
+            while self.bytes > self.max_bytes and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self.bytes -= len(old)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+
+def to_ppm(rgb):
+    """RGB uint8 [rows, cols, 3] as binary PPM bytes, which Tk's PhotoImage reads without PIL."""
+    rows, cols = rgb.shape[:2]
+    return b"P6 %d %d 255\n" % (cols, rows) + np.ascontiguousarray(rgb).tobytes()
+
+def display_orientation(slice_2d, max_size=MAX_DISPLAY):
+    """
+    [i, j] axial slice (as dcm2niix writes it) to [rows, cols] for display:
+    anterior at the top, patient's right on the left; downsampled to fit max_size.
+    """
+    view = slice_2d.T[::-1]
+    step = max(1, -(-max(view.shape[:2]) // max_size))
+    return view[::step, ::step]
+
+
+class SliceStack:
+    """
+    Lazily rendered axial slices of a patient's CT and segmentation. Slices are
+    read one at a time through the NIfTI proxies (int16 CT / uint8 labels, never
+    the whole float volume), rendered with the window/level and label colours of
+    overlay_render, and kept in a SliceCache. After every get() a background
+    thread renders the next PREFETCH slices in the direction of travel.
+    """
+
+    def __init__(self, patient_output, window="abdomen", labels=True, cache_mb=CACHE_MB, prefetch=PREFETCH):
+        ct_path = find_nii(os.path.join(patient_output, "nifti"))
+        if ct_path is None:
+            raise FileNotFoundError(f"No CT NIfTI in {patient_output}/nifti")
+        seg_path = find_nii(os.path.join(patient_output, "segmentation"))
+        self.ct = load_nifti(ct_path)
+        self.seg = load_nifti(seg_path) if seg_path else None
+        self.n_slices = self.ct.shape[2]
+        self.window = window
+        self.labels = labels and self.seg is not None
+        self.prefetch = prefetch
+        self.cache = SliceCache(cache_mb * 1024 ** 2)
+        self._lut = build_label_lut()
+        self._read_lock = threading.Lock()  # one reader per (gzip) file handle
+        self._wake = threading.Condition()
+        self._target = None  # (slice, step, settings) the prefetcher works towards
+        self._closed = False
+        self._thread = threading.Thread(target=self._prefetch_loop, name="sarc-viewer-prefetch", daemon=True)
+        self._thread.start()
+
+    def _key(self, k):
+        return k, self.window, self.labels
+
+    def render(self, k, window, labels):
+        """
+        Read and render slice k (no cache) with the given settings, which are
+        passed in rather than read from self so a configure() meanwhile cannot
+        change what is drawn under a cache key. Returns PPM bytes.
+        """
+        with self._read_lock:
+            ct_slice = read_axial_slice(self.ct, k)
+            seg_slice = read_axial_slice(self.seg, k) if labels and self.seg is not None else None
+        if seg_slice is None:
+            grey = display_orientation(window_to_uint8(ct_slice, window))
+            return to_ppm(np.repeat(grey[..., None], 3, axis=2))
+        return to_ppm(display_orientation(render_overlay(ct_slice, seg_slice, window, self._lut)))
+
+    def get(self, k, step=1):
+        """(PPM bytes of slice k, cache hit), then prefetch ahead of k in the direction of step."""
+        key = self._key(k)
+        ppm = self.cache.get(key)
+        hit = ppm is not None
+        if not hit:
+            ppm = self.render(*key)
+            self.cache.put(key, ppm)
+        with self._wake:
+            self._target = (k, 1 if step >= 0 else -1, key[1:])
+            self._wake.notify()
+        return ppm, hit
+
+    def configure(self, window=None, labels=None):
+        """Change window preset and/or label display; cached renders of the old settings are dropped."""
+        if window is not None:
+            self.window = window
+        if labels is not None:
+            self.labels = labels and self.seg is not None
+        self.cache.clear()
+
+    def close(self):
+        with self._wake:
+            self._closed = True
+            self._wake.notify()
+
+    def _prefetch_loop(self):
+        while True:
+            with self._wake:
+                while self._target is None and not self._closed:
+                    self._wake.wait()
+                if self._closed:
+                    return
+                target, self._target = self._target, None
+            k, step, settings = target
+            for i in range(1, self.prefetch + 1):
+                idx = k + i * step
+                if not 0 <= idx < self.n_slices or self._target is not None or self._closed:
+                    break  # end of volume, or the user moved on: start from the new position
+                key = (idx, *settings)
+                if settings != self._key(idx)[1:]:
+                    break  # window or labels changed since the request
+                if key in self.cache:
+                    continue
+                try:
+                    self.cache.put(key, self.render(*key))
+                except Exception:
+                    break
+
+
+class SliceViewer:
+    """
+    Tk panel scrolling through a patient's volume with the segmentation overlaid.
+    Mouse wheel, arrow keys, Page Up/Down and the slider move through the slices.
+    """
+
+    def __init__(self, master, patient_output):
+        import tkinter as tk
+        from tkinter import ttk
+        self.master = master
+        self.stack = SliceStack(patient_output)
+        self.k = self.stack.n_slices // 2
+        self._photo = None
+        master.title(f"Slices - {os.path.basename(os.path.normpath(patient_output))}")
+
+        controls = tk.Frame(master)
+        controls.pack(fill=tk.X, padx=5, pady=5)
+        tk.Label(controls, text="Window:").pack(side=tk.LEFT)
+        self.window_var = tk.StringVar(value=self.stack.window)
+        window_box = ttk.Combobox(controls, textvariable=self.window_var, values=list(WINDOW_PRESETS),
+                                  state="readonly", width=12)
+        window_box.pack(side=tk.LEFT, padx=5)
+        window_box.bind("<<ComboboxSelected>>", lambda e: self._configure(window=self.window_var.get()))
+        self.labels_var = tk.BooleanVar(value=self.stack.labels)
+        tk.Checkbutton(controls, text="Segmentation", variable=self.labels_var,
+                       command=lambda: self._configure(labels=self.labels_var.get()),
+                       state=tk.NORMAL if self.stack.seg is not None else tk.DISABLED).pack(side=tk.LEFT, padx=5)
+        self.status = tk.Label(controls, anchor="e")
+        self.status.pack(side=tk.RIGHT)
+
+        self.image = tk.Label(master, bg="black")
+        self.image.pack(fill=tk.BOTH, expand=True)
+        self.slider = tk.Scale(master, from_=0, to=self.stack.n_slices - 1, orient=tk.HORIZONTAL,
+                               showvalue=False, command=self._on_slider)
+        self.slider.pack(fill=tk.X, padx=5, pady=5)
+
+        master.bind("<MouseWheel>", lambda e: self.step(1 if e.delta > 0 else -1))  # Windows / macOS
+        master.bind("<Button-4>", lambda e: self.step(1))   # X11
+        master.bind("<Button-5>", lambda e: self.step(-1))
+        master.bind("<Up>", lambda e: self.step(1))
+        master.bind("<Down>", lambda e: self.step(-1))
+        master.bind("<Prior>", lambda e: self.step(10))
+        master.bind("<Next>", lambda e: self.step(-10))
+        master.protocol("WM_DELETE_WINDOW", self.close)
+        self.slider.set(self.k)
+        self.show(self.k)
+
+    def _on_slider(self, value):
+        if int(value) != self.k:
+            self.show(int(value))
+
+    def step(self, delta):
+        self.show(min(max(self.k + delta, 0), self.stack.n_slices - 1), step=delta)
+
+    def show(self, k, step=None):
+        import tkinter as tk
+        step = (k - self.k) if step is None else step
+        started = time.perf_counter()
+        ppm, hit = self.stack.get(k, step or 1)
+        self._photo = tk.PhotoImage(data=ppm, format="PPM")
+        self.image.configure(image=self._photo)
+        self.k = k
+        if self.slider.get() != k:
+            self.slider.set(k)
+        ms = (time.perf_counter() - started) * 1000
+        self.status.configure(text=f"Slice {k + 1}/{self.stack.n_slices}   {ms:.1f} ms {'(cached)' if hit else ''}   "
+                                   f"cache {self.stack.cache.bytes / 1024 ** 2:.0f}/{self.stack.cache.max_bytes / 1024 ** 2:.0f} MB")
+
+    def _configure(self, **settings):
+        self.stack.configure(**settings)
+        self.show(self.k)
+
+    def close(self):
+        self.stack.close()
+        self.master.destroy()
+
+
+def open_viewer(master, patient_output):
+    """Open a SliceViewer for a patient folder in its own window on top of master."""
+    import tkinter as tk
+    window = tk.Toplevel(master)
+    return SliceViewer(window, patient_output)
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Scroll through a patient's CT with the segmentation overlaid")
+    parser.add_argument("patient_folder", help="Patient results folder (with nifti/ and segmentation/)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.patient_folder):
+        print(f"❌ Not a folder: {args.patient_folder}")
+        sys.exit(1)
+    import tkinter as tk
+    root = tk.Tk()
+    SliceViewer(root, args.patient_folder)
+    root.mainloop()
+
+
+if __name__ == "__main__":
+    main()
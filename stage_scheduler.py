@@ -0,0 +1,250 @@
+# stage_scheduler.py
+import os
+import json
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+
+# Stage -> stages whose outputs it needs. Overlays only read the CT and the
+# segmentation, so they run alongside scoring (and the LLM request started
+# once report.csv exists); the report waits for both.
+STAGE_GRAPH = {
+    "conversion": (),
+    "segmentation": ("conversion",),
+    "scoring": ("segmentation",),
+    "overlays": ("segmentation",),
+    "report": ("scoring", "overlays"),
+}
+
+# Worker threads per stage, sized by what the stage is bound on. "intake" reads
+# the DICOM headers and writes metadata.csv before a patient's first stage.
+DEFAULT_POOLS = {
+    "intake": 2,
+    "conversion": 2,    # dcm2niix, each run already converts CONVERSION_WORKERS series at once
+    "segmentation": 1,  # model inference: one patient at a time on the GPU / warm worker
+    "scoring": 2,
+    "overlays": 2,
+    "report": 4,        # mostly waiting on the LLM
+}
+
+# Override pool sizes, e.g. SARC_STAGE_POOLS="segmentation=2,overlays=4"
+STAGE_POOLS = os.environ.get("SARC_STAGE_POOLS", "")
+
+CHECKPOINT_DIR = "checkpoints"
+
+# Stage states that let dependents run
+OK_STATES = ("done", "cached", "resumed")
+
+
+def pool_sizes(spec=STAGE_POOLS):
+    """DEFAULT_POOLS with the "stage=n,..." overrides of spec applied."""
+    sizes = dict(DEFAULT_POOLS)
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        stage, _, n = item.partition("=")
+        if stage.strip() not in sizes:
+            raise ValueError(f"Unknown stage pool: {stage}")
+        sizes[stage.strip()] = max(1, int(n))
+    return sizes
+
+
+# -- checkpoints -------------------------------------------------------------
+def _checkpoint_path(patient_output, stage):
+    return os.path.join(patient_output, CHECKPOINT_DIR, f"{stage}.json")
+
+def _artifact_files(patient_output, relpaths, exclude=()):
+    """{relpath: size} of every file under the given artifact paths."""
+    files = {}
+    for rel in relpaths:
+        path = os.path.join(patient_output, rel)
+        if os.path.isfile(path):
+            files[rel] = os.path.getsize(path)
+        for root, _, names in os.walk(path):
+            for name in names:
+                p = os.path.join(root, name)
+                r = os.path.relpath(p, patient_output)
+                if r not in exclude:
+                    files[r] = os.path.getsize(p)
+    return files
+
+def write_checkpoint(patient_output, stage, fingerprint, digest, relpaths, exclude=()):
+    """Mark a stage complete: its input fingerprint, output digest and output files/sizes."""
+    path = _checkpoint_path(patient_output, stage)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"stage": stage, "fingerprint": fingerprint, "digest": digest,
+                   "files": _artifact_files(patient_output, relpaths, exclude),
+                   "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}, f, indent=2)
+    os.replace(tmp, path)
+
+def read_checkpoint(patient_output, stage, fingerprint):
+    """
+    The stage's checkpoint if it was written for the same inputs (fingerprint)
+    and every output file it lists is still there with the same size, else None.
+    """
+    if fingerprint is None:
+        return None
+    try:
+        with open(_checkpoint_path(patient_output, stage)) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get("fingerprint") != fingerprint:
+        return None
+    for rel, size in checkpoint.get("files", {}).items():
+        try:
+            if os.path.getsize(os.path.join(patient_output, rel)) != size:
+                return None
+        except OSError:
+            return None
+    return checkpoint
+
+def clear_checkpoint(patient_output, stage):
+    try:
+        os.remove(_checkpoint_path(patient_output, stage))
+    except FileNotFoundError:
+        pass
+
+
+class StageScheduler:
+    """
+    Runs jobs (one per patient) through a graph of stages, each stage type on
+    its own thread pool. A stage is queued as soon as the stages it depends on
+    have finished, so independent stages of a patient run concurrently and
+    patients overlap: patient N+1 converts while patient N is segmenting.
+    When a stage fails, the stages depending on it are skipped.
+
+    A job provides prepare(), run_stage(stage) -> state ("done", "cached",
+    "resumed" or "failed"), skip_stage(stage, failed_dependencies) and
+    finish(states) -> result; submit() returns a Future of that result.
+    """
+
+    def __init__(self, graph=None, pools=None):
+        self.graph = dict(graph or STAGE_GRAPH)
+        sizes = pool_sizes() if pools is None else dict(DEFAULT_POOLS, **pools)
+        self._executors = {name: ThreadPoolExecutor(max_workers=sizes.get(name, 1), thread_name_prefix=f"sarc-{name}")
+                           for name in ("intake", *self.graph)}
+        self._dependents = {s: [t for t, deps in self.graph.items() if s in deps] for s in self.graph}
+        self._queued = dict.fromkeys(self._executors, 0)  # tasks waiting for a thread, per pool
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._active = 0
+
+    def submit(self, job):
+        """Queue a job; its stages run as their dependencies complete. Returns a Future."""
+        run = {"job": job, "future": Future(), "states": {}, "claimed": set()}
+        with self._lock:
+            self._active += 1
+        self._submit("intake", self._start, run)
+        return run["future"]
+
+    def active(self):
+        """Jobs submitted and not finished yet."""
+        with self._lock:
+            return self._active
+
+    def queue_depths(self):
+        """Tasks waiting for a free thread, per pool."""
+        with self._lock:
+            return dict(self._queued)
+
+    def wait(self):
+        """Block until every submitted job has finished."""
+        with self._idle:
+            while self._active:
+                self._idle.wait()
+
+    def shutdown(self, wait=True):
+        if wait:
+            self.wait()
+        for executor in self._executors.values():
+            executor.shutdown(wait=wait)
+
+    def _submit(self, pool, fn, *args):
+        with self._lock:
+            self._queued[pool] += 1
+
+        def task():
+            with self._lock:
+                self._queued[pool] -= 1
+            fn(*args)
+        self._executors[pool].submit(task)
+
+    def _start(self, run):
+        try:
+            run["job"].prepare()
+        except BaseException as e:
+            self._done(run, error=e)
+            return
+        for stage, deps in self.graph.items():
+            if not deps:
+                self._claim(run, stage)
+                self._submit(stage, self._run_stage, run, stage)
+
+    def _claim(self, run, stage):
+        with self._lock:
+            run["claimed"].add(stage)
+
+    def _run_stage(self, run, stage):
+        try:
+            state = run["job"].run_stage(stage)
+        except Exception:
+            state = "failed"
+        self._resolve(run, stage, state)
+
+    def _resolve(self, run, stage, state):
+        ready, blocked = [], []
+        with self._lock:
+            states = run["states"]
+            states[stage] = state
+            for t in self._dependents[stage]:
+                deps = self.graph[t]
+                if t in run["claimed"] or any(d not in states for d in deps):
+                    continue
+                run["claimed"].add(t)
+                failed = [d for d in deps if states[d] not in OK_STATES]
+                (blocked if failed else ready).append((t, failed))
+            finished = len(states) == len(self.graph)
+
+        for t, _ in ready:
+            self._submit(t, self._run_stage, run, t)
+        for t, failed in blocked:
+            try:
+                run["job"].skip_stage(t, failed)
+            except Exception:
+                pass
+            self._resolve(run, t, "skipped")
+        if finished:
+            try:
+                result = run["job"].finish(dict(run["states"]))
+            except BaseException as e:
+                self._done(run, error=e)
+            else:
+                self._done(run, result=result)
+
+    def _done(self, run, result=None, error=None):
+        if error is not None:
+            run["future"].set_exception(error)
+        else:
+            run["future"].set_result(result)
+        with self._idle:
+            self._active -= 1
+            self._idle.notify_all()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """Process-wide shared StageScheduler, so every run in the process shares the stage pools."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = StageScheduler()
+            metrics.IN_FLIGHT.set_function(_scheduler.active)
+            metrics.QUEUE_DEPTH.set_function(
+                lambda: {(pool,): n for pool, n in _scheduler.queue_depths().items()}, "scheduler")
+            metrics.start_exporters()
+        return _scheduler
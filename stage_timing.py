@@ -0,0 +1,216 @@
+# stage_timing.py
+import os
+import sys
+import json
+import time
+import argparse
+import cProfile
+import pstats
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Set SARC_PROFILE=1 to dump cProfile output for the in-process stages
+PROFILE = os.environ.get("SARC_PROFILE", "") not in ("", "0")
+
+# ru_maxrss is bytes on macOS, kilobytes on Linux
+_MAXRSS_TO_MB = 1 / (1024 * 1024) if sys.platform == "darwin" else 1 / 1024
+
+
+def _rusage(who):
+    if resource is None:
+        return None
+    return resource.getrusage(who)
+
+def _proc_io(path="/proc/self/io"):
+    """read_bytes/write_bytes (storage IO) and rchar/wchar from a /proc io file, where it exists."""
+    try:
+        with open(path) as f:
+            return {k: int(v) for k, v in (line.split(":") for line in f)}
+    except (OSError, ValueError):
+        return None
+
+
+class StageTimer:
+    """
+    Context manager measuring one pipeline stage. With the pipeline's stages and
+    patients running concurrently on threads of one process, scope "thread"
+    (default) only counts the calling thread: its CPU time (time.thread_time),
+    major faults (RUSAGE_THREAD) and IO (/proc/thread-self/io), where the OS
+    provides them. Work handed to other threads is not included, and there is no
+    per-thread peak RSS. Subprocesses are measured exactly when their rusage is
+    passed to add_child (see pipeline.run_command). Scope "process" measures the
+    whole process and every child that finished during the block, which is only
+    meaningful when nothing else runs in the process (benchmarks). With
+    profile_path the block also runs under cProfile and the stats are dumped there.
+    """
+
+    def __init__(self, stage, profile_path=None, scope="thread"):
+        self.stage = stage
+        self.profile_path = profile_path
+        self.scope = scope
+        self.record = {"stage": stage}
+        self._profiler = None
+        self._kids = []
+
+    def _usage(self):
+        """(cpu seconds, rusage or None, io dict or None) for the timer's scope."""
+        if self.scope == "process":
+            return time.process_time(), _rusage(resource.RUSAGE_SELF) if resource else None, _proc_io()
+        who = getattr(resource, "RUSAGE_THREAD", None)
+        return (time.thread_time(), _rusage(who) if who is not None else None,
+                _proc_io("/proc/thread-self/io"))
+
+    def add_child(self, rusage):
+        """Account the rusage of a subprocess the stage ran (from os.wait4)."""
+        self._kids.append(rusage)
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu, self._self, self._io = self._usage()
+        self._children = _rusage(resource.RUSAGE_CHILDREN) if resource and self.scope == "process" else None
+        self.record["started"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        if self.profile_path:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._profiler:
+            self._profiler.disable()
+            os.makedirs(os.path.dirname(self.profile_path), exist_ok=True)
+            self._profiler.dump_stats(self.profile_path)
+            self.record["profile"] = self.profile_path
+
+        r = self.record
+        cpu, now, io = self._usage()
+        r["wall_s"] = round(time.perf_counter() - self._wall, 4)
+        r["cpu_s"] = round(cpu - self._cpu, 4)
+        if now is not None and self._self is not None:
+            r["major_faults"] = now.ru_majflt - self._self.ru_majflt
+            if self.scope == "process":
+                # A process lifetime high-water mark, not per stage
+                r["peak_rss_mb"] = round(now.ru_maxrss * _MAXRSS_TO_MB, 1)
+        if self._children is not None:
+            kids = _rusage(resource.RUSAGE_CHILDREN)
+            r["children"] = {
+                "user_s": round(kids.ru_utime - self._children.ru_utime, 4),
+                "sys_s": round(kids.ru_stime - self._children.ru_stime, 4),
+                "peak_rss_mb": round(kids.ru_maxrss * _MAXRSS_TO_MB, 1),
+                "read_blocks": kids.ru_inblock - self._children.ru_inblock,
+                "write_blocks": kids.ru_oublock - self._children.ru_oublock,
+            }
+        elif self._kids:
+            r["children"] = {
+                "user_s": round(sum(k.ru_utime for k in self._kids), 4),
+                "sys_s": round(sum(k.ru_stime for k in self._kids), 4),
+                "peak_rss_mb": round(max(k.ru_maxrss for k in self._kids) * _MAXRSS_TO_MB, 1),
+                "read_blocks": sum(k.ru_inblock for k in self._kids),
+                "write_blocks": sum(k.ru_oublock for k in self._kids),
+            }
+        if io and self._io:
+            r["read_bytes"] = io.get("read_bytes", 0) - self._io.get("read_bytes", 0)
+            r["write_bytes"] = io.get("write_bytes", 0) - self._io.get("write_bytes", 0)
+            r["rchar"] = io.get("rchar", 0) - self._io.get("rchar", 0)
+            r["wchar"] = io.get("wchar", 0) - self._io.get("wchar", 0)
+        return False
+
+
+def profile_path_for(patient_output, stage):
+    """Where the cProfile dump of a stage goes (None when profiling is off)."""
+    return os.path.join(patient_output, "profile", f"{stage}.prof") if PROFILE else None
+
+
+def write_timings(patient_output, records, **extra):
+    """Write the per-stage records to <patient_output>/timings.json (atomically)."""
+    data = dict(extra)
+    data["stages"] = {r["stage"]: {k: v for k, v in r.items() if k != "stage"} for r in records}
+    data["total_wall_s"] = round(sum(r.get("wall_s", 0) for r in records), 4)
+    path = os.path.join(patient_output, "timings.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+    return path
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def aggregate(results_dir):
+    """
+    Combine every <results_dir>/*/timings.json into per-stage totals:
+    runs, wall/CPU hours (including child processes), mean/p50/p95 wall seconds.
+    """
+    per_stage = {}
+    for name in sorted(os.listdir(results_dir)):
+        path = os.path.join(results_dir, name, "timings.json")
+        if not os.path.isfile(path):
+            continue
+        try:
+            with open(path) as f:
+                stages = json.load(f).get("stages", {})
+        except (OSError, ValueError):
+            continue
+        for stage, r in stages.items():
+            per_stage.setdefault(stage, []).append(r)
+
+    summary = {}
+    for stage, records in per_stage.items():
+        wall = [r.get("wall_s", 0) for r in records]
+        cpu = [r.get("cpu_s", 0) + r.get("children", {}).get("user_s", 0) + r.get("children", {}).get("sys_s", 0)
+               for r in records]
+        summary[stage] = {
+            "runs": len(records),
+            "states": {s: sum(1 for r in records if r.get("state") == s) for s in {r.get("state") for r in records}},
+            "wall_hours": round(sum(wall) / 3600, 4),
+            "cpu_hours": round(sum(cpu) / 3600, 4),
+            "wall_mean_s": round(sum(wall) / len(wall), 3),
+            "wall_p50_s": round(_percentile(wall, 0.5), 3),
+            "wall_p95_s": round(_percentile(wall, 0.95), 3),
+            "max_peak_rss_mb": max(max(r.get("peak_rss_mb") or 0, r.get("children", {}).get("peak_rss_mb") or 0)
+                                   for r in records),
+        }
+    return summary
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Aggregate per-stage timings.json files across a results folder")
+    parser.add_argument("results_dir", help="Folder holding patient result folders")
+    parser.add_argument("--json", help="Also write the summary to this JSON file")
+    parser.add_argument("--profile", help="Print the top functions of a .prof dump instead")
+    parser.add_argument("--top", type=int, default=25, help="Functions shown with --profile")
+    args = parser.parse_args()
+
+    if args.profile:
+        pstats.Stats(args.profile).sort_stats("cumulative").print_stats(args.top)
+        return
+
+    summary = aggregate(args.results_dir)
+    if not summary:
+        print(f"No timings.json found under {args.results_dir}")
+        sys.exit(1)
+
+    total = sum(s["wall_hours"] for s in summary.values()) or 1
+    print(f"{'stage':<14}{'runs':>6}{'wall h':>10}{'share':>8}{'cpu h':>10}{'p50 s':>9}{'p95 s':>9}{'rss MB':>9}")
+    for stage, s in sorted(summary.items(), key=lambda kv: -kv[1]["wall_hours"]):
+        print(f"{stage:<14}{s['runs']:>6}{s['wall_hours']:>10.3f}{100 * s['wall_hours'] / total:>7.1f}%"
+              f"{s['cpu_hours']:>10.3f}{s['wall_p50_s']:>9.2f}{s['wall_p95_s']:>9.2f}{s['max_peak_rss_mb']:>9.0f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"✅ Summary written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
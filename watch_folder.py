@@ -0,0 +1,266 @@
+# watch_folder.py
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+import traceback
+
+from pipeline import RESULTS_DIR, PATIENT_FIELDS, submit_patient, read_status, write_status
+from stage_scheduler import get_scheduler
+
+SIDECAR_NAME = "patient.json"
+DICOM_MAGIC_OFFSET = 128  # "DICM" follows the 128-byte preamble of a Part 10 file
+
+
+def load_sidecar(study_dir):
+    """
+    Read optional patient details from <study_dir>/patient.json.
+    Keys are matched case-insensitively: name, age, weight, gender, height, l3_z.
+    """
+    path = os.path.join(study_dir, SIDECAR_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            raw = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not read sidecar {path}: {e}")
+        return {}
+    return {str(k).lower(): v for k, v in raw.items()}
+
+
+def folder_signature(study_dir):
+    """(file count, total bytes, newest mtime) of a study folder; changes while it is still being copied."""
+    count, size, newest = 0, 0, 0.0
+    for root, _, files in os.walk(study_dir):
+        for f in files:
+            try:
+                st = os.stat(os.path.join(root, f))
+            except OSError:
+                continue
+            count += 1
+            size += st.st_size
+            newest = max(newest, st.st_mtime)
+    return count, size, newest
+
+
+def has_dicom_files(study_dir):
+    """True if the study folder holds at least one DICOM file (.dcm or a Part 10 "DICM" preamble)."""
+    for root, _, files in os.walk(study_dir):
+        for f in files:
+            path = os.path.join(root, f)
+            if f.lower().endswith(".dcm"):
+                return True
+            try:
+                with open(path, "rb") as fh:
+                    fh.seek(DICOM_MAGIC_OFFSET)
+                    if fh.read(4) == b"DICM":
+                        return True
+            except OSError:
+                continue
+    return False
+
+
+def study_patient_name(study_dir, sidecar=None):
+    """Patient folder name under results/: sidecar name, else the study folder name."""
+    sidecar = load_sidecar(study_dir) if sidecar is None else sidecar
+    name = str(sidecar.get("name") or sidecar.get("patientname") or os.path.basename(os.path.normpath(study_dir)))
+    return re.sub(r"[\\/]+", "_", name.strip())
+
+
+def submit_study(study_dir, results_dir=RESULTS_DIR, scheduler=None, patient_name=None):
+    """
+    Queue the whole pipeline for one study folder on the stage scheduler.
+    Missing sidecar fields stay empty so scoring falls back to the DICOM header values
+    (PatientSex, PatientAge, TableHeight) written by extract_dicom_metadata.
+    patient_name overrides the results folder name (default: study_patient_name).
+    Returns (patient_name, Future of the final status).
+    """
+    sidecar = load_sidecar(study_dir)
+    patient_name = patient_name or study_patient_name(study_dir, sidecar)
+    fields = {key: sidecar.get(key.lower(), "") for key in PATIENT_FIELDS}
+    return patient_name, submit_logged(study_dir, patient_name, fields, results_dir, scheduler)
+
+def submit_logged(input_dir, patient_name, fields, results_dir=RESULTS_DIR, scheduler=None):
+    """
+    submit_patient with the progress of every stage appended to
+    <results_dir>/<patient_name>/pipeline.log. Returns the Future of the final status.
+    """
+    patient_output = os.path.join(results_dir, patient_name)
+    os.makedirs(patient_output, exist_ok=True)
+    log_file = open(os.path.join(patient_output, "pipeline.log"), "a", buffering=1)
+    lock = threading.Lock()  # stages of one patient log from several threads
+
+    def log(msg):
+        with lock:
+            log_file.write(msg)
+
+    def close_log(future):
+        if future.exception() is not None:
+            e = future.exception()
+            log(f"\nERROR: {e}\n{''.join(traceback.format_exception(e))}")
+            write_status(patient_output, patient=patient_name, state="failed", error=str(e))
+        log_file.close()
+
+    future = submit_patient(input_dir, patient_name, fields, results_dir=results_dir, log=log, scheduler=scheduler)
+    future.add_done_callback(close_log)
+    return future
+
+def process_study(study_dir, results_dir=RESULTS_DIR):
+    """Run the whole pipeline for one study folder and wait for it. Returns (patient_name, state)."""
+    patient_name, future = submit_study(study_dir, results_dir)
+    try:
+        status = future.result()
+    except Exception:
+        status = read_status(os.path.join(results_dir, patient_name))
+    return patient_name, status.get("state")
+
+
+class InboxWatcher:
+    """
+    Poll an inbox directory for new DICOM study folders and run the pipeline on
+    each one once its contents have stopped changing for settle_seconds.
+    Up to workers patients are in flight at once on the shared stage scheduler,
+    so one patient converts while another is segmenting.
+
+    Settled folders that are empty or hold no DICOM files are skipped (and
+    looked at again if their contents change). Studies whose sidecars give the
+    same patient name get distinct results folders: the second one is
+    suffixed _2, _3, ...
+    """
+
+    def __init__(self, inbox, results_dir=RESULTS_DIR, workers=2, settle_seconds=30.0, poll_interval=5.0):
+        self.inbox = os.path.abspath(inbox)
+        self.results_dir = os.path.abspath(results_dir)
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.workers = workers
+        self.scheduler = get_scheduler()
+        self._seen = {}       # study_dir -> (signature, time signature last changed)
+        self._submitted = {}  # study_dir -> Future
+        self._skipped = {}    # study_dir -> signature it was skipped with (nothing to process)
+        self._names = {}      # study_dir -> patient folder name under results_dir
+        os.makedirs(self.results_dir, exist_ok=True)
+
+    def _patient_name(self, study_dir):
+        """
+        Results folder name for a study: its sidecar/folder name, suffixed when
+        another study of this watcher, or an earlier run from a different input
+        folder, already owns that name.
+        """
+        if study_dir in self._names:
+            return self._names[study_dir]
+        base = study_patient_name(study_dir)
+        taken = set(self._names.values())
+        name, n = base, 1
+        while name in taken or read_status(os.path.join(self.results_dir, name)).get("input") not in (None, study_dir):
+            n += 1
+            name = f"{base}_{n}"
+        if name != base:
+            print(f"⚠️ {base} is already used by another study; writing {study_dir} to {name}", flush=True)
+        self._names[study_dir] = name
+        return name
+
+    def _already_done(self, study_dir):
+        patient_output = os.path.join(self.results_dir, self._patient_name(study_dir))
+        status = read_status(patient_output)
+        return status.get("state") == "done" and status.get("input") == study_dir
+
+    def poll(self):
+        """Scan the inbox once and submit every settled, unprocessed study."""
+        now = time.time()
+        try:
+            entries = sorted(e.path for e in os.scandir(self.inbox) if e.is_dir() and not e.name.startswith("."))
+        except OSError as e:
+            print(f"Cannot read inbox {self.inbox}: {e}")
+            return
+
+        for gone in set(self._seen) - set(entries) - set(self._submitted):
+            self._seen.pop(gone)  # removed from the inbox before it was processed
+            self._skipped.pop(gone, None)
+
+        for study_dir in entries:
+            if study_dir in self._submitted:
+                continue
+            sig = folder_signature(study_dir)
+            if self._skipped.get(study_dir) == sig:
+                continue
+            self._skipped.pop(study_dir, None)
+            prev = self._seen.get(study_dir)
+            if prev is None or prev[0] != sig:
+                self._seen[study_dir] = (sig, now)
+                continue
+            if now - prev[1] < self.settle_seconds:
+                continue
+            if sig[0] == 0 or not has_dicom_files(study_dir):
+                print(f"⏭️ Skipping {study_dir}: no DICOM files", flush=True)
+                self._skipped[study_dir] = sig
+                continue
+            if self._already_done(study_dir):
+                self._submitted[study_dir] = None
+                continue
+            if self.pending() >= self.workers:
+                continue  # picked up on a later poll, once a patient finishes
+
+            print(f"▶️ Queued study: {study_dir}", flush=True)
+            patient_name, future = submit_study(study_dir, self.results_dir, self.scheduler,
+                                                patient_name=self._patient_name(study_dir))
+            future.add_done_callback(lambda f, name=patient_name: self._report(name, f))
+            self._submitted[study_dir] = future
+
+    @staticmethod
+    def _report(patient_name, future):
+        try:
+            state = future.result().get("state")
+            print(f"{'✅' if state == 'done' else '⚠️'} {patient_name}: {state}", flush=True)
+        except Exception as e:
+            print(f"❌ {patient_name} crashed: {e}", flush=True)
+
+    def pending(self):
+        return sum(1 for f in self._submitted.values() if f is not None and not f.done())
+
+    def run(self, once=False):
+        """
+        Poll until interrupted. With once=True, wait for the current inbox
+        contents to settle, process them and return; folders with nothing to
+        process count as handled.
+        """
+        print(f"👀 Watching {self.inbox} -> {self.results_dir}", flush=True)
+        try:
+            while True:
+                self.poll()
+                handled = len(self._submitted) + len(self._skipped)
+                if once and self._seen and handled == len(self._seen) and not self.pending():
+                    break
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print("Stopping watcher, waiting for running patients...", flush=True)
+        finally:
+            self.scheduler.wait()
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description="Watch an inbox folder and run the sarcopenia pipeline headless")
+    parser.add_argument("--inbox", required=True, help="Folder that receives one subfolder of DICOM files per study")
+    parser.add_argument("--results", default=RESULTS_DIR, help="Results base folder")
+    parser.add_argument("--workers", type=int, default=2, help="Number of patients in flight at once")
+    parser.add_argument("--settle", type=float, default=30.0, help="Seconds a study folder must stay unchanged before processing")
+    parser.add_argument("--poll", type=float, default=5.0, help="Inbox polling interval in seconds")
+    parser.add_argument("--once", action="store_true", help="Process what is in the inbox, then exit")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.inbox):
+        print(f"❌ Inbox folder does not exist: {args.inbox}")
+        sys.exit(1)
+
+    watcher = InboxWatcher(args.inbox, args.results, workers=args.workers,
+                           settle_seconds=args.settle, poll_interval=args.poll)
+    watcher.run(once=args.once)
+
+
+if __name__ == "__main__":
+    main()